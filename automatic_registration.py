@@ -1,12 +1,13 @@
 import irdrone.utils as ut
 import irdrone.process as pr
-from registration.warp_flow import warp
+from registration.warp_flow import undistort
+from registration.pyramid import msr_pyramid, msr_input_pyramid, scales_from_scheme
+from registration.tracing import Tracer, TRACE_MANDATORY, TRACE_ALL
 import numpy as np
 import logging
 import os.path as osp
 import registration.rigid as rigid
-from irdrone.semi_auto_registration import manual_warp, ManualAlignment, Transparency, Absgrad
-from skimage import transform
+from irdrone.semi_auto_registration import get_zoom_mat, rotation_warp, manual_warp, manual_warp_variants, WARP_LOCAL, WARP_GLOBAL, ManualAlignment, Transparency, Absgrad
 import os
 osp = os.path
 import time
@@ -18,11 +19,21 @@ import cv2
 import argparse
 from pathlib import Path
 from copy import deepcopy
-from config import CROP
+from config import CROP, VIS_CAMERA, UNDISTORT_MAPS_ON_DISK
+from config import WARM_START_SEARCH_SIZE, WARM_START_COST_RATIO, WARM_START_EARLY_STOP
+from config import OFFSET_ANGLES_DOWNSCALE, COARSE_THUMBNAIL_DOWNSCALE
+from irdrone.utils import Style
+from irdrone.frame_cache import cached_image, schedule_pairs, group_pairs, get_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import traceback
+import threading
+import queue
 
 exif_dict_minimal = np.load(osp.join(osp.dirname(__file__), "utils", "minimum_exif_dji.npy"), allow_pickle=True).item()
 TRACES = ["vis", "nir", "vir", "ndvi"]
 VIS, NIR, VIR, NDVI = TRACES
+WARM_START_SEEDED, WARM_START_FALLBACK = "seeded", "fallback"
+WARM_START_ITERATIVE_SCHEME = [(16, 2, 4, 4), (16, 2, 5), (4, 3, 5)]  # smaller first search, iterations stop early
 
 def colorMapNDVI():
     #  définition de la palette des couleurs pour l'indice NDVI à partir de couleurs prédéfinies
@@ -94,8 +105,8 @@ def ndvi(vis_img, nir_img, out_path=None, exif=None, gps=None, image_in=None):
 
 
 def vir(vis_img, nir_img, out_path=None, exif=None, gps=None, image_in=None):
-    vir = vis_img.copy()
-    vir[:, :, 0] = np.mean(nir_img, axis=-1)
+    vir = np.empty_like(vis_img)  # all channels are overwritten, no copy of the visible image needed
+    np.mean(nir_img, axis=-1, out=vir[:, :, 0])
     vir[:, :, 0] *= 0.5/np.mean(vir[:, :, 0]) # @TODO: correctly expose the NIR channel
     vir[:, :, 1] = vis_img[:, :, 0]
     vir[:, :, 2] = vis_img[:, :, 1]
@@ -141,105 +152,157 @@ def user_assisted_manual_alignment(ref, mov, cals, yaw=0, pitch=0, roll=0):
 
 
 def coarse_alignment(ref_full, mov_full, cals, yaw_main, pitch_main, roll_main, extension=1.4,
-                     debug_dir=None, debug=False):
+                     debug_dir=None, debug=False, tracer=None,
+                     search_size=None, expected_cost=None, downscale=1):
+    """
+    :param tracer: registration.tracing.Tracer, overrides debug & debug_dir
+    :param search_size: restricted search window (in pixels at 1/32) around the predicted angles (warm start).
+    None searches the whole FOV extension.
+    :param expected_cost: coarse cost of the previous pair, the restricted search is inconsistent when the cost
+    at the predicted angles is much higher (WARM_START_COST_RATIO)
+    :param downscale: ref_full and mov_full are thumbnails downscaled by this factor (power of 2, at most 32)
+    :return: dict(yaw, pitch, roll, coarse_cost, consistent). The NIR image is not warped here,
+    the refined angles are composed into the single full resolution warp of align_raw.
+    When the restricted search is inconsistent, the full search shall be used.
+    """
+    if tracer is None:
+        tracer = Tracer.from_debug_flags(debug=debug, debug_dir=debug_dir)
     ts_start_coarse_search = time.perf_counter()
     ds = 32
+    level = ds // downscale  # coarse search pyramid level of the input images
     # -------------------------------------------------------------- Full res : Undistort NIR fisheye with a larger FOV
     mov_w_full = manual_warp(
         ref_full, mov_full,
         yaw_main, pitch_main, roll_main,
         refcalib=cals["refcalib"], movingcalib=cals["movingcalib"],
+        geometric_scale=None if downscale == 1 else 1./downscale,
         refinement_homography=None,
         bigger_size_factor=extension,
     )
     # ------------------------------------------------------------------------------------ Multi-spectral representation
-    # @TODO : REFACTOR! This is exactly the same kind of data preparation for pyramidal search
     msr_mode = rigid.LAPLACIAN_ENERGIES
-    # @TODO : Fix Gaussian
-    msr_ref_full = rigid.multispectral_representation(ref_full, mode=msr_mode, sigma_gaussian=3.).astype(np.float32)
-    # @TODO: re-use MSR of full res!
-    msr_mov_full = rigid.multispectral_representation(mov_w_full, mode=msr_mode, sigma_gaussian=1.).astype(np.float32)
-    msr_ref = transform.pyramid_reduce(msr_ref_full, downscale=ds, multichannel=True).astype(np.float32)
-    msr_mov = transform.pyramid_reduce(msr_mov_full, downscale=ds, multichannel=True).astype(np.float32)
+    msr_ref = msr_pyramid(ref_full, [level], msr_mode, sigma_gaussian=3./downscale)[level]
+    msr_mov = msr_pyramid(mov_w_full, [level], msr_mode, sigma_gaussian=1./downscale)[level]
     pad_y = (msr_mov.shape[0]-msr_ref.shape[0])//2
     pad_x = (msr_mov.shape[1]-msr_ref.shape[1])//2
+    restricted = search_size is not None and search_size < min(pad_x, pad_y)
+    if restricted:
+        # only keep the search window around the predicted position
+        msr_mov = msr_mov[
+            pad_y-search_size:pad_y+msr_ref.shape[0]+search_size,
+            pad_x-search_size:pad_x+msr_ref.shape[1]+search_size
+        ]
+        pad_y = pad_x = search_size
     align_config = rigid.AlignmentConfig(num_patches=1, search_size=pad_x, mode=msr_mode)
     padded_ref = np.zeros_like(msr_mov)
     padded_ref[pad_y:pad_y+msr_ref.shape[0], pad_x:pad_x+msr_ref.shape[1], :] = msr_ref
     # pr.Image(rigid.viz_msr(mov_w, None)).save(osp.join(debug_dir, "_LOWRES_MOV_INIT.jpg"))
-    if debug_dir is not None:
-        pr.Image(rigid.viz_msr(msr_mov, align_config.mode)).save(osp.join(debug_dir, "_PADDED_LOWRES_MOV_MSR.jpg"))
-        pr.Image(rigid.viz_msr(padded_ref, align_config.mode)).save(osp.join(debug_dir, "_PADDED_LOWRES_MSR_REF.jpg"))
+    tracer.image(TRACE_MANDATORY, "_PADDED_LOWRES_MOV_MSR.jpg", lambda: rigid.viz_msr(msr_mov, align_config.mode))
+    tracer.image(TRACE_MANDATORY, "_PADDED_LOWRES_MSR_REF.jpg", lambda: rigid.viz_msr(padded_ref, align_config.mode))
     cost_dict = rigid.compute_cost_surfaces_with_traces(
         msr_mov, padded_ref,
-        debug=debug, debug_dir=debug_dir,
+        debug=tracer.debug, debug_dir=tracer.forced_debug_dir,
         prefix="Full Search", suffix="",
         align_config=align_config,
-        forced_debug_dir=debug_dir,
+        forced_debug_dir=tracer.forced_debug_dir,
     )
+    cost_surface = cost_dict["costs"][0, 0, :, :, :].sum(axis=-1)
+    coarse_cost = float(cost_surface.min())
+    if restricted:
+        consistent = coarse_search_consistency(cost_surface, expected_cost=expected_cost)
+        if not consistent:
+            logging.warning("{:.2f}s elapsed in restricted coarse search - inconsistent with the prediction".format(
+                time.perf_counter() - ts_start_coarse_search))
+            return dict(yaw=yaw_main, pitch=pitch_main, roll=roll_main, coarse_cost=coarse_cost, consistent=False)
     focal = cals["refcalib"]["mtx"][0, 0].copy()
     try:
-        translation = -ds*rigid.minimum_cost_max_hessian(cost_dict["costs"][0,0, :, :, :], debug=debug)
+        translation = -ds*rigid.minimum_cost_max_hessian(cost_dict["costs"][0,0, :, :, :], debug=tracer.debug)
     except:
         logging.warning("Max of Hessian failed!")  # @ TODO: handle the case of argmax close to the edge!
         trans, _, _ = rigid.minimum_cost(cost_dict["costs"][0, 0, :, :, :])
         translation = -ds*trans
     yaw_refine = np.rad2deg(np.arctan(translation[0]/focal))
     pitch_refine = np.rad2deg(np.arctan(translation[1]/focal))
-    print("2D translation {}".format(translation, yaw_refine, pitch_refine))
-    ts_end_coarse_search = time.perf_counter()
-    logging.warning("{:.2f}s elapsed in coarse search".format(ts_end_coarse_search - ts_start_coarse_search))
-    ts_start_warp = time.perf_counter()
-    if debug_dir is not None and debug:
+    logging.info("2D translation {} - yaw refine {:.3f} pitch refine {:.3f}".format(translation, yaw_refine, pitch_refine))
+    if tracer.saving(TRACE_ALL):
         mov_wr = manual_warp(
-            msr_ref, cv2.resize(mov_full, (mov_full.shape[1]//ds, mov_full.shape[0]//ds)),
+            msr_ref, cv2.resize(mov_full, (mov_full.shape[1]//level, mov_full.shape[0]//level)),
             yaw_main + yaw_refine, pitch_main + pitch_refine, roll_main,
             refcalib=cals["refcalib"], movingcalib=cals["movingcalib"],
             geometric_scale=1/ds, refinement_homography=None,
             )
-        pr.Image(rigid.viz_msr(mov_wr, None)).save(osp.join(debug_dir, "_LOWRES_REGISTERED.jpg"))
-        pr.Image(rigid.viz_msr(cv2.resize(ref_full, (ref_full.shape[1]//ds, ref_full.shape[0]//ds)), None)).save(
-            osp.join(debug_dir, "_LOWRES_REF.jpg"))
-    mov_wr_fullres = manual_warp(
-        ref_full, mov_full,
-        yaw_main + yaw_refine, pitch_main + pitch_refine, roll_main,
-        refcalib=cals["refcalib"], movingcalib=cals["movingcalib"],
-        geometric_scale=None, refinement_homography=None,
+        tracer.image(TRACE_ALL, "_LOWRES_REGISTERED.jpg", rigid.viz_msr(mov_wr, None))
+        tracer.image(TRACE_ALL, "_LOWRES_REF.jpg",
+                     lambda: rigid.viz_msr(cv2.resize(ref_full, (ref_full.shape[1]//level, ref_full.shape[0]//level)), None))
+    ts_end_coarse_search = time.perf_counter()
+    logging.warning("{:.2f}s elapsed in coarse search".format(ts_end_coarse_search - ts_start_coarse_search))
+    return dict(
+        yaw=yaw_main + yaw_refine, pitch=pitch_main + pitch_refine, roll=roll_main,
+        coarse_cost=coarse_cost, consistent=True
     )
-    ts_end_warp = time.perf_counter()
-    logging.warning("{:.2f}s elapsed in warping from coarse search".format(ts_end_warp - ts_start_warp))
-    if debug_dir is not None:
-        pr.Image(ref_full).save(osp.join(debug_dir, "FULLRES_REF.jpg"))
-        pr.Image(mov_wr_fullres).save(osp.join(debug_dir, "FULLRES_REGISTERED_COARSE.jpg"))
-    return mov_wr_fullres, dict(yaw=yaw_main + yaw_refine, pitch=pitch_main + pitch_refine, roll=roll_main)
 
 
-def align_raw(vis_path, nir_path, cals_dict, debug_dir=None, debug=False, extension=1.4, manual=True, init_angles=[0., 0., 0.], motion_model_file = None):
+def coarse_search_consistency(cost_surface, expected_cost=None):
+    """Restricted coarse search sanity check (warm start)
+    - the minimum shall lie inside the search window (away from the borders, Hessian refinement included)
+    - the cost at the predicted position (center) shall not be much higher than the previous pair coarse cost.
     """
-    :param vis_path: Path to visible DJI DNG image
-    :param nir_path: Path to NIR SJCAM M20 RAW image
+    search_y, search_x = cost_surface.shape[0]//2, cost_surface.shape[1]//2
+    amin_y, amin_x = np.unravel_index(np.argmin(cost_surface), cost_surface.shape)
+    if abs(amin_y - search_y) > search_y - 3 or abs(amin_x - search_x) > search_x - 3:
+        logging.warning("coarse minimum on the border of the restricted search window")
+        return False
+    if expected_cost is not None and cost_surface[search_y, search_x] > WARM_START_COST_RATIO * expected_cost:
+        logging.warning("coarse cost at the predicted position {:.3g} - previous pair {:.3g}".format(
+            cost_surface[search_y, search_x], expected_cost))
+        return False
+    return True
+
+
+def align_raw(vis_path, nir_path, cals_dict, debug_dir=None, debug=False, extension=1.4, manual=True, init_angles=[0., 0., 0.], motion_model_file = None,
+              warp_variants=[WARP_LOCAL, WARP_GLOBAL], warm_start=None):
+    """
+    :param vis_path: Path to visible DJI DNG image (or an already decoded pr.Image)
+    :param nir_path: Path to NIR SJCAM M20 RAW image (or an already decoded pr.Image).
+    Decoded NIR frames are kept in the frame cache (a NIR image is often paired with 2 visible images)
+    along with their coarse search thumbnail and the input pyramid of their multispectral representation
     :param cals_dict: Geometric calibration dictionary.
     :param debug_dir: traces folder
     :param extension: extend the FOV of the NIR camera compared to the DJI camera 1.4 by default, 1.75 is ~maximum
-    :return:
+    :param warp_variants: linear NIR outputs to compute: WARP_LOCAL (homography + vector field), WARP_GLOBAL (homography)
+    :param warm_start: seed from the previous pair motion model (warm_start_seed).
+    The coarse search is restricted around the previous angle offsets, the pyramidal search starts from the previous
+    homography with a smaller search and stops early once converged.
+    Falls back to the full search when the restricted coarse search is inconsistent.
+    motion_model["warm_start"] records WARM_START_SEEDED or WARM_START_FALLBACK (None without warm start).
+    :return: visible, locally aligned NIR, globally aligned NIR (None if not requested), motion model
     """
     cals = deepcopy(cals_dict)
     if debug_dir is not None and not osp.isdir(debug_dir):
         os.mkdir(debug_dir)
     if debug_dir is not None:
         motion_model_file = osp.join(debug_dir, "motion_model")
+    tracer = Tracer.from_debug_flags(debug=debug, debug_dir=debug_dir)
     ts_start = time.perf_counter()
-    vis = pr.Image(vis_path)
-    nir = pr.Image(nir_path)
-    vis_undist = warp(vis.data, cals["refcalib"], np.eye(3))
+    vis = vis_path if isinstance(vis_path, pr.Image) else pr.Image(vis_path)
+    nir = nir_path if isinstance(nir_path, pr.Image) else cached_image(nir_path)
+    vis_undist, vis_undist_lin = undistort(
+        [vis.data, vis.lineardata], cals["refcalib"],
+        cache_folder=osp.join(osp.dirname(__file__), "calibration", VIS_CAMERA) if UNDISTORT_MAPS_ON_DISK else None
+    )
     vis_undist = pr.Image(vis_undist)
-    vis_undist_lin = warp(vis.lineardata, cals["refcalib"], np.eye(3))
     # distorsion has been compensated on the reference.
     cals_ref = cals["refcalib"]
     cals_ref["dist"] *= 0.
     cals["refcalib"] = cals_ref
     ref_full = vis_undist.data
     mov_full = nir.data
+
+    def nir_derived(name, compute):
+        """Representation of the unwarped NIR image, shared with the other pairs using it (frame cache)"""
+        if nir.path is None or not osp.isfile(nir.path):
+            return compute()
+        return get_cache().derived(nir.path, name, compute, data=mov_full)
     ts_end_load = time.perf_counter()
     logging.warning("{:.2f}s elapsed in loading full resolution RAW".format(ts_end_load - ts_start))
     if motion_model_file is None or not osp.isfile(motion_model_file+".npy"):
@@ -248,58 +311,99 @@ def align_raw(vis_path, nir_path, cals_dict, debug_dir=None, debug=False, extens
             yaw_main, pitch_main, roll_main = alignment_params["yaw"], alignment_params["pitch"], alignment_params["roll"]
         else:
             yaw_main, pitch_main, roll_main = init_angles
-        mov_wr_fullres, coarse_rotation_estimation = coarse_alignment(
-            ref_full, mov_full, cals,
-            yaw_main, pitch_main, roll_main,
+        iterative_scheme = [(16, 2, 4, 8), (16, 2, 5), (4, 3, 5)]
+        ts_start_pyr = time.perf_counter()
+        # reference pyramid computed once for the pyramidal search
+        msr_ref_pyr = msr_pyramid(
+            ref_full, scales_from_scheme(iterative_scheme), rigid.LAPLACIAN_ENERGIES, sigma_gaussian=5.
+        )
+        logging.warning("{:.2f}s elapsed in reference MSR pyramid".format(time.perf_counter() - ts_start_pyr))
+        # coarse search on thumbnails, the full resolution NIR image is only warped once per output (below)
+        ds_coarse = COARSE_THUMBNAIL_DOWNSCALE
+        ref_thumbnail = cv2.resize(
+            ref_full, (ref_full.shape[1]//ds_coarse, ref_full.shape[0]//ds_coarse), interpolation=cv2.INTER_AREA)
+        mov_thumbnail = nir_derived(("thumbnail", ds_coarse), lambda: cv2.resize(
+            mov_full, (mov_full.shape[1]//ds_coarse, mov_full.shape[0]//ds_coarse), interpolation=cv2.INTER_AREA))
+        # the coarse search uses its own (less blurred) reference representation, computed on the thumbnail
+        coarse_params = dict(
             extension=extension,  # FOV extension
-            debug_dir=debug_dir, debug=debug
+            tracer=tracer,
+            downscale=ds_coarse
+        )
+        warm_start_status = None
+        if warm_start is not None:
+            coarse_rotation_estimation = coarse_alignment(
+                ref_thumbnail, mov_thumbnail, cals,
+                yaw_main + warm_start["yaw"], pitch_main + warm_start["pitch"], roll_main + warm_start["roll"],
+                search_size=WARM_START_SEARCH_SIZE, expected_cost=warm_start.get("coarse_cost", None),
+                **coarse_params
+            )
+            warm_start_status = WARM_START_SEEDED if coarse_rotation_estimation["consistent"] else WARM_START_FALLBACK
+        if warm_start_status != WARM_START_SEEDED:
+            coarse_rotation_estimation = coarse_alignment(
+                ref_thumbnail, mov_thumbnail, cals,
+                yaw_main, pitch_main, roll_main,
+                **coarse_params
+            )
+        seeded = warm_start_status == WARM_START_SEEDED
+        coarse_warp = rotation_warp(
+            coarse_rotation_estimation["yaw"], coarse_rotation_estimation["pitch"], coarse_rotation_estimation["roll"],
+            refcalib=cals["refcalib"], movingcalib=cals["movingcalib"]
+        )
+        tracer.image(TRACE_MANDATORY, "FULLRES_REF.jpg", ref_full)
+        tracer.image(TRACE_MANDATORY, "FULLRES_REGISTERED_COARSE.jpg",
+                     lambda: coarse_warp(mov_full, np.eye(3), 1, (ref_full.shape[1], ref_full.shape[0])))
+        # the pyramidal search only warps the downsampled MSR of the NIR image (rotation composed with its homography)
+        # its input levels do not depend on the angles of the pair: shared with the other pairs using this NIR image
+        pyramidal_scheme = WARM_START_ITERATIVE_SCHEME if seeded else iterative_scheme
+        mov_scales = scales_from_scheme(pyramidal_scheme)
+        msr_mov_pyr = nir_derived(
+            ("msr_input", rigid.LAPLACIAN_ENERGIES, 3., tuple(sorted(mov_scales))),
+            lambda: msr_input_pyramid(mov_full, mov_scales, rigid.LAPLACIAN_ENERGIES, sigma_gaussian=3.)
         )
         motion_model = rigid.pyramidal_search(
-            ref_full, mov_wr_fullres,
-            iterative_scheme=[(16, 2, 4, 8), (16, 2, 5), (4, 3, 5)],
+            ref_full, mov_full,
+            iterative_scheme=pyramidal_scheme,
             mode=rigid.LAPLACIAN_ENERGIES, dist=rigid.NTG,
-            debug=debug, debug_dir=debug_dir,
             affinity=False,
             sigma_ref=5.,
-            sigma_mov=3.
+            sigma_mov=3.,
+            msr_ref_pyr=msr_ref_pyr, msr_mov_pyr=msr_mov_pyr, tracer=tracer,
+            init_model=warm_start["homography"] if seeded else None,
+            early_stop=WARM_START_EARLY_STOP if seeded else None,
+            mov_warp=coarse_warp
         )
         homog = motion_model.rescale(downscale=1.)
         full_motion_model = coarse_rotation_estimation.copy()
         full_motion_model["homography"] = homog
         full_motion_model["vector_field"] = motion_model.vector_field
         full_motion_model["previous_homography"] = motion_model.previous_model
+        full_motion_model["warm_start"] = warm_start_status
         if motion_model_file is not None:
             np.save(motion_model_file, full_motion_model, allow_pickle=True)
     else:
         logging.warning("Loading motion model!")
         full_motion_model = np.load(motion_model_file+".npy", allow_pickle=True).item()
 
-    if debug_dir is not None:
-        mov_w_final_yowo_full = manual_warp(
-            ref_full, mov_full,
-            full_motion_model["yaw"], full_motion_model["pitch"], full_motion_model["roll"],
-            refcalib=cals["refcalib"], movingcalib=cals["movingcalib"],
-            geometric_scale=None, refinement_homography=full_motion_model["previous_homography"],
-            vector_field=full_motion_model["vector_field"]
-        )  # you only warp once!
-        pr.Image(mov_w_final_yowo_full).save(osp.join(debug_dir, "FULLRES_REGISTERED_REFINED_WARPED_ONCE_ONLY.jpg"))
-    ts_start_yowo = time.perf_counter()
-    mov_w_linear_local = manual_warp(
-        ref_full, nir.lineardata,
+    tracer.image(TRACE_MANDATORY, "FULLRES_REGISTERED_REFINED_WARPED_ONCE_ONLY.jpg", lambda: manual_warp(
+        ref_full, mov_full,
         full_motion_model["yaw"], full_motion_model["pitch"], full_motion_model["roll"],
         refcalib=cals["refcalib"], movingcalib=cals["movingcalib"],
-        geometric_scale=None,
-        refinement_homography=full_motion_model["previous_homography"],
+        geometric_scale=None, refinement_homography=full_motion_model["previous_homography"],
         vector_field=full_motion_model["vector_field"]
-    )  # you only warp once!
-
-    mov_w_linear_global = manual_warp(
+    ))  # you only warp once!
+    ts_start_yowo = time.perf_counter()
+    mov_w_linear = manual_warp_variants(
         ref_full, nir.lineardata,
         full_motion_model["yaw"], full_motion_model["pitch"], full_motion_model["roll"],
         refcalib=cals["refcalib"], movingcalib=cals["movingcalib"],
-        geometric_scale=None,
-        refinement_homography=full_motion_model["homography"],
-    )  # global warp!
+        local_homography=full_motion_model["previous_homography"],
+        vector_field=full_motion_model["vector_field"],
+        global_homography=full_motion_model["homography"],
+        variants=warp_variants
+    )  # you only warp once!
+    mov_w_linear_local = mov_w_linear.get(WARP_LOCAL, None)
+    mov_w_linear_global = mov_w_linear.get(WARP_GLOBAL, None)
     ts_end = time.perf_counter()
     logging.warning("{:.2f}s elapsed in global and local unique warp".format(ts_end - ts_start_yowo))
     logging.warning("{:.2f}s elapsed in total alignment".format(ts_end - ts_start))
@@ -310,6 +414,30 @@ def align_raw(vis_path, nir_path, cals_dict, debug_dir=None, debug=False, extens
 
 
 
+def warm_start_seed(motion_model):
+    """Warm start seed of the next pair from a motion model: angle offsets found by the coarse search
+    (relatively to the initial angles) and refined homography.
+    :return: seed dictionary, None if the motion model can't be used as a seed
+    """
+    if motion_model is None or "initialization" not in motion_model.keys() or motion_model.get("homography") is None:
+        return None
+    return dict(
+        yaw=motion_model["yaw"] - motion_model["initialization"]["yaw"],
+        pitch=motion_model["pitch"] - motion_model["initialization"]["pitch"],
+        roll=motion_model["roll"] - motion_model["initialization"]["roll"],
+        homography=motion_model["homography"],
+        coarse_cost=motion_model.get("coarse_cost", None)
+    )
+
+
+def report_warm_start(motion_models):
+    """Log how often the warm start was used and how often it fell back to the full search"""
+    status = [mm.get("warm_start", None) for mm in motion_models if mm is not None]
+    seeded, fallback = status.count(WARM_START_SEEDED), status.count(WARM_START_FALLBACK)
+    logging.warning("Warm start: {} pairs seeded, {} fallbacks to the full search ({:.0f}%), {} full searches".format(
+        seeded, fallback, 100. * fallback / max(1, seeded + fallback), status.count(None)))
+
+
 def write_manual_bat_redo(vis_pth, nir_pth_list, debug_bat_pth, out_dir=None, debug=False, async_suffix=None, multispectral_folder=None, angles=None):
     if out_dir is None:
         out_dir = osp.abspath(debug_bat_pth.replace(".bat", ""))
@@ -334,148 +462,640 @@ def write_manual_bat_redo(vis_pth, nir_pth_list, debug_bat_pth, out_dir=None, de
             fi.write(cmd)
         fi.write("call deactivate\n")
 
+
+def initial_angles(angles=None, shoot_point=None):
+    """Initial [yaw, pitch, roll] of a pair: theoretical angles of the shoot point (EXIF) when available,
+    otherwise user provided angles (0 by default)
+    """
+    if angles is None:
+        yaw_init, pitch_init, roll_init = 0., 0., 0.
+    else:
+        assert len(angles) == 3
+        yaw_init, pitch_init, roll_init = angles
+    if shoot_point is not None:
+        yaw_init = shoot_point.yawIR2VI
+        pitch_init = shoot_point.pitchIR2VI
+        roll_init = shoot_point.rollIR2VI
+        logging.info(f"INIT ANGLES FROM EXIF: yaw {yaw_init}, pitch {pitch_init}, roll {roll_init}")
+    return [yaw_init, pitch_init, roll_init]
+
+
+def coarse_angles_pair(
+        index_pair,
+        sync_pairs,
+        cals=dict(refcalib=ut.cameracalibration(camera="DJI_RAW"), movingcalib=ut.cameracalibration(camera="M20_RAW")),
+        extension=1.4,
+        shoot_point=None,
+        angles=None,
+        downscale=OFFSET_ANGLES_DOWNSCALE
+    ):
+    """Angles only alignment of a pair: coarse search on thumbnails, nothing is warped at full resolution
+    and nothing is written.
+    Thumbnails are read from the memory mapped RAW proxies when available, otherwise RAW images are decoded at reduced
+    resolution by RawTherapee (see pr.Image.thumbnail): no full resolution decoding.
+
+    :param downscale: thumbnails downscale factor (power of 2, at most 32)
+    :return: dict(yaw, pitch, roll, coarse_cost, initialization) like the motion model of align_raw
+    """
+    ts_start = time.perf_counter()
+    vis_pth, nir_pth = sync_pairs[index_pair]
+    init_angles = initial_angles(angles=angles, shoot_point=shoot_point)
+    cals = deepcopy(cals)
+    ref_cal = deepcopy(cals["refcalib"])
+    ref_cal["mtx"] = np.dot(get_zoom_mat(1./downscale), ref_cal["mtx"])
+    ref = undistort([pr.Image(vis_pth).thumbnail(downscale)], ref_cal)[0]
+    mov = pr.Image(nir_pth).thumbnail(downscale)
+    cals["refcalib"]["dist"] *= 0.  # distorsion has been compensated on the reference.
+    coarse_rotation_estimation = coarse_alignment(
+        ref, mov, cals,
+        init_angles[0], init_angles[1], init_angles[2],
+        extension=extension,
+        downscale=downscale
+    )
+    coarse_rotation_estimation["initialization"] = {"yaw": init_angles[0], "pitch": init_angles[1], "roll": init_angles[2]}
+    logging.warning("{:.2f}s elapsed in angles only alignment of {}".format(
+        time.perf_counter() - ts_start, osp.basename(vis_pth)))
+    return coarse_rotation_estimation
+
+
+def coarse_angles_pair_record(index_pair, sync_pairs, **kwargs):
+    """Process pool entry point of coarse_angles_pair, never raises (see process_raw_pair_record)
+    """
+    vis_pth, nir_pth = sync_pairs[index_pair]
+    record = dict(index=index_pair, vis=vis_pth, nir=nir_pth, motion_model=None, error=None)
+    try:
+        record["motion_model"] = coarse_angles_pair(index_pair, sync_pairs, **kwargs)
+    except Exception:
+        record["error"] = traceback.format_exc()
+    return record
+
+
+def coarse_angles_pair_records(indexes, sync_pairs, shoot_points=None, **kwargs):
+    """Process pool entry point for pairs sharing the same NIR image (see process_raw_pair_records)
+    """
+    return [
+        coarse_angles_pair_record(
+            index_pair, sync_pairs, shoot_point=None if shoot_points is None else shoot_points[id_pair], **kwargs
+        )
+        for id_pair, index_pair in enumerate(indexes)
+    ]
+
+
+def coarse_angles_pairs(
+        sync_pairs,
+        cals=dict(refcalib=ut.cameracalibration(camera="DJI_RAW"), movingcalib=ut.cameracalibration(camera="M20_RAW")),
+        extension=1.4,
+        listPts=None,
+        angles=None,
+        downscale=OFFSET_ANGLES_DOWNSCALE,
+        workers=None
+    ):
+    """Angles only alignment of all pairs in parallel processes (offset angles pre-computation)
+
+    :param workers: number of processes, all CPUs by default
+    :return: list of coarse angles dictionaries (see coarse_angles_pair), in the same order as sync_pairs
+    (None for failed pairs)
+    """
+    ts_start = time.perf_counter()
+    if workers is None:
+        workers = os.cpu_count()
+    pair_kwargs = dict(cals=cals, extension=extension, angles=angles, downscale=downscale)
+    if workers <= 1 or len(sync_pairs) <= 1:
+        records = [
+            coarse_angles_pair_record(
+                index_pair, sync_pairs, shoot_point=None if listPts is None else listPts[index_pair], **pair_kwargs
+            )
+            for index_pair in range(len(sync_pairs))
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    coarse_angles_pair_records,
+                    indexes, sync_pairs,
+                    shoot_points=None if listPts is None else [listPts[index_pair] for index_pair in indexes],
+                    **pair_kwargs
+                ): indexes
+                for indexes in group_pairs(sync_pairs)
+            }
+            records = gather_records(futures, sync_pairs)
+    report_failed_pairs(records)
+    logging.warning("{:.2f}s elapsed in angles only alignment of {} pairs".format(
+        time.perf_counter() - ts_start, len(sync_pairs)))
+    return [record["motion_model"] for record in records]
+
+
+def decode_raw_pair(
+        index_pair,
+        sync_pairs,
+        debug_folder=None, out_dir=None, manual=False,
+        shoot_point=None, option_alti='takeoff',
+        multispectral_folder=None,
+        angles=None
+    ):
+    """Pipeline stage 1: prepare a pair and decode both RAW images (RawTherapee / sjcam_raw2dng subprocesses).
+
+    :return: job dictionary passed to align_raw_pair then write_raw_pair
+    """
+    vis_pth, nir_pth = sync_pairs[index_pair]
+    angles = initial_angles(angles=angles, shoot_point=shoot_point)
+    # RELOAD PREVIOUSLY COMPUTED MOTION FILE
+    motion_model_file = osp.join(out_dir, osp.basename(vis_pth[:-4])+"_motion_model")
+    if not osp.exists(motion_model_file + ".npy"):
+        motion_model_file = None
+    else:
+        logging.warning(f"Using cached motion file {motion_model_file}")
+    logging.warning("processing {} {}".format(osp.basename(vis_pth), osp.basename(nir_pth)))
+
+    # DEBUG FOLDER
+    if debug_folder is not None:
+        debug_dir = osp.join(debug_folder, osp.basename(vis_pth)[:-4]+"_align_traces" + ("_manual" if manual else ""))
+    else:
+        debug_dir = None
+
+    # REDO.bat
+    if os.name == "nt":
+        offset_async = [offset for offset in [0, -1, +1, -2, +2]
+                    if (index_pair+offset >=0 and index_pair+offset<len(sync_pairs))]
+        nir_pth_async = [sync_pairs[index_pair+offset][1] for offset in offset_async]
+        write_manual_bat_redo(vis_pth, nir_pth_async,
+                          osp.join(out_dir, osp.basename(vis_pth[:-4])+"_REDO_ASYNC.bat"),
+                          async_suffix=offset_async,
+                          debug=False,
+                          multispectral_folder=multispectral_folder,
+                          angles=angles)
+        write_manual_bat_redo(vis_pth, [nir_pth], osp.join(out_dir, osp.basename(vis_pth[:-4])+"_REDO.bat"), debug=False, multispectral_folder=multispectral_folder, angles=angles)
+        write_manual_bat_redo(vis_pth, [nir_pth], osp.join(out_dir, osp.basename(vis_pth[:-4])+"_DEBUG.bat"), debug=True, multispectral_folder=multispectral_folder, angles=angles)
+
+
+    vis = pr.Image(vis_pth)
+    gps_vis = vis.gps
+    date_vis = vis.date   # todo fix error  date Exif (Date/Time Original and Create Date
+    try:
+        #option_alti = 'sealevel'  #   geo, ground, sealevel, takeoff
+
+        if option_alti == 'geo':
+            # Substitutes of drone altitude to the takeoff by altitude of ground to sea level
+            gps_vis['altitude'] = shoot_point.altGeo
+            logging.info(f"Use altitude of ground to sea level : {gps_vis['altitude']} m")
+        if option_alti == 'ground':
+            #Substitutes of drone altitude to the takeoff by drone altitude to ground.
+            gps_vis['altitude'] = shoot_point.altGround
+            logging.info(f"Use altitude of drone to ground  : {gps_vis['altitude']} m")
+        if option_alti == 'sealevel':
+            #Substitutes of drone altitude to the takeoff by drone altitude to ground.
+            gps_vis['altitude'] = shoot_point.altGeo + shoot_point.altGround
+            logging.info(f"Use altitude of drone to sea level  : {gps_vis['altitude']} m")
+        if option_alti == 'takeoff':
+            # altitude of droe to the takeoff.
+            logging.info(f"Use altitude of drone to takeoff  : {gps_vis['altitude']} m")
+            gps_vis['altitude'] = shoot_point.altTakeOff
+    except Exception as exc:
+        logging.warning(f"{exc} use altitude drone to takeoff instead: {gps_vis['altitude']} m")
+
+    ts_start = time.perf_counter()
+    nir = cached_image(nir_pth)  # NIR image shared with the previous pair is decoded once
+    vis.data  # force decoding of the visible RAW file (linear data is decoded at the same time)
+    logging.warning("{:.2f}s elapsed in decoding {} {}".format(
+        time.perf_counter() - ts_start, osp.basename(vis_pth), osp.basename(nir_pth)))
+    return dict(
+        index=index_pair, vis_pth=vis_pth, nir_pth=nir_pth,
+        vis=vis, nir=nir, gps_vis=gps_vis,
+        init_angles=angles, motion_model_file=motion_model_file, debug_dir=debug_dir
+    )
+
+
+def align_raw_pair(
+        job,
+        cals=dict(refcalib=ut.cameracalibration(camera="DJI_RAW"), movingcalib=ut.cameracalibration(camera="M20_RAW")),
+        extension=1.4,
+        manual=False, debug=False,
+        warp_variants=[WARP_LOCAL, WARP_GLOBAL],
+        warm_start=None
+    ):
+    """Pipeline stage 2: align a decoded pair (CPU bound). Decoded images are released once warped.
+    :param warm_start: seed from the previous pair motion model (warm_start_seed), None for a full search
+    """
+    job["ref_full"], job["aligned_full"], job["align_full_global"], job["motion_model"] = align_raw(
+        job["vis"], job["nir"], cals,
+        debug_dir=job["debug_dir"], debug=debug,
+        manual=manual,
+        extension=extension,
+        init_angles=job["init_angles"],
+        motion_model_file=job["motion_model_file"],
+        warp_variants=warp_variants,
+        warm_start=warm_start
+    )
+    job["vis"], job["nir"] = None, None
+    return job
+
+
+def required_warps(traces, debug=False):
+    """Aligned NIR variants consumed by write_raw_pair: the local alignment is always used (multispectral output),
+    the global one only by the NIR/VIR/NDVI traces and the debug outputs.
+    """
+    if debug or any([trace in traces for trace in [NIR, VIR, NDVI]]):
+        return [WARP_LOCAL, WARP_GLOBAL]
+    return [WARP_LOCAL]
+
+
+def write_raw_pair(
+        job,
+        out_dir=None, debug=False,
+        crop=None,
+        clean_proxy=False, proxy_budget=None,
+        multispectral_folder=None,
+        traces=[VIS, NIR, VIR, NDVI],
+    ):
+    """Pipeline stage 3: write all outputs of an aligned pair (disk + exiftool subprocesses).
+
+    :return: motion model
+    """
+    vis_pth, nir_pth = job["vis_pth"], job["nir_pth"]
+    gps_vis = job["gps_vis"]
+    motion_model_file = job["motion_model_file"]
+    ref_full, aligned_full, align_full_global = job["ref_full"], job["aligned_full"], job["align_full_global"]
+    motion_model = job["motion_model"]
+    ts_start = time.perf_counter()
+
+    # AGGREGATED RESULTS! (crops are views, no full resolution copies)
+    if crop is not None:
+        aligned_full = aligned_full[crop:-crop, crop:-crop, :]
+        if align_full_global is not None:
+            align_full_global = align_full_global[crop:-crop, crop:-crop, :]
+        ref_full = ref_full[crop:-crop, crop:-crop, :]
+    # Systematically write motion model!
+    if motion_model is not None:
+        if motion_model_file is None:
+            motion_model_file = osp.join(out_dir, osp.basename(vis_pth[:-4])+"_motion_model")
+        np.save(motion_model_file, motion_model, allow_pickle=True)
+    if multispectral_folder is not None:
+        img = pr.Image(vis_pth)
+        ms_img = np.empty((ref_full.shape[0], ref_full.shape[1], 4), dtype=pr.working_dtype())
+        ms_img[:, :, :3] = ref_full
+        np.mean(aligned_full, axis=-1, out=ms_img[:, :, 3])
+        img._data = ms_img
+        # out_name = f"{(index_pair+1):04d}"
+        out_name = osp.basename(vis_pth[:-4])
+        img.save_multispectral(Path(multispectral_folder)/out_name)
+    if VIS in traces:
+        vis_img = pr.Image((ut.contrast_stretching(ref_full)[0]*255).astype(np.uint8))
+        vis_img.path = vis_pth
+        vis_img.save(
+            osp.join(out_dir, osp.basename(vis_pth[:-4])+"_VIS.jpg"), gps=gps_vis, exif=exif_dict_minimal)
+
+    for ali, almode in [(aligned_full, "_local_"), (align_full_global, "_global_")]:
+        if ali is None:
+            continue
+        if NDVI in traces:
+            ndvi(ref_full, ali, out_path=osp.join(out_dir, "_NDVI_" + almode + osp.basename(vis_pth[:-4])+".jpg"),
+                gps=gps_vis, exif=exif_dict_minimal, image_in=vis_pth)
+        if VIR in traces:
+            vir(ref_full, ali, out_path=osp.join(out_dir, "_VIR_" + almode + osp.basename(vis_pth[:-4])+".jpg"),
+                gps=gps_vis, exif=exif_dict_minimal, image_in=vis_pth)
+        if NIR in traces:
+            nir_out = pr.Image((ut.contrast_stretching(ali)[0]*255).astype(np.uint8))
+            nir_out.path = vis_pth
+            nir_out.save(
+                osp.join(out_dir, osp.basename(vis_pth[:-4])+"_NIR{}.jpg".format(almode)),
+                exif=exif_dict_minimal,
+                gps=gps_vis
+            )
+    if debug:  # SCIENTIFIC LINEAR OUTPUTS
+        pr.Image(aligned_full).save(osp.join(out_dir, "_RAW_" + osp.basename(vis_pth[:-4])+"_NIR.tif"), gps=gps_vis, exif=exif_dict_minimal)
+        pr.Image(align_full_global).save(osp.join(out_dir, "_RAW_" + osp.basename(vis_pth[:-4])+"_NIR_global.tif"), gps=gps_vis, exif=exif_dict_minimal)
+        pr.Image(ref_full).save(osp.join(out_dir, "_RAW_"+ osp.basename(vis_pth[:-4])+"_VIS.tif"), gps=gps_vis, exif=exif_dict_minimal)
+
+    if clean_proxy:
+        clean_proxies([vis_pth, nir_pth], proxy_budget=proxy_budget)
+    logging.warning("{:.2f}s elapsed in writing outputs of {}".format(time.perf_counter() - ts_start, osp.basename(vis_pth)))
+    return motion_model
+
+
+def clean_proxies(img_paths, proxy_budget=None):
+    """Release the RAW proxies of images which are not needed anymore (see pr.Image.clean_proxy)
+    """
+    for img_pth in img_paths:
+        pr.Image(img_pth).clean_proxy(budget=proxy_budget)
+
+
+def process_raw_pair(
+        index_pair,
+        sync_pairs,
+        cals=dict(refcalib=ut.cameracalibration(camera="DJI_RAW"), movingcalib=ut.cameracalibration(camera="M20_RAW")),
+        extension=1.4,
+        debug_folder=None, out_dir=None, manual=False, debug=False,
+        crop=None, shoot_point=None, option_alti='takeoff',
+        clean_proxy=False, proxy_budget=None,
+        multispectral_folder=None,
+        traces=[VIS, NIR, VIR, NDVI],
+        angles=None,
+        warm_start=None
+    ):
+    """Align a single (visible DNG, NIR RAW) pair and write all its outputs.
+    Output names only depend on the visible image name, so pairs can be processed in any order.
+
+    :param index_pair: index of the pair to process in sync_pairs
+    :param sync_pairs: list of all (visible, NIR) pairs (neighbours are used for the REDO_ASYNC.bat helpers)
+    :param shoot_point: ShootPoint metadata of the pair (initial angles & altitudes), None if not available
+    :param warm_start: seed from the previous pair motion model (warm_start_seed)
+    :return: motion model
+    """
+    job = decode_raw_pair(
+        index_pair, sync_pairs,
+        debug_folder=debug_folder, out_dir=out_dir, manual=manual,
+        shoot_point=shoot_point, option_alti=option_alti,
+        multispectral_folder=multispectral_folder, angles=angles
+    )
+    job = align_raw_pair(
+        job, cals=cals, extension=extension, manual=manual, debug=debug,
+        warp_variants=required_warps(traces, debug=debug),
+        warm_start=warm_start
+    )
+    return write_raw_pair(
+        job, out_dir=out_dir, debug=debug, crop=crop, clean_proxy=clean_proxy, proxy_budget=proxy_budget,
+        multispectral_folder=multispectral_folder, traces=traces
+    )
+
+
+def process_raw_pair_record(index_pair, sync_pairs, **kwargs):
+    """Process pool entry point: never raises, returns a per-pair record instead
+    so that a single bad pair does not kill the whole batch.
+
+    :return: dict(index, vis, nir, motion_model, error)
+    """
+    vis_pth, nir_pth = sync_pairs[index_pair]
+    record = dict(index=index_pair, vis=vis_pth, nir=nir_pth, motion_model=None, error=None)
+    try:
+        record["motion_model"] = process_raw_pair(index_pair, sync_pairs, **kwargs)
+    except Exception:
+        record["error"] = traceback.format_exc()
+    return record
+
+
+def process_raw_pair_records(indexes, sync_pairs, shoot_points=None, **kwargs):
+    """Process pool entry point for pairs sharing the same NIR image (decoded once by the worker)
+
+    :param shoot_points: ShootPoint of each pair (same order as indexes), None if not available
+    :return: list of records (see process_raw_pair_record)
+    """
+    return [
+        process_raw_pair_record(
+            index_pair, sync_pairs, shoot_point=None if shoot_points is None else shoot_points[id_pair], **kwargs
+        )
+        for id_pair, index_pair in enumerate(indexes)
+    ]
+
+
+def process_raw_pairs_pipeline(
+        sync_pairs,
+        listPts=None,
+        queue_depth=1,
+        cals=dict(refcalib=ut.cameracalibration(camera="DJI_RAW"), movingcalib=ut.cameracalibration(camera="M20_RAW")),
+        extension=1.4,
+        debug_folder=None, out_dir=None, manual=False, debug=False,
+        crop=None, option_alti='takeoff',
+        clean_proxy=False, proxy_budget=None,
+        multispectral_folder=None,
+        traces=[VIS, NIR, VIR, NDVI],
+        angles=None,
+        warm_start=False
+    ):
+    """Three stages producer/consumer pipeline: decode thread -> alignment (main thread) -> writer thread.
+    Decoding and writing are mostly spent in subprocesses & disk I/O, so they overlap with the alignment.
+    Alignment stays in the main thread so that manual alignment GUI keeps working.
+    Bounded queues of size queue_depth cap the number of full resolution pairs kept in memory.
+    Pairs sharing the same NIR image are decoded one after the other (schedule_pairs) so the NIR image is decoded once.
+    With warm_start, each pair is seeded with the motion model of the previously aligned pair.
+    With clean_proxy, the proxies of an image are released by the writer once all the pairs using it are finished
+    (the decoder may already be decoding the next pair sharing the same NIR image).
+    If the alignment stage is interrupted, the decoder stops after its current pair and both threads are joined.
+
+    :return: list of motion models, in the same order as sync_pairs (None for failed pairs)
+    """
+    decoded_queue = queue.Queue(maxsize=queue_depth)
+    aligned_queue = queue.Queue(maxsize=queue_depth)
+    stop_decoding = threading.Event()
+    records = [
+        dict(index=index_pair, vis=vis_pth, nir=nir_pth, motion_model=None, error=None)
+        for index_pair, (vis_pth, nir_pth) in enumerate(sync_pairs)
+    ]
+    pending_pairs = dict()  # image -> pairs using it which are not finished yet (only accessed by the writer)
+    for index_pair, pair in enumerate(sync_pairs):
+        for img_pth in pair:
+            pending_pairs.setdefault(osp.abspath(str(img_pth)), set()).add(index_pair)
+
+    def decoder():
+        for index_pair in schedule_pairs(sync_pairs):
+            if stop_decoding.is_set():
+                break
+            try:
+                job = decode_raw_pair(
+                    index_pair, sync_pairs,
+                    debug_folder=debug_folder, out_dir=out_dir, manual=manual,
+                    shoot_point=None if listPts is None else listPts[index_pair],
+                    option_alti=option_alti,
+                    multispectral_folder=multispectral_folder, angles=angles
+                )
+            except Exception:
+                records[index_pair]["error"] = traceback.format_exc()
+                job = None
+            decoded_queue.put((index_pair, job))
+        decoded_queue.put(None)
+
+    def writer():
+        while True:
+            item = aligned_queue.get()
+            if item is None:
+                break
+            index_pair, job = item
+            if job is not None:  # failed pairs are only forwarded to release their images
+                try:
+                    records[index_pair]["motion_model"] = write_raw_pair(
+                        job, out_dir=out_dir, debug=debug, crop=crop, clean_proxy=False,
+                        multispectral_folder=multispectral_folder, traces=traces
+                    )
+                except Exception:
+                    records[index_pair]["error"] = traceback.format_exc()
+            released = []
+            for img_pth in sync_pairs[index_pair]:
+                pairs_using = pending_pairs[osp.abspath(str(img_pth))]
+                pairs_using.discard(index_pair)
+                if len(pairs_using) == 0:
+                    released.append(img_pth)
+            if clean_proxy:
+                try:
+                    clean_proxies(released, proxy_budget=proxy_budget)
+                except Exception:
+                    logging.warning("cannot clean proxies of {}\n{}".format(released, traceback.format_exc()))
+
+    decode_thread = threading.Thread(target=decoder, daemon=True)
+    write_thread = threading.Thread(target=writer, daemon=True)
+    decode_thread.start()
+    write_thread.start()
+    seed = None
+    decoded_all = False
+    try:
+        while True:
+            item = decoded_queue.get()
+            if item is None:
+                decoded_all = True
+                break
+            index_pair, job = item
+            if job is not None:
+                try:
+                    job = align_raw_pair(
+                        job, cals=cals, extension=extension, manual=manual, debug=debug,
+                        warp_variants=required_warps(traces, debug=debug),
+                        warm_start=seed
+                    )
+                    if warm_start:
+                        seed = warm_start_seed(job["motion_model"]) or seed
+                except Exception:
+                    records[index_pair]["error"] = traceback.format_exc()
+                    job = None
+            aligned_queue.put((index_pair, job))
+    finally:
+        if not decoded_all:  # interrupted: stop the decoder and unblock it
+            stop_decoding.set()
+            while decoded_queue.get() is not None:
+                pass
+        decode_thread.join()
+        aligned_queue.put(None)
+        write_thread.join()
+    report_failed_pairs(records)
+    if warm_start:
+        report_warm_start([record["motion_model"] for record in records])
+    get_cache().report()
+    return [record["motion_model"] for record in records]
+
+
+def gather_records(futures, sync_pairs):
+    """Wait for process pool tasks returning lists of per-pair records.
+    A task which raised (worker killed when running out of memory, BrokenProcessPool...) only fails its own pairs,
+    records of the tasks which completed are kept.
+
+    :param futures: dictionary {future: indexes of the pairs processed by the task}
+    :return: list of records, in the same order as sync_pairs
+    """
+    records = [None] * len(sync_pairs)
+    for future in as_completed(futures):
+        try:
+            task_records = future.result()
+        except Exception:
+            error = traceback.format_exc()
+            task_records = [
+                dict(index=index_pair, vis=sync_pairs[index_pair][0], nir=sync_pairs[index_pair][1],
+                     motion_model=None, error=error)
+                for index_pair in futures[future]
+            ]
+        for record in task_records:
+            records[record["index"]] = record
+    return records
+
+
+def report_failed_pairs(records):
+    for record in records:
+        if record["error"] is not None:
+            logging.error(Style.RED + "Pair {} failed {} {}\n{}".format(
+                record["index"], osp.basename(record["vis"]), osp.basename(record["nir"]), record["error"]) + Style.RESET)
+    failures = [record for record in records if record["error"] is not None]
+    if len(failures) > 0:
+        logging.error(Style.RED + "{}/{} pairs failed: {}".format(
+            len(failures), len(records), [osp.basename(record["vis"]) for record in failures]) + Style.RESET)
+
+
 def process_raw_pairs(
         sync_pairs,
         cals=dict(refcalib=ut.cameracalibration(camera="DJI_RAW"), movingcalib=ut.cameracalibration(camera="M20_RAW")),
         extension=1.4,
         debug_folder=None, out_dir=None, manual=False, debug=False,
         crop=None, listPts=None, option_alti='takeoff',
-        clean_proxy=False,
+        clean_proxy=False, proxy_budget=None,
         multispectral_folder=None,
         traces=[VIS, NIR, VIR, NDVI],
-        angles=None
+        angles=None,
+        workers=1,
+        queue_depth=None,
+        warm_start=False
     ):
+    """Align all (visible, NIR) pairs and write results to out_dir
+
+    :param workers: number of processes. When > 1, pairs are dispatched to a process pool,
+    each worker decodes / aligns / writes its own pairs.
+    Whatever the number of workers or the pipeline, a failing pair is logged (report_failed_pairs)
+    and gets a None motion model instead of interrupting the batch.
+    Manual alignment requires a GUI and is never dispatched to a process pool.
+    :param proxy_budget: with clean_proxy, disk budget (bytes) of the proxies kept in each source folder proxy cache
+    (visible and NIR folders are budgeted separately).
+    None uses config.PROXY_CACHE_BUDGET (0 by default: proxies are removed after each pair)
+    :param queue_depth: when > 0 (and a single worker is used), decoding, alignment and writing are pipelined:
+    pair N+1 is decoded and pair N-1 is written while pair N is aligned.
+    queue_depth is the maximum number of pairs waiting between two stages (caps memory).
+    :param warm_start: seed each pair with the refined motion model of the previous pair (hyperlapse sequences):
+    restricted coarse search, smaller pyramidal search with early stop, full search fallback when inconsistent.
+    Sequential processing only (ignored with several workers or manual alignment).
+    Pairs sharing the same NIR image are processed one after the other (by the same worker) so that the decoded NIR
+    image is re-used from the frame cache.
+    :return: list of motion models, in the same order as sync_pairs (None for failed pairs)
+    """
     # if debug_folder is None:
     #     debug_folder = osp.dirname(sync_pairs[0][0])
     if out_dir is None:
         out_dir = osp.join(osp.dirname(sync_pairs[0][0]), "_RESULTS")
     if not osp.exists(out_dir):
         os.mkdir(out_dir)
-    motion_model_list = []
-    for index_pair, (vis_pth, nir_pth) in enumerate(sync_pairs):
-        if angles is None:
-            yaw_init, pitch_init, roll_init = 0., 0., 0.
-        else:
-            assert len(angles) == 3
-            yaw_init, pitch_init, roll_init = angles
-        if listPts is not None:
-            yaw_init = listPts[index_pair].yawIR2VI
-            pitch_init = listPts[index_pair].pitchIR2VI
-            roll_init = listPts[index_pair].rollIR2VI
-            logging.info(f"INIT ANGLES FROM EXIF: yaw {yaw_init}, pitch {pitch_init}, roll {roll_init}")
-        angles = [yaw_init, pitch_init, roll_init]
-        # RELOAD PREVIOUSLY COMPUTED MOTION FILE
-        motion_model_file = osp.join(out_dir, osp.basename(vis_pth[:-4])+"_motion_model")
-        if not osp.exists(motion_model_file + ".npy"):
-            motion_model_file = None
-        else:
-            logging.warning(f"Using cached motion file {motion_model_file}")
-        logging.warning("processing {} {}".format(osp.basename(vis_pth), osp.basename(nir_pth)))
-        
-        # DEBUG FOLDER
-        if debug_folder is not None:
-            debug_dir = osp.join(debug_folder, osp.basename(vis_pth)[:-4]+"_align_traces" + ("_manual" if manual else ""))
-        else:
-            debug_dir = None
-
-        # REDO.bat
-        if os.name == "nt":
-            offset_async = [offset for offset in [0, -1, +1, -2, +2]
-                        if (index_pair+offset >=0 and index_pair+offset<len(sync_pairs))]
-            nir_pth_async = [sync_pairs[index_pair+offset][1] for offset in offset_async]
-            write_manual_bat_redo(vis_pth, nir_pth_async,
-                              osp.join(out_dir, osp.basename(vis_pth[:-4])+"_REDO_ASYNC.bat"),
-                              async_suffix=offset_async,
-                              debug=False,
-                              multispectral_folder=multispectral_folder,
-                              angles=angles)
-            write_manual_bat_redo(vis_pth, [nir_pth], osp.join(out_dir, osp.basename(vis_pth[:-4])+"_REDO.bat"), debug=False, multispectral_folder=multispectral_folder, angles=angles)
-            write_manual_bat_redo(vis_pth, [nir_pth], osp.join(out_dir, osp.basename(vis_pth[:-4])+"_DEBUG.bat"), debug=True, multispectral_folder=multispectral_folder, angles=angles)
-
-
-        gps_vis = pr.Image(vis_pth).gps
-        date_vis = pr.Image(vis_pth).date   # todo fix error  date Exif (Date/Time Original and Create Date
-        try:
-            #option_alti = 'sealevel'  #   geo, ground, sealevel, takeoff
-
-            if option_alti == 'geo':
-                # Substitutes of drone altitude to the takeoff by altitude of ground to sea level
-                gps_vis['altitude'] = listPts[index_pair].altGeo
-                logging.info(f"Use altitude of ground to sea level : {gps_vis['altitude']} m")
-            if option_alti == 'ground':
-                #Substitutes of drone altitude to the takeoff by drone altitude to ground.
-                gps_vis['altitude'] = listPts[index_pair].altGround
-                logging.info(f"Use altitude of drone to ground  : {gps_vis['altitude']} m")
-            if option_alti == 'sealevel':
-                #Substitutes of drone altitude to the takeoff by drone altitude to ground.
-                gps_vis['altitude'] = listPts[index_pair].altGeo + listPts[index_pair].altGround
-                logging.info(f"Use altitude of drone to sea level  : {gps_vis['altitude']} m")
-            if option_alti == 'takeoff':
-                # altitude of droe to the takeoff.
-                logging.info(f"Use altitude of drone to takeoff  : {gps_vis['altitude']} m")
-                gps_vis['altitude'] = listPts[index_pair].altTakeOff
-        except Exception as exc:
-            logging.warning(f"{exc} use altitude drone to takeoff instead: {gps_vis['altitude']} m")
-
-        ref_full, aligned_full, align_full_global, motion_model = align_raw(
-            vis_pth, nir_pth, cals,
-            debug_dir=debug_dir, debug=debug,
-            manual=manual,
-            extension=extension,
-            init_angles=[yaw_init, pitch_init, roll_init],
-            motion_model_file=motion_model_file
-        )
-        
-        # AGGREGATED RESULTS!
-        if crop is not None:
-            aligned_full = aligned_full[crop:-crop, crop:-crop, :]
-            align_full_global = align_full_global[crop:-crop, crop:-crop, :]
-            ref_full = ref_full[crop:-crop, crop:-crop, :]
-        # Systematically write motion model!
-        if motion_model is not None:
-            if motion_model_file is None:
-                motion_model_file = osp.join(out_dir, osp.basename(vis_pth[:-4])+"_motion_model")
-            np.save(motion_model_file, motion_model, allow_pickle=True)
-        if multispectral_folder is not None:
-            img = pr.Image(vis_pth)
-            ms_img = np.zeros((ref_full.shape[0], ref_full.shape[1], 4))
-            ms_img[:, :, :3] = ref_full
-            ms_img[:, :, 3] = np.average(aligned_full, axis=-1)
-            img._data = ms_img
-            # out_name = f"{(index_pair+1):04d}"
-            out_name = osp.basename(vis_pth[:-4])
-            img.save_multispectral(Path(multispectral_folder)/out_name)
-        if VIS in traces:
-            vis_img = pr.Image((ut.contrast_stretching(ref_full)[0]*255).astype(np.uint8))
-            vis_img.path = vis_pth
-            vis_img.save(
-                osp.join(out_dir, osp.basename(vis_pth[:-4])+"_VIS.jpg"), gps=gps_vis, exif=exif_dict_minimal)
-        
-        for ali, almode in [(aligned_full, "_local_"), (align_full_global, "_global_")]:
-            if NDVI in traces:
-                ndvi(ref_full, ali, out_path=osp.join(out_dir, "_NDVI_" + almode + osp.basename(vis_pth[:-4])+".jpg"),
-                    gps=gps_vis, exif=exif_dict_minimal, image_in=vis_pth)
-            if VIR in traces:
-                vir(ref_full, ali, out_path=osp.join(out_dir, "_VIR_" + almode + osp.basename(vis_pth[:-4])+".jpg"),
-                    gps=gps_vis, exif=exif_dict_minimal, image_in=vis_pth)
-            if NIR in traces:
-                nir_out = pr.Image((ut.contrast_stretching(ali)[0]*255).astype(np.uint8))
-                nir_out.path = vis_pth
-                nir_out.save(
-                    osp.join(out_dir, osp.basename(vis_pth[:-4])+"_NIR{}.jpg".format(almode)),
-                    exif=exif_dict_minimal,
-                    gps=gps_vis
-                )
-        if debug:  # SCIENTIFIC LINEAR OUTPUTS
-            pr.Image(aligned_full).save(osp.join(out_dir, "_RAW_" + osp.basename(vis_pth[:-4])+"_NIR.tif"), gps=gps_vis, exif=exif_dict_minimal)
-            pr.Image(align_full_global).save(osp.join(out_dir, "_RAW_" + osp.basename(vis_pth[:-4])+"_NIR_global.tif"), gps=gps_vis, exif=exif_dict_minimal)
-            pr.Image(ref_full).save(osp.join(out_dir, "_RAW_"+ osp.basename(vis_pth[:-4])+"_VIS.tif"), gps=gps_vis, exif=exif_dict_minimal)
-            
-        motion_model_list.append(motion_model)
-        if clean_proxy:
-            pr.Image(vis_pth).clean_proxy()
-            pr.Image(nir_pth).clean_proxy()
-    return motion_model_list
+    pair_kwargs = dict(
+        cals=cals, extension=extension,
+        debug_folder=debug_folder, out_dir=out_dir, manual=manual, debug=debug,
+        crop=crop, option_alti=option_alti,
+        clean_proxy=clean_proxy, proxy_budget=proxy_budget,
+        multispectral_folder=multispectral_folder,
+        traces=traces,
+        angles=angles
+    )
+    if warm_start and manual:
+        warm_start = False
+    if warm_start and workers is not None and workers > 1 and len(sync_pairs) > 1:
+        logging.warning("Warm start requires sequential processing, ignored with {} workers".format(workers))
+        warm_start = False
+    if workers is None or workers <= 1 or manual or len(sync_pairs) <= 1:
+        if queue_depth is not None and queue_depth > 0 and len(sync_pairs) > 1:
+            return process_raw_pairs_pipeline(
+                sync_pairs, listPts=listPts, queue_depth=queue_depth, warm_start=warm_start, **pair_kwargs
+            )
+        records = [None] * len(sync_pairs)
+        seed = None
+        for index_pair in schedule_pairs(sync_pairs):
+            record = process_raw_pair_record(
+                index_pair, sync_pairs,
+                shoot_point=None if listPts is None else listPts[index_pair],
+                warm_start=seed,
+                **pair_kwargs
+            )
+            if warm_start:
+                seed = warm_start_seed(record["motion_model"]) or seed
+            records[index_pair] = record
+        report_failed_pairs(records)
+        motion_model_list = [record["motion_model"] for record in records]
+        if warm_start:
+            report_warm_start(motion_model_list)
+        get_cache().report()
+        return motion_model_list
+    logging.warning(f"Processing {len(sync_pairs)} pairs with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                process_raw_pair_records,
+                indexes, sync_pairs,
+                shoot_points=None if listPts is None else [listPts[index_pair] for index_pair in indexes],
+                **pair_kwargs
+            ): indexes
+            for indexes in group_pairs(sync_pairs)  # pairs sharing the same NIR image
+        }
+        records = gather_records(futures, sync_pairs)
+    report_failed_pairs(records)
+    return [record["motion_model"] for record in records]
 
 
 if __name__ == "__main__":
@@ -487,6 +1107,8 @@ if __name__ == "__main__":
     parser.add_argument('--delay', help='synchronization (in seconds)', default=0.)
     parser.add_argument('--multispectral-folder', help='multispectral TIF folder for ODM', default=None)
     parser.add_argument("--angles", nargs='+', type=float, help="yaw,pitch,roll")
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel processes (one pair per process)')
+    parser.add_argument('--queue-depth', type=int, default=None, help='pipeline decoding / alignment / writing with bounded queues of this size')
     args = parser.parse_args()
     extension = 1.6
     if args.images is None:
@@ -515,6 +1137,8 @@ if __name__ == "__main__":
         extension=extension,
         crop=CROP,
         multispectral_folder=args.multispectral_folder,
-        angles=args.angles
+        angles=args.angles,
+        workers=args.workers,
+        queue_depth=args.queue_depth
     )
 
@@ -24,6 +24,17 @@ IRD_LENS_INFO = '%s mm f/%s' % (str(round(IRD_FOCAL_LENGTH_35MM, 0)), str(round(
 OVERLAP_X = 0.30    #
 OVERLAP_Y = 0.75    # Image Overlay for mapping   [0.50 ; 0.90]
 CNIRCVIS_0 = 0.046  # Distance between the lenses of two cameras (DJI Mavic Air 2 and SJCam M20) = 46 mm.
+PROXY_CACHE_BUDGET = 0  # Disk budget (bytes) of RAW proxies kept per source folder (visible, NIR) when cleaning proxies. 0: delete right away, None: keep all
+PROXY_FORMAT = "tif"  # RAW proxies format. "tif": 16bit RawTherapee tif. "uint16" or "float16": memory mapped .npy (fast re-opening)
+WORKING_DTYPE = "float32"  # Linear data precision from RAW decoding to the outputs (warps, VIR, NDVI, multispectral). "float32" or "float64"
+UNDISTORT_MAPS_ON_DISK = True  # Persist visible camera undistortion maps as .npy next to its calibration.json. False: in memory only
+WARM_START_SEARCH_SIZE = 6  # Warm start: coarse search window (pixels at 1/32) around the previous pair alignment
+WARM_START_COST_RATIO = 2.  # Warm start: fall back to the full search when the predicted coarse cost exceeds the previous one by this ratio
+WARM_START_EARLY_STOP = 0.5  # Warm start: stop iterating at a pyramid scale when the model update moves the corners by less (pixels)
+NIR_FRAME_CACHE_SIZE = 2  # Decoded NIR frames kept in memory (a NIR image is often paired with 2 visible images). 0: disabled
+COARSE_THUMBNAIL_DOWNSCALE = 8  # Coarse alignment: NIR warp & multispectral representation on thumbnails downscaled by this factor
+OFFSET_ANGLES_DOWNSCALE = 8  # Offset angles pre-computation: coarse search only, on thumbnails downscaled by this factor
+EXIFTOOL_STAY_OPEN = True  # Keep a single exiftool process alive for all metadata reads & writes. False: one exiftool call per file
 
 
 # User Settings --------------------------------------------------------------------------------------
@@ -266,7 +266,11 @@ class ImagePipe:
         self.maxColorBar = maxColorBar
 
     def engine(self, imglst, geometricscale=None):
-        if not self.signalIn and self.floatpipe: result = [1. * deepcopy(imglst[0])] + list(map(lambda x: x.astype(np.float), imglst.copy()))
+        if not self.signalIn and self.floatpipe:
+            # process blocks may work in place (ColorMix): never alias the caller's images nor output 0 and input 1
+            # floating point images keep their precision (no float64 promotion of float32 linear data)
+            floatlst = [x.copy() if np.issubdtype(x.dtype, np.floating) else x.astype(np.float32) for x in imglst]
+            result = [floatlst[0].copy()] + floatlst
         else: result = [deepcopy(imglst[0])] + deepcopy(imglst)
         for prc in self.sliders:
             if prc is None:
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent exiftool session using the -stay_open protocol.
+Starting exiftool (Perl) costs much more than reading or writing a few tags,
+so a single process is kept alive and receives one command per file through its stdin.
+Falls back to one exiftool process per call if the session cannot be started.
+stdout and stderr are read separately: each command ends with -echo4 so that its warnings are delimited on stderr too
+and never mixed with the output of the next command.
+"""
+import atexit
+import logging
+import os
+import subprocess
+import threading
+
+READY = "{ready}"
+READY_STDERR = "{ready_stderr}"
+
+
+class ExifToolSession:
+    """
+    Client of a long lived `exiftool -stay_open True -@ -` process.
+    Each call to execute sends all its arguments as a single command (so several tag operations on a file
+    are batched in one command) and returns the text output of exiftool.
+    Thread safe. A session is tied to the process which started it (a forked worker restarts its own session).
+    """
+    def __init__(self, executable="exiftool", config=None):
+        self.executable = executable
+        self.config = config
+        self.process = None
+        self.pid = None
+        self.persistent = True  # switched to False when exiftool cannot be kept alive: fallback to one process per call
+        self.lock = threading.Lock()
+
+    def base_command(self):
+        cmd = [self.executable]
+        if self.config is not None:
+            cmd += ["-config", self.config]  # -config must be the first argument
+        return cmd
+
+    def start(self):
+        if self.running:
+            return
+        cmd = self.base_command() + ["-stay_open", "True", "-@", "-", "-common_args", "-charset", "filename=utf8"]
+        try:
+            self.process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, encoding="utf-8", bufsize=1
+            )
+            self.pid = os.getpid()
+        except OSError as exc:
+            logging.warning(f"cannot start exiftool session {exc}, exiftool will be called once per file")
+            self.process = None
+            self.persistent = False
+
+    @property
+    def running(self):
+        return self.process is not None and self.pid == os.getpid() and self.process.poll() is None
+
+    @staticmethod
+    def read_until(stream, marker):
+        lines = []
+        while True:
+            line = stream.readline()
+            if line == "":
+                raise BrokenPipeError("exiftool session ended unexpectedly")
+            if line.rstrip() == marker:
+                return "".join(lines)
+            lines.append(line)
+
+    @staticmethod
+    def log_errors(args, errors):
+        if errors.strip():
+            logging.info(f"exiftool {' '.join(args)}: {errors.strip()}")
+
+    def execute(self, *args):
+        """
+        :param args: exiftool arguments of a single command (options, tags and files)
+        :return: exiftool standard output of this command (warnings and errors are logged)
+        """
+        args = [str(arg) for arg in args]
+        with self.lock:
+            if self.persistent:
+                self.start()
+            if self.running:
+                try:
+                    self.process.stdin.write("\n".join(args + ["-echo4", READY_STDERR, "-execute"]) + "\n")
+                    self.process.stdin.flush()
+                    output = self.read_until(self.process.stdout, READY)
+                    self.log_errors(args, self.read_until(self.process.stderr, READY_STDERR))
+                    return output
+                except (OSError, ValueError) as exc:
+                    logging.warning(f"exiftool session failed {exc}, exiftool will be called once per file")
+                    self.terminate()
+                    self.persistent = False
+        p = subprocess.run(self.base_command() + args, capture_output=True, text=True)
+        self.log_errors(args, p.stderr)
+        return p.stdout
+
+    def terminate(self):
+        if self.process is not None and self.pid == os.getpid():
+            try:
+                self.process.kill()
+                self.process.wait()
+            except OSError:
+                pass
+        self.process = None
+
+    def close(self):
+        with self.lock:
+            if not self.running:
+                self.process = None
+                return
+            try:
+                self.process.stdin.write("-stay_open\nFalse\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=10)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                self.terminate()
+            self.process = None
+
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(executable="exiftool", config=None):
+    """Shared session per (executable, config), closed when python exits.
+    """
+    key = (executable, config)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = ExifToolSession(executable, config=config)
+        return _sessions[key]
+
+
+@atexit.register
+def close_sessions():
+    for session in list(_sessions.values()):
+        session.close()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded in-memory LRU cache of decoded frames.
+With the DJI shooting every 2s and the SJCAM M20 every 3s, the same NIR RAW is regularly paired with two consecutive
+visible images. Decoding a NIR RAW (sjcam_raw2dng, RawTherapee, tif loading, polar shading correction) is paid once:
+decoded data (8bit) and linear data (shading corrected) are kept in memory, keyed by path, size and modification time
+(a modified image is decoded again).
+Representations derived from the unwarped frame which do not depend on the angles of a pair (coarse search thumbnail,
+input pyramid of the multispectral representation) are cached along with the frame (see FrameCache.derived),
+keyed by their parameters. The representations themselves are computed after warping these levels for each pair.
+Cached arrays are shared by all images created from the cache and shall not be modified in place.
+"""
+import logging
+import os
+import os.path as osp
+import threading
+from collections import OrderedDict
+import irdrone.process as pr
+from config import NIR_FRAME_CACHE_SIZE
+
+
+class FrameCache:
+    def __init__(self, max_frames=NIR_FRAME_CACHE_SIZE):
+        """
+        :param max_frames: maximum number of decoded frames kept in memory. 0 disables the cache
+        """
+        self.max_frames = max_frames
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()  # decoding thread & alignment thread of the pairs pipeline
+        self.hits = 0
+        self.misses = 0
+        self.derived_hits = 0
+
+    @staticmethod
+    def key(img_path):
+        stat = os.stat(img_path)
+        return osp.abspath(img_path), stat.st_size, stat.st_mtime
+
+    def get(self, img_path):
+        """
+        :return: (data, lineardata) of a decoded image, None if the image is not cached or was modified since
+        """
+        key = self.key(img_path)
+        with self.lock:
+            frame = self.frames.get(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return frame[:2]
+
+    def put(self, img_path, data, lineardata):
+        if self.max_frames <= 0:
+            return
+        key = self.key(img_path)
+        with self.lock:
+            for stale in [k for k in self.frames.keys() if k[0] == key[0] and k != key]:
+                self.frames.pop(stale)
+            self.frames[key] = (data, lineardata, dict())
+            self.frames.move_to_end(key)
+            while len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+
+    def derived(self, img_path, name, compute, data=None):
+        """Representation of a cached frame, computed once per frame.
+        Not cached when the frame itself is not cached (evicted, modified or cache disabled).
+        :param name: hashable key of the representation and of its parameters, e.g. ("thumbnail", 8)
+        :param compute: function () -> representation, called when it is not cached yet
+        :param data: decoded data the representation is computed from. When provided, the cache is only used
+        if it is the cached frame data (not another decoding of the same file)
+        """
+        key = self.key(img_path)
+
+        def cached_frame():
+            frame = self.frames.get(key, None)
+            return frame if frame is not None and (data is None or frame[0] is data) else None
+        with self.lock:
+            frame = cached_frame()
+            if frame is not None and name in frame[2]:
+                self.derived_hits += 1
+                return frame[2][name]
+        value = compute()
+        with self.lock:
+            frame = cached_frame()
+            if frame is not None:
+                frame[2][name] = value
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.hits, self.misses, self.derived_hits = 0, 0, 0
+
+    def report(self):
+        if self.hits + self.misses > 0:
+            logging.warning("Decoded frames cache: {} hits / {} decodes, {} derived representations re-used".format(
+                self.hits, self.misses, self.derived_hits))
+
+
+_cache = FrameCache()
+
+
+def get_cache():
+    """Process wide cache of decoded frames"""
+    return _cache
+
+
+def cached_image(img_path, cache=None):
+    """Decoded image, taken from the cache when the same file was recently decoded.
+    :param cache: FrameCache, process wide cache by default
+    :return: pr.Image with data and lineardata already decoded
+    """
+    if cache is None:
+        cache = get_cache()
+    img = pr.Image(img_path)
+    frame = cache.get(img_path)
+    if frame is not None:
+        img._data, img._lineardata = frame
+        return img
+    img.data  # force decoding (linear data is decoded at the same time)
+    cache.put(img_path, img._data, img._lineardata)
+    return img
+
+
+def schedule_pairs(sync_pairs):
+    """Processing order of the pairs so that pairs sharing the same NIR image are processed one after the other
+    (NIR images are decoded once with a small cache). Pairs keep their original order otherwise.
+    :return: list of pair indexes
+    """
+    first_use = dict()
+    for index_pair, (_vis_pth, nir_pth) in enumerate(sync_pairs):
+        first_use.setdefault(osp.abspath(str(nir_pth)), index_pair)
+    return sorted(range(len(sync_pairs)), key=lambda index_pair: first_use[osp.abspath(str(sync_pairs[index_pair][1]))])
+
+
+def group_pairs(sync_pairs):
+    """Pairs sharing the same NIR image, in processing order (see schedule_pairs).
+    A group is a single process pool task: a NIR RAW is never converted, decoded or cleaned by two workers at once.
+    :return: list of lists of pair indexes
+    """
+    groups = dict()
+    for index_pair in schedule_pairs(sync_pairs):
+        groups.setdefault(osp.abspath(str(sync_pairs[index_pair][1])), []).append(index_pair)
+    return list(groups.values())
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Mission wide metadata index.
+Parsing the EXIF of a DNG (exifread + exiftool for gimbal angles) is slow and the same images are
+wrapped many times in pr.Image objects during a mission processing.
+Metadata (date, camera, GPS, altitude, gimbal & flight angles) are stored once per image in a SQLite database
+next to the images, keyed by path, size and modification time (a modified image is parsed again).
+Only successfully parsed metadata are indexed: a transient failure (exiftool, file access) is parsed again next time.
+Reads open the database read only, the database is only created when metadata are indexed.
+"""
+import logging
+import os
+import os.path as osp
+import pickle
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+INDEX_NAME = "_metadata_index.sqlite"
+METADATA_FIELDS = ["date", "dateFile", "gps", "latitude", "longitude", "camera", "altitude", "altitude_ref", "flight_info"]
+
+
+def index_path(img_path):
+    return osp.join(osp.dirname(osp.abspath(img_path)), INDEX_NAME)
+
+
+def connect(db_path, read_only=False):
+    if read_only:
+        return sqlite3.connect(Path(db_path).as_uri() + "?mode=ro", uri=True, timeout=30.)
+    connection = sqlite3.connect(db_path, timeout=30.)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, record BLOB)"
+    )
+    return connection
+
+
+def parsed(record):
+    """EXIF parsing succeeded (loadMetata leaves all fields unset when the file or exiftool can't be accessed)"""
+    return record is not None and any(record.get(field, None) is not None for field in ["date", "gps", "camera"])
+
+
+def signature(img_path):
+    stat = os.stat(img_path)
+    return stat.st_size, stat.st_mtime
+
+
+def get(img_path):
+    """
+    :return: metadata dictionary of an image, None if the image is not indexed or was modified since
+    """
+    db_path = index_path(img_path)
+    if not osp.isfile(db_path):
+        return None
+    try:
+        connection = connect(db_path, read_only=True)
+        try:
+            row = connection.execute(
+                "SELECT size, mtime, record FROM metadata WHERE path=?", (osp.abspath(img_path),)
+            ).fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error as exc:
+        logging.warning(f"metadata index unavailable {db_path}: {exc}")
+        return None
+    if row is None or (row[0], row[1]) != signature(img_path):
+        return None
+    return pickle.loads(row[2])
+
+
+def put(records):
+    """
+    :param records: list of (image path, metadata dictionary), records which were not parsed are skipped
+    """
+    per_index = dict()
+    for img_path, record in records:
+        if not parsed(record):
+            continue
+        per_index.setdefault(index_path(img_path), []).append(
+            (osp.abspath(img_path), *signature(img_path), pickle.dumps(record))
+        )
+    for db_path, rows in per_index.items():
+        try:
+            connection = connect(db_path)
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)", rows)
+            connection.close()
+        except sqlite3.Error as exc:
+            logging.warning(f"cannot write metadata index {db_path}: {exc}")
+
+
+def parse(img_path):
+    """Full EXIF parsing of an image (slow)
+    """
+    import irdrone.process as pr
+    img = pr.Image(img_path)
+    img.loadMetata()
+    return img_path, {field: img.__dict__[field] for field in METADATA_FIELDS if field in img.__dict__}
+
+
+def fill(img_paths, workers=None):
+    """Index all images which are not indexed yet (or were modified), parsing them in parallel processes.
+    """
+    missing = [str(pth) for pth in img_paths if get(str(pth)) is None]
+    if len(missing) == 0:
+        return
+    logging.warning(f"Indexing metadata of {len(missing)} images")
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1 or len(missing) == 1:
+        records = [parse(pth) for pth in missing]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            records = list(executor.map(parse, missing, chunksize=max(1, len(missing) // (4 * workers))))
+    put(records)
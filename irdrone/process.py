@@ -24,6 +24,12 @@ import config as cf
 import subprocess
 from pathlib import Path
 import json
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from irdrone.exiftool import ExifToolSession, get_session
+from irdrone.proxy_cache import get_cache
+import irdrone.metadata_index as metadata_index
 
 
 if os.name == 'nt':
@@ -38,6 +44,7 @@ else:
 
 shading_correction_DJI = None
 shading_correction_M20 = None
+SJCAM_BLACK_POINT = 0.255  # subtracted to the SJCAM M20 RawTherapee linear data
 SJCAM_M20_PROFILE_CONTROL_POINTS = {
     "R" :[(-2013.186139572626, 1.0285597058816314), (196.1657528923779, 1.0138095996814964), (672.4623430384404, 0.9758875264857452), (1240.4111479507396, 1.0150339670490343), (1686.281583682889, 1.068122341155305), (2056.884896435969, 1.204810909017386), (2396.436069270902, 1.2303145442390813), (3045.416916737508, 0.7854837645467905), (3357.444414697938, 0.3475093200941026)],
     "G": [(-1818.1593058299723, 0.9593926491976511), (184.6507089333645, 1.016621860616801), (672.4623430384404, 0.9758875264857452), (1240.4111479507396, 1.0150339670490343), (1672.6256359791887, 1.0733830394880173), (2022.0053655849624, 1.2150426799356917), (2363.4446467906046, 1.245596720032249), (2994.7102946010355, 0.7414550584390546), (3256.7450918053655, 0.32619787712675397)],
@@ -45,29 +52,301 @@ SJCAM_M20_PROFILE_CONTROL_POINTS = {
 }
 
 
+def working_dtype():
+    """Floating point precision of the linear data (config.WORKING_DTYPE): float32 halves the memory footprint of
+    the full resolution buffers of a pair. float16 is a storage only format (PROXY_FORMAT), cv2.remap can't warp it.
+    """
+    dtype = getattr(cf, "WORKING_DTYPE", "float32")
+    if dtype not in ["float32", "float64"]:
+        raise NameError(f"Unsupported working dtype {dtype}")
+    return np.dtype(dtype)
+
+
+def shading_map(path, img_shape):
+    """Lens shading correction map (loaded once) of the camera which shot a RAW image: DJI DNG or SJCAM M20 RAW
+    """
+    global shading_correction_DJI, shading_correction_M20
+    if str.lower(osp.basename(path)).endswith("dng"):
+        if shading_correction_DJI is None:
+            shading_correction_DJI = np.load(
+                osp.abspath(osp.join(osp.dirname(__file__), "..", "calibration", "DJI_RAW",
+                                     "shading_calibration.npy"))
+            )
+            shading_correction_DJI = cv2.resize(
+                shading_correction_DJI, (img_shape[1], img_shape[0])).astype(working_dtype(), copy=False)
+        return shading_correction_DJI
+    if shading_correction_M20 is None:
+        shading_correction_M20 = get_polar_shading_map(
+            img_shape=img_shape,
+            calib=SJCAM_M20_PROFILE_CONTROL_POINTS
+        ).astype(working_dtype(), copy=False)
+    return shading_correction_M20
+
+
+def thumbnail_shading_map(path, img_shape, downscale):
+    """Lens shading correction map of a thumbnail (image downscaled by downscale).
+    Unlike shading_map, nothing is cached: the full resolution maps of shading_map are left untouched.
+    """
+    if str.lower(osp.basename(path)).endswith("dng"):
+        shading_calibration = np.load(
+            osp.abspath(osp.join(osp.dirname(__file__), "..", "calibration", "DJI_RAW", "shading_calibration.npy"))
+        )
+        return cv2.resize(shading_calibration, (img_shape[1], img_shape[0])).astype(working_dtype(), copy=False)
+    return get_polar_shading_map(
+        img_shape=img_shape, calib=SJCAM_M20_PROFILE_CONTROL_POINTS, pixel_size=downscale
+    ).astype(working_dtype(), copy=False)
+
+
 def load_tif(in_file):
     flags = cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR
     flags |= cv2.IMREAD_IGNORE_ORIENTATION
-    return cv2.cvtColor(cv2.imread(in_file, flags=flags), cv2.COLOR_BGR2RGB)/(2.**16-1)
+    linear_data = cv2.cvtColor(cv2.imread(in_file, flags=flags), cv2.COLOR_BGR2RGB).astype(working_dtype())
+    linear_data *= 1./(2.**16-1)
+    return linear_data
 
 def cached_tif(path):
     return path[:-4]+"_RawTherapee.tif"
 
-def load_dng(path, template="DJI_neutral.pp3"):
-    out_file = cached_tif(path)
-    # assert osp.isfile(RAWTHERAPEEPATH), "RAWTHERAPEE NOT FOUND"
-    cmd = [
+def cached_npy(path):
+    return path[:-4]+"_RawTherapee.npy"
+
+def proxy_header(npy_path):
+    return npy_path[:-4]+".json"
+
+def cached_proxy_exists(path):
+    return osp.isfile(cached_tif(path)) or osp.isfile(cached_npy(path))
+
+
+class ProxyArray:
+    """
+    Read only RGB proxy memory mapped from a .npy file (uint16 or float16) - opening it costs nothing.
+    The json header stores shape, scale and black point.
+    Conversion to linear values (working dtype) is only applied to the accessed regions:
+    proxy[::32, ::32] reads a thumbnail, np.asarray(proxy) converts the whole image.
+    """
+    def __init__(self, path):
+        with open(proxy_header(path), "r") as fi:
+            header = json.load(fi)
+        self.path = path
+        self.raw = np.load(path, mmap_mode="r")
+        assert list(self.raw.shape) == header["shape"], f"corrupted proxy {path}"
+        self.scale = header["scale"]
+        self.black_point = header["black_point"]
+        self.shape = self.raw.shape
+        self.ndim = self.raw.ndim
+        self.dtype = working_dtype()
+
+    def __getitem__(self, key):
+        region = self.raw[key].astype(self.dtype)
+        region *= self.scale
+        region -= self.black_point
+        return region
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+
+def save_npy_proxy(path, linear_data, proxy_format="uint16", black_point=0.):
+    """
+    :param linear_data: RGB linear data in [0, 1] (without black point subtraction)
+    :param proxy_format: uint16 (exact 16bit RawTherapee output) or float16
+    """
+    if proxy_format == "uint16":
+        raw, scale = (linear_data.clip(0., 1.) * (2**16-1)).round().astype(np.uint16), 1./(2**16-1)
+    elif proxy_format == "float16":
+        raw, scale = linear_data.astype(np.float16), 1.
+    else:
+        raise NameError(f"Unknown proxy format {proxy_format}")
+    np.save(path, raw)
+    with open(proxy_header(path), "w") as fi:
+        json.dump(dict(shape=list(raw.shape), dtype=proxy_format, scale=scale, black_point=black_point), fi)
+
+
+def rawtherapee_command(out, template, in_files, partial_profiles=[]):
+    """rawtherapee-cli command converting one or several files (out is a folder when several files are provided)
+    :param partial_profiles: .pp3 files applied on top of the template (in this order)
+    """
+    profiles = [osp.join(osp.dirname(__file__), "..", "thirdparty", "rawtherapee", template)] + list(partial_profiles)
+    return [
         RAWTHERAPEEPATH,
-        "-t", "-o", out_file,
-        "-p", osp.join(osp.dirname(__file__), "..", "thirdparty", "rawtherapee", template),
-        "-c", path
+        "-t", "-o", out,
+        *[arg for profile in profiles for arg in ["-p", profile]],
+        "-c", *in_files
     ]
+
+
+THUMBNAIL_PROFILE = """[Version]
+AppVersion=5.8
+Version=346
+
+[Resize]
+Enabled=true
+Scale={scale}
+AppliesTo=Full image
+Method=Lanczos
+DataSpecified=0
+AllowUpscaling=false
+
+[RAW Bayer]
+Method=fast
+"""
+
+
+def load_dng_thumbnail(path, downscale, template="DJI_neutral.pp3", black_point=0.):
+    """Reduced resolution RawTherapee decoding: fast demosaicing, then resized by 1/downscale by RawTherapee
+    (partial profile on top of the template). No full resolution tif is written or loaded and no proxy is kept.
+    :param black_point: subtracted to the linear data
+    :return: linear data
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        resize_profile = osp.join(tmp_dir, "thumbnail.pp3")
+        with open(resize_profile, "w") as fi:
+            fi.write(THUMBNAIL_PROFILE.format(scale=1./downscale))
+        out_file = osp.join(tmp_dir, osp.basename(path)[:-4] + ".tif")
+        subprocess.call(rawtherapee_command(out_file, template, [path], partial_profiles=[resize_profile]))
+        assert osp.isfile(out_file), f"DNG file not converted! {out_file}"
+        linear_data = load_tif(out_file)
+    if black_point != 0.:
+        linear_data -= black_point
+    return linear_data
+
+def load_dng(path, template="DJI_neutral.pp3", black_point=0., lazy=False):
+    """
+    :param black_point: subtracted to the linear data
+    :param lazy: with the npy proxy format (config.PROXY_FORMAT), return a memory mapped ProxyArray
+    :return: linear data, proxy path
+    """
+    out_file = cached_tif(path)
+    npy_file = cached_npy(path)
+    proxy_format = getattr(cf, "PROXY_FORMAT", "tif")
+    if proxy_format != "tif" and osp.isfile(npy_file):
+        logging.info("DNG already processed by RAW THERAPEE {}".format(path))
+        proxy = ProxyArray(npy_file)
+        return (proxy if lazy else proxy[...]), npy_file
+    # assert osp.isfile(RAWTHERAPEEPATH), "RAWTHERAPEE NOT FOUND"
+    cmd = rawtherapee_command(out_file, template, [path])
     if not osp.isfile(out_file):
         subprocess.call(cmd)
     else:
         logging.info("DNG already processed by RAW THERAPEE {}".format(path))
     assert osp.isfile(out_file), f"DNG file not converted! {out_file}"
-    return load_tif(out_file), out_file
+    linear_data = load_tif(out_file)
+    if proxy_format != "tif":
+        save_npy_proxy(npy_file, linear_data, proxy_format=proxy_format, black_point=black_point)
+        os.remove(out_file)
+        proxy = ProxyArray(npy_file)
+        return (proxy if lazy else proxy[...]), npy_file
+    if black_point != 0.:
+        linear_data -= black_point
+    return linear_data, out_file
+
+
+def sjcam_converter_path():
+    if os.name == "nt":
+        sjcam_converter = osp.join(osp.dirname(osp.abspath(__file__)), "..", "thirdparty", "sjcam_raw2dng", "sjcam_raw2dng.exe")
+        sjconverter_link = "https://github.com/yanburman/sjcam_raw2dng/releases/tag/v1.2.0"
+        assert osp.isfile(sjcam_converter), "{} does not exist - please download from {}".format(
+            sjcam_converter,
+            sjconverter_link
+        )
+    else:
+        sjcam_converter = osp.join(osp.dirname(osp.abspath(__file__)), "..", "thirdparty", "sjcam_raw2dng_linux", "sjcam_raw2dng")
+    return sjcam_converter
+
+
+def sjcam_dng_path(path):
+    return osp.join(osp.dirname(path), "_conversion_sjcam", osp.basename(path).replace(".RAW", ".dng"))
+
+
+def convert_batch_rawtherapee(in_files, template):
+    """Single rawtherapee-cli call for several DNG of the same folder.
+    RawTherapee names batch outputs after the input file, they are renamed to the cached_tif proxy names.
+    """
+    batch_dir = osp.join(osp.dirname(in_files[0]), "_rawtherapee_batch_{}".format(osp.basename(in_files[0])[:-4]))
+    if not osp.isdir(batch_dir):
+        mkdir(batch_dir)
+    subprocess.call(rawtherapee_command(batch_dir, template, in_files))
+    for in_file in in_files:
+        batch_out = osp.join(batch_dir, osp.basename(in_file)[:-4] + ".tif")
+        if osp.isfile(batch_out):
+            shutil.move(batch_out, cached_tif(in_file))
+        else:
+            logging.warning(f"{in_file} not converted by RawTherapee batch")
+    shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+def batch_convert_raw(image_paths, workers=2, batch_size=32):
+    """Pre-convert DJI DNG and SJCAM M20 RAW images into their cached RawTherapee tif proxies.
+    Pending files are grouped per folder & profile and converted by batched rawtherapee-cli calls
+    (program start-up and .pp3 parsing are paid once per batch) split across `workers` parallel calls.
+    Afterwards Image.get_data only finds the cached _RawTherapee.tif proxies.
+    Files which could not be converted are simply left to the per image conversion of load_dng.
+
+    :param image_paths: list of .DNG / .RAW paths (other files are ignored)
+    :param workers: number of parallel rawtherapee-cli (and sjcam_raw2dng) invocations
+    :param batch_size: maximum number of files per invocation
+    """
+    image_paths = list(dict.fromkeys(str(pth) for pth in image_paths))
+    for pth in image_paths:
+        if pth.lower().endswith("raw") or pth.lower().endswith("dng"):
+            get_cache(pth).validate(pth, [])  # remove stale proxies so that they get converted again
+    # SJCAM RAW -> DNG
+    pending_raw = dict()
+    for pth in image_paths:
+        if pth.lower().endswith("raw") and not osp.isfile(sjcam_dng_path(pth)):
+            pending_raw.setdefault(osp.dirname(sjcam_dng_path(pth)), []).append(osp.abspath(pth))
+    # DNG -> TIF
+    jobs = []
+    for conv_dir, raw_list in pending_raw.items():
+        if not osp.isdir(conv_dir):
+            mkdir(conv_dir)
+        for start in range(0, len(raw_list), batch_size):
+            # sjcam_raw2dng CLI: "[options] file1|dir1 file2|dir2 ...", -o output folder (must exist)
+            jobs.append([sjcam_converter_path(), "-o", conv_dir, *raw_list[start:start+batch_size]])
+    ts_start = time.perf_counter()
+    if len(jobs) > 0:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(subprocess.call, jobs))
+    pending_dng = dict()
+    for pth in image_paths:
+        if pth.lower().endswith("raw"):
+            dng_file, template = sjcam_dng_path(pth), "SJCAM.pp3"
+            if not osp.isfile(dng_file):
+                logging.warning(f"{pth} not converted by sjcam_raw2dng batch")
+                continue
+        elif pth.lower().endswith("dng"):
+            dng_file, template = pth, "DJI_neutral.pp3"
+        else:
+            continue
+        if not cached_proxy_exists(dng_file):
+            pending_dng.setdefault((osp.dirname(dng_file), template), []).append(dng_file)
+    batches = []
+    for (_folder, template), dng_list in pending_dng.items():
+        # split evenly so that all workers get some work
+        size = min(batch_size, max(1, int(np.ceil(len(dng_list) / workers))))
+        for start in range(0, len(dng_list), size):
+            batches.append((dng_list[start:start+size], template))
+    if len(batches) > 0:
+        logging.warning(f"Converting {sum(len(batch) for batch, _ in batches)} DNG with {len(batches)} RawTherapee batches")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda batch: convert_batch_rawtherapee(*batch), batches))
+    logging.warning("{:.2f}s elapsed in batch RAW conversion".format(time.perf_counter() - ts_start))
+
+
+XMP_CONFIG = osp.join(osp.dirname(__file__), "..", "thirdparty", "exiftool", "xmp.config")
+
+
+def exiftool(*args):
+    """Run a single exiftool command (options, tags, files) and return its text output.
+    Uses the shared stay_open session unless disabled by config.EXIFTOOL_STAY_OPEN
+    """
+    if getattr(cf, "EXIFTOOL_STAY_OPEN", True):
+        session = get_session(EXIFTOOLPATH, config=XMP_CONFIG)
+    else:
+        session = ExifToolSession(EXIFTOOLPATH, config=XMP_CONFIG)
+        session.persistent = False
+    return session.execute(*args)
 
 
 def get_gimbal_info(pth: Path):
@@ -76,9 +355,7 @@ def get_gimbal_info(pth: Path):
         with open(exif_file, "r") as fi:
             dic = json.load(fi)
     else:
-        cmd = [EXIFTOOLPATH, pth]
-        p = subprocess.run(cmd,  capture_output=True, text=True)
-        output_text = p.stdout
+        output_text = exiftool(pth)
         lines = output_text.split("\n")
         selection = [li for li in lines if "Degree" in li]
         dic = dict()
@@ -120,13 +397,16 @@ def infoCameraIRdrone():
 
 
 
-def copy_metadata(pth_src, pth_dst):
+def copy_metadata(pth_src, pth_dst, extra_tags=[]):
+    """
+    :param extra_tags: additional exiftool tag assignments (like xmp_band_tags) written in the same exiftool command
+    """
     cameraMaker, cameraModel, focalLength, focalLengthIN35mmFormat, lensInfo = infoCameraIRdrone()
     #
     #  Copying Exif data from a pth_src image  (HYPRLAPSE_XXXX.DNG) in pth_dst (img_XXXX_Y.tif or .jpg)
     #  + modification or addition of Tags in the pth_dst image and write (cmd  "-overwrite_original", "-fast")
 
-    cmd = [EXIFTOOLPATH, "-TagsFromFile", pth_src,
+    cmd = ["-TagsFromFile", pth_src,
            f"-Make={cameraMaker}",
            f'-Model={cameraModel}',
            f'-UniqueCameraModel={cf.IRD_CAMERA_DESCRIPTION}',
@@ -138,17 +418,17 @@ def copy_metadata(pth_src, pth_dst):
            f'-LensModel={cf.NIR_FILTER_MODEL}',
            f'-Copyright={cf.COPYRIGHT}',
            f'-Artist={cf.ARTIST}',
+           *extra_tags,
            pth_dst, "-overwrite_original",  "-fast"]
 
-    p = subprocess.run(cmd)
+    exiftool(*cmd)
 
     return
 
 
-
-def xmp_band_metadata(pth_src, band_index=1):
+def xmp_band_tags(band_index=1):
     """
-    RGB-NIR
+    RGB-NIR XMP camera tags (requires xmp.config)
     """
     assert band_index in [1, 2, 3, 4]
     band_name, band_central_wavelength, band_sensitivity =[
@@ -157,19 +437,21 @@ def xmp_band_metadata(pth_src, band_index=1):
         ("Blue", 475, 0.2613),
         ("NIR", 840, 0.169)
     ][band_index-1]
-    xmp_conf = osp.join(osp.dirname(__file__), "..", "thirdparty", "exiftool", "xmp.config")
-    assert osp.exists(xmp_conf)
-    cmd = [
-        EXIFTOOLPATH,  "-config",  xmp_conf,
+    return [
         f"-XMP-camera:BandName={band_name}",
         "-XMP-camera:RigCameraIndex=0",
         f"-XMP-camera:CentralWavelength={band_central_wavelength}",
         f"-XMP-camera:BandSensitivity={band_sensitivity}",
         "-m",
-        "-overwrite_original",
-        pth_src
     ]
-    p = subprocess.run(cmd)
+
+
+def xmp_band_metadata(pth_src, band_index=1):
+    """
+    RGB-NIR
+    """
+    assert osp.exists(XMP_CONFIG)
+    exiftool(*xmp_band_tags(band_index), "-overwrite_original", pth_src)
 
 class Image:
     """
@@ -193,22 +475,48 @@ class Image:
             # This piece of code is a dirty, the proxies are RGB temporary conversions of raw files
             # The list self.proxy is used to later clear (methode clean_proxy)
             dng_file = osp.join(self.conv_dir, osp.basename(self.path).replace(".RAW", ".dng"))
-            proxypth = cached_tif(self.path)
-            proxypth_from_dng = cached_tif(dng_file)
-            self.proxy = [dng_file, proxypth, proxypth_from_dng]
+            self.proxy = [dng_file] + [
+                proxy_pth
+                for src in [self.path, dng_file]
+                for proxy_pth in [cached_tif(src), cached_npy(src), proxy_header(cached_npy(src))]
+            ]
         else:
             self.path = None
             self._data = dat
             self._lineardata = None
             self.name = name
         if name is not None: self.name = name
-        self.date = None
-        self.gps = None
-        self.camera = None
-        self.altitude = None
-        self.altitude_ref = None
-        self.flight_info = None
-        self.loadMetata()
+        if self.path is None:
+            self.set_default_metadata()
+        # metadata of images on disk are loaded lazily from the mission metadata index (see __getattr__)
+
+    def set_default_metadata(self):
+        for field in ["date", "gps", "camera", "altitude", "altitude_ref", "flight_info"]:
+            if field not in self.__dict__:
+                setattr(self, field, None)
+
+    def __getattr__(self, name):
+        if name in metadata_index.METADATA_FIELDS and self.__dict__.get("path", None) is not None \
+                and not self.__dict__.get("_metadata_loaded", False):
+            self.load_indexed_metadata()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def load_indexed_metadata(self):
+        """Metadata from the mission index, EXIF is parsed (then indexed) only for unknown or modified images.
+        Metadata fields assigned before loading are kept.
+        """
+        self._metadata_loaded = True
+        assigned = {field: self.__dict__.pop(field) for field in metadata_index.METADATA_FIELDS if field in self.__dict__}
+        record = metadata_index.get(self.path)
+        if record is None:
+            self.loadMetata()
+            record = {field: self.__dict__[field] for field in metadata_index.METADATA_FIELDS if field in self.__dict__}
+            metadata_index.put([(self.path, record)])  # not indexed if the EXIF parsing failed
+        for field, value in record.items():
+            setattr(self, field, value)
+        self.__dict__.update(assigned)
+        self.set_default_metadata()
 
     def save(self, path, gps=None, exif=None):
         if gps is not None:
@@ -259,9 +567,10 @@ class Image:
         for ch in range(self._data.shape[2]):
             file_name =  str(path.stem) + f"_{ch+1}"
             pth_channel = (path.parent/ file_name).with_suffix(".tif")
-            cv2.imwrite(str(pth_channel), ((2**16-1)*(self._data[:, :, ch].clip(0, 1))).astype(np.uint16))
-            copy_metadata(self.path, pth_channel)
-            xmp_band_metadata(pth_channel, band_index=bands[ch])
+            channel = self._data[:, :, ch].clip(0, 1)  # single working dtype copy of the band
+            channel *= (2**16-1)
+            cv2.imwrite(str(pth_channel), channel.astype(np.uint16))
+            copy_metadata(self.path, pth_channel, extra_tags=xmp_band_tags(band_index=bands[ch]))  # single exiftool command per band
 
     def loadMetata(self):
         if self.path is not None:
@@ -374,6 +683,18 @@ class Image:
                 logging.info(Style.YELLOW + "NO GPS DATA FOUND IN %s"%self.path + Style.RESET)
                 self.gps = None
 
+    def get_rawproxy(self):
+        """Memory mapped linear data (before shading correction) when a npy proxy already exists, None otherwise.
+        Opening costs nothing and only accessed regions are converted to linear data (like thumbnails rawproxy[::32, ::32])
+        """
+        if self.path is None:
+            return None
+        for src in [self.path, osp.join(self.conv_dir, osp.basename(self.path).replace(".RAW", ".dng"))]:
+            if osp.isfile(cached_npy(src)) and osp.isfile(proxy_header(cached_npy(src))):
+                return ProxyArray(cached_npy(src))
+        return None
+    rawproxy = property(get_rawproxy)
+
     def get_lineardata(self):
         self.get_data()
         return self._lineardata
@@ -385,57 +706,30 @@ class Image:
             assert osp.exists(self.path), "%s not an image"%self.path
 # ---------------------------------------------------------------------------------------------------- DJI Mavic Air RAW
             if str.lower(osp.basename(self.path)).endswith("dng"):
+                self.cache_proxy("validate")
                 rawimg, proxypth = load_dng(self.path, template="DJI_neutral.pp3") # COLOR MATRIX IS APPLIED, LINEAR
-                self.proxy = [proxypth]
+                self.proxy = [proxypth] + ([proxy_header(proxypth)] if proxypth.endswith(".npy") else [])
+                self.cache_proxy("acquire")
                 # lens shading correction for DJI
                 if self.shading_correction:
-                    global shading_correction_DJI
-                    if shading_correction_DJI is None:
-                        shading_correction_DJI = np.load(
-                            osp.abspath(osp.join(osp.dirname(__file__), "..", "calibration", "DJI_RAW",
-                                                 "shading_calibration.npy"))
-                        )
-                        shading_correction_DJI = cv2.resize(shading_correction_DJI, (rawimg.shape[1], rawimg.shape[0]))
-                    rawimg = (shading_correction_DJI*rawimg).clip(0., 1.)
+                    rawimg *= shading_map(self.path, rawimg.shape)  # in place, rawimg is a freshly decoded buffer
+                    rawimg = np.clip(rawimg, 0., 1., out=rawimg)
                 # self._data = ((rawimg**(gamma)).clip(0., 1.)*255).astype(np.uint8)
                 self._data = (contrast_stretching(rawimg.clip(0., 1.))[0]*255).astype(np.uint8)
                 self._lineardata = rawimg
 # -------------------------------------------------------------------------------------------------------- SJCAM M20 RAW
             elif str.lower(osp.basename(self.path)).endswith("raw"):
-                if os.name == "nt":
-                    sjcam_converter = osp.join(osp.dirname(osp.abspath(__file__)), "..", "thirdparty", "sjcam_raw2dng", "sjcam_raw2dng.exe")
-                    sjconverter_link = "https://github.com/yanburman/sjcam_raw2dng/releases/tag/v1.2.0"
-                    assert osp.isfile(sjcam_converter), "{} does not exist - please download from {}".format(
-                        sjcam_converter,
-                        sjconverter_link
-                    )
-                else:
-                    sjcam_converter = osp.join(osp.dirname(osp.abspath(__file__)), "..", "thirdparty", "sjcam_raw2dng_linux", "sjcam_raw2dng")
-                conv_dir = self.conv_dir
-                if not osp.isdir(conv_dir):
-                    mkdir(conv_dir)
-                dng_file = osp.join(conv_dir, osp.basename(self.path).replace(".RAW", ".dng"))
-                if not osp.isfile(dng_file):
-                    # assert osp.isfile(sjcam_converter), f"No SJCam converter {sjcam_converter}"
-                    assert osp.isfile(self.path), f"No input raw file {self.path}"
-                    subprocess.call([sjcam_converter, "-o", conv_dir, osp.abspath(self.path)])
-                assert osp.isfile(dng_file), "RAW file not converted into DNG!"
-                rawimg, proxypth = load_dng(dng_file, template="SJCAM.pp3")
-                self.proxy = [dng_file, proxypth]
-                bp_sjcam = 0.255
-                rawimg = rawimg - bp_sjcam
+                self.cache_proxy("validate")
+                dng_file = self.sjcam_dng()
+                rawimg, proxypth = load_dng(dng_file, template="SJCAM.pp3", black_point=SJCAM_BLACK_POINT)
+                self.proxy = [dng_file, proxypth] + ([proxy_header(proxypth)] if proxypth.endswith(".npy") else [])
+                self.cache_proxy("acquire")
                 if self.shading_correction:
-                    global shading_correction_M20
-                    if shading_correction_M20 is None:
-                        shading_correction_M20 = get_polar_shading_map(
-                            img_shape=rawimg.shape,
-                            calib=SJCAM_M20_PROFILE_CONTROL_POINTS
-                        )
-                        # print("LOADING SHADING CALIB")
-                    rawimg = (rawimg * shading_correction_M20)
+                    rawimg *= shading_map(self.path, rawimg.shape)
+                rawimg = np.clip(rawimg, 0., 1., out=rawimg)
                 # self._data = ((rawimg.clip(0., 1.)**(gamma)).clip(0., 1.)*255).astype(np.uint8)
-                self._data = (contrast_stretching(rawimg.clip(0., 1.))[0]*255).astype(np.uint8)
-                self._lineardata = rawimg.clip(0., 1.)
+                self._data = (contrast_stretching(rawimg)[0]*255).astype(np.uint8)
+                self._lineardata = rawimg
             elif str.lower(osp.basename(self.path)).endswith("tif") or str.lower(osp.basename(self.path)).endswith("tiff"):
                 linear_data = load_tif(self.path)
                 self._lineardata = linear_data
@@ -453,6 +747,60 @@ class Image:
         self._data = value
     data = property(get_data, set_data)
 
+    def sjcam_dng(self):
+        """DNG conversion of a SJCAM M20 RAW image (converted once in the _conversion_sjcam folder)
+        """
+        sjcam_converter = sjcam_converter_path()
+        conv_dir = self.conv_dir
+        if not osp.isdir(conv_dir):
+            mkdir(conv_dir)
+        dng_file = osp.join(conv_dir, osp.basename(self.path).replace(".RAW", ".dng"))
+        if not osp.isfile(dng_file):
+            # assert osp.isfile(sjcam_converter), f"No SJCam converter {sjcam_converter}"
+            assert osp.isfile(self.path), f"No input raw file {self.path}"
+            subprocess.call([sjcam_converter, "-o", conv_dir, osp.abspath(self.path)])
+        assert osp.isfile(dng_file), "RAW file not converted into DNG!"
+        return dng_file
+
+    def thumbnail(self, downscale):
+        """8bit thumbnail (data downscaled by an integer factor) of a RAW image, without full resolution decoding:
+        - when a npy proxy exists, only the thumbnail pixels of the memory mapped linear data are read.
+        - otherwise, unless a full resolution tif proxy already exists, RawTherapee decodes a reduced resolution image
+        (load_dng_thumbnail), nothing is kept on disk except the SJCAM DNG conversion.
+        The shading correction and contrast stretching are applied to the thumbnail.
+        Already decoded images and other formats are downscaled from the full resolution data.
+        """
+        rawproxy = self.rawproxy if self._data is None else None
+        name = str.lower(osp.basename(self.path)) if self.path is not None else ""
+        is_raw = name.endswith("dng") or name.endswith("raw")
+        if rawproxy is None and is_raw and self._data is None:
+            if name.endswith("raw"):
+                self.cache_proxy("validate")
+                dng_file = self.sjcam_dng()
+            else:
+                dng_file = self.path
+            if not cached_proxy_exists(dng_file):
+                return self.raw_thumbnail(dng_file, downscale)
+        if rawproxy is None:
+            return cv2.resize(
+                self.data, (self.data.shape[1]//downscale, self.data.shape[0]//downscale), interpolation=cv2.INTER_AREA
+            )
+        linear_data = rawproxy[::downscale, ::downscale]
+        if self.shading_correction:
+            linear_data = linear_data * shading_map(self.path, rawproxy.shape)[::downscale, ::downscale]
+        # same contrast stretching as the full resolution data (black fisheye borders excluded from the percentiles)
+        return (contrast_stretching(linear_data.clip(0., 1.), crop_black_circle=450//downscale)[0]*255).astype(np.uint8)
+
+    def raw_thumbnail(self, dng_file, downscale):
+        """Thumbnail from a reduced resolution RawTherapee decoding of the DNG (see thumbnail)"""
+        if dng_file == self.path:
+            linear_data = load_dng_thumbnail(dng_file, downscale, template="DJI_neutral.pp3")
+        else:
+            linear_data = load_dng_thumbnail(dng_file, downscale, template="SJCAM.pp3", black_point=SJCAM_BLACK_POINT)
+        if self.shading_correction:
+            linear_data *= thumbnail_shading_map(self.path, linear_data.shape, downscale)
+        return (contrast_stretching(linear_data.clip(0., 1.), crop_black_circle=450//downscale)[0]*255).astype(np.uint8)
+
     def __getitem__(self, item):
         if item == 0:
             # print("ACESS IMAGE CONTENT!")
@@ -524,13 +872,29 @@ class Image:
     def hsv(self):
         self.data = cv2.cvtColor(self.data, cv2.COLOR_RGB2HSV)
 
-    def clean_proxy(self):
-        if self.proxy is None:
+    def cache_proxy(self, action, **kwargs):
+        """Proxy cache bookkeeping (validate, acquire, release). The cache never prevents loading an image.
+        Validate and acquire only apply to missions where the proxy cache is in use (see ProxyCache.in_use).
+        """
+        if self.path is None or self.proxy is None:
             return
-        for img_pth in self.proxy:
-            if os.path.isfile(img_pth):
-                logging.info(f"CLEANING {img_pth}")
-                os.remove(img_pth)
+        try:
+            cache = get_cache(self.path)
+            if action != "release" and not cache.in_use():
+                return
+            getattr(cache, action)(self.path, self.proxy, **kwargs)
+        except OSError as exc:
+            logging.warning(f"proxy cache unavailable for {self.path}: {exc}")
+
+    def clean_proxy(self, budget=None):
+        """Release proxies to the proxy cache of the image folder.
+        :param budget: disk budget in bytes of all proxies of the images of the same folder
+        (the visible and NIR folders of a mission each get this budget). Least recently used proxies are evicted.
+        0 removes the proxies of this image right away. None uses config.PROXY_CACHE_BUDGET
+        """
+        if budget is None:
+            budget = getattr(cf, "PROXY_CACHE_BUDGET", 0)
+        self.cache_proxy("release", budget=budget)
 
 
 def loadimage(imgpth, numpyMode=True):
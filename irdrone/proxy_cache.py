@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Disk budgeted cache of RAW proxies (_conversion_sjcam/*.dng, *_RawTherapee.tif).
+An index file per source folder (visible images folder, NIR images folder) records for each source image
+its size & modification time, its proxies and the last time they were used.
+- Proxies of a modified source image are stale and removed before being re-used.
+- When proxies are released (Image.clean_proxy), the least recently used proxies of the source folder are evicted
+until the total proxies size of that folder fits in the byte budget. A 0 budget deletes proxies right away.
+The budget applies to each source folder: a mission with a visible and a NIR folder may use up to twice the budget.
+- Proxies acquired by a running process (pair being processed) are never evicted by another process.
+The index only exists once proxies have been released with a non zero budget: without it, loading an image does
+not touch the source folder (see in_use).
+"""
+import json
+import logging
+import os
+import os.path as osp
+import time
+import uuid
+from contextlib import contextmanager
+
+INDEX_NAME = "_proxy_cache.json"
+
+
+class ProxyCache:
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = osp.join(folder, INDEX_NAME)
+        self.lock_path = self.index_path + ".lock"
+
+    def in_use(self):
+        """Proxies of this source folder are managed by the cache (released at least once with a non zero budget)"""
+        return osp.isfile(self.index_path)
+
+    def lock_owner(self):
+        """:return: token written in the lock file by its owner, None if there is no lock"""
+        try:
+            with open(self.lock_path, "r") as fi:
+                return fi.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass  # exists but owned by another user
+        return True
+
+    def stale_lock(self, owner, ts_start, timeout):
+        """A lock is stale when its owner process is dead or when it is held for too long"""
+        try:
+            pid = int(owner.split()[0])
+        except (ValueError, IndexError):
+            pid = None  # lock file being written
+        return (pid is not None and not self.alive(pid)) or time.time() - ts_start > timeout
+
+    @contextmanager
+    def locked_index(self, timeout=10.):
+        """Read / modify / write the index with an exclusive lock file (several processes may process a mission).
+        The lock file contains the pid and a unique token of its owner: only the owner removes it.
+        """
+        token = f"{os.getpid()} {uuid.uuid4().hex}"
+        ts_start = time.time()
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, token.encode())
+                os.close(fd)
+                break
+            except FileExistsError:
+                owner = self.lock_owner()
+                if owner is not None and self.stale_lock(owner, ts_start, timeout):
+                    if self.lock_owner() == owner:  # nobody took it over meanwhile
+                        logging.warning(f"removing stale proxy cache lock {self.lock_path}")
+                        try:
+                            os.remove(self.lock_path)
+                        except OSError:
+                            pass
+                    ts_start = time.time()
+                time.sleep(0.01)
+        try:
+            index = self.load()
+            yield index
+            tmp_path = self.index_path + f".{os.getpid()}.tmp"
+            with open(tmp_path, "w") as fi:
+                json.dump(index, fi, indent=1)
+            os.replace(tmp_path, self.index_path)
+        finally:
+            if self.lock_owner() == token:
+                os.remove(self.lock_path)
+
+    def load(self):
+        if not osp.isfile(self.index_path):
+            return dict()
+        try:
+            with open(self.index_path, "r") as fi:
+                return json.load(fi)
+        except (ValueError, OSError):
+            logging.warning(f"corrupted proxy cache index {self.index_path}, starting a new one")
+            return dict()
+
+    @staticmethod
+    def signature(source):
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime
+
+    @staticmethod
+    def remove_proxies(proxies):
+        for img_pth in proxies:
+            if osp.isfile(img_pth):
+                logging.info(f"CLEANING {img_pth}")
+                os.remove(img_pth)
+
+    @staticmethod
+    def entry_size(entry):
+        return sum(osp.getsize(pth) for pth in entry["proxies"] if osp.isfile(pth))
+
+    def validate(self, source, proxies):
+        """Remove the proxies of a source which changed since they were generated.
+        Proxies which are not indexed yet are considered valid.
+        Lock free unless the proxies are stale (the index is replaced atomically).
+        """
+        source = osp.abspath(source)
+        if not self.in_use():
+            return
+        entry = self.load().get(source, None)
+        if entry is None or not osp.isfile(source) or (entry["size"], entry["mtime"]) == self.signature(source):
+            return
+        with self.locked_index() as index:
+            entry = index.get(source, None)
+            if entry is None or not osp.isfile(source):
+                return
+            size, mtime = self.signature(source)
+            if entry["size"] != size or entry["mtime"] != mtime:
+                logging.warning(f"stale proxies for {source}")
+                self.remove_proxies(set(entry["proxies"] + list(proxies)))
+                index.pop(source)
+
+    @staticmethod
+    def record(index, source, proxies):
+        size, mtime = ProxyCache.signature(source)
+        entry = index.get(source, dict(proxies=[]))
+        entry["proxies"] = sorted(set(entry["proxies"] + [osp.abspath(pth) for pth in proxies]))
+        entry["size"], entry["mtime"] = size, mtime
+        entry["last_access"] = time.time()
+        entry["readers"] = entry.get("readers", [])
+        index[source] = entry
+        return entry
+
+    def touch(self, source, proxies):
+        """Record the proxies of a source and mark them as most recently used
+        """
+        source = osp.abspath(source)
+        with self.locked_index() as index:
+            self.record(index, source, proxies)
+
+    def acquire(self, source, proxies):
+        """The current process reads the proxies of a source: they are not evicted by other processes until released
+        """
+        source = osp.abspath(source)
+        with self.locked_index() as index:
+            entry = self.record(index, source, proxies)
+            entry["readers"] = sorted(set(entry["readers"] + [os.getpid()]))
+
+    def in_flight(self, entry):
+        return any(self.alive(pid) for pid in entry.get("readers", []))
+
+    def release(self, source, proxies, budget):
+        """Proxies of source are not needed anymore by the caller.
+        Evict least recently used proxies until all proxies of the source folder fit in budget (in bytes).
+        """
+        source = osp.abspath(source)
+        if budget is not None and budget <= 0:
+            self.remove_proxies(proxies)
+            if self.in_use():
+                with self.locked_index() as index:
+                    index.pop(source, None)
+            return
+        with self.locked_index() as index:
+            entry = self.record(index, source, proxies)
+            entry["readers"] = [pid for pid in entry["readers"] if pid != os.getpid()]
+            if budget is None:
+                return
+            for src in [src for src in index.keys() if not osp.isfile(src)]:
+                self.remove_proxies(index.pop(src)["proxies"])  # source images removed from the mission
+            sizes = {src: self.entry_size(entry) for src, entry in index.items()}
+            total = sum(sizes.values())
+            for src in sorted(index.keys(), key=lambda src: index[src]["last_access"]):
+                if total <= budget:
+                    break
+                if self.in_flight(index[src]):
+                    continue  # being processed by a running worker
+                logging.info(f"EVICTING proxies of {src}")
+                self.remove_proxies(index.pop(src)["proxies"])
+                total -= sizes[src]
+
+
+def get_cache(source):
+    """Proxy cache of the folder containing the source image (one cache and one budget per source folder)
+    """
+    return ProxyCache(osp.dirname(osp.abspath(source)))
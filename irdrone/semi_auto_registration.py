@@ -9,7 +9,7 @@ from skimage import filters
 from skimage import exposure
 import irdrone.utils as ut
 import irdrone.process as pr
-from registration.warp_flow import warp
+from registration.warp_flow import warp, warp_from_sparse_vector_field
 import interactive.imagepipe as ipipe
 from irdrone.register import register_by_blocks, estimateFeaturePoints
 import numpy as np
@@ -17,6 +17,7 @@ import cv2
 import logging
 
 ROTATE = "Rotate"
+WARP_LOCAL, WARP_GLOBAL = "local", "global"
 
 
 # ---------------------------------------------- 3D ROTATION -----------------------------------------------------------
@@ -27,11 +28,12 @@ def get_zoom_mat(scale):
     return zoom_mat
 
 
-def manual_warp(ref: pr.Image, mov: pr.Image, yaw_main: float, pitch_main: float, roll_main: float = 0.,
-                refcalib=None, movingcalib=None, geometric_scale=None, refinement_homography=None,
-                bigger_size_factor = None,
-                vector_field=None
-    ):
+def rotation_homography(yaw_main: float, pitch_main: float, roll_main: float = 0.,
+                        refcalib=None, movingcalib=None, geometric_scale=None):
+    """3D rotation homography from the moving camera to the reference camera
+    :param geometric_scale: images downscaled by 1/geometric_scale, both camera intrinsics are zoomed
+    :return: homography, moving camera calibration (at this scale)
+    """
     rot_main, _ = cv2.Rodrigues(np.array([-np.deg2rad(pitch_main), np.deg2rad(yaw_main), np.deg2rad(roll_main)]))
     mov_calib = movingcalib.copy()
     if geometric_scale is None:
@@ -45,6 +47,31 @@ def manual_warp(ref: pr.Image, mov: pr.Image, yaw_main: float, pitch_main: float
         mov_cal = np.dot(zoom_mat_mov, mov_cal)
         h = np.dot(np.dot(ref_cal, rot_main), np.linalg.inv(mov_cal))
         mov_calib["mtx"] = mov_cal
+    return h, mov_calib
+
+
+def rotation_warp(yaw_main: float, pitch_main: float, roll_main: float = 0., refcalib=None, movingcalib=None):
+    """Initial transform of the moving image for rigid.pyramidal_search (mov_warp):
+    3D rotation + moving camera distortion, refined by a homography, at any pyramid level.
+    :return: function (image, homography, downscale, outsize) -> warped image
+    """
+    def warp_at_scale(img, homography, downscale, outsize):
+        h, mov_calib = rotation_homography(
+            yaw_main, pitch_main, roll_main, refcalib=refcalib, movingcalib=movingcalib,
+            geometric_scale=None if downscale == 1 else 1./downscale
+        )
+        return warp(img, mov_calib, np.dot(homography, h), outsize=outsize)
+    return warp_at_scale
+
+
+def manual_warp(ref: pr.Image, mov: pr.Image, yaw_main: float, pitch_main: float, roll_main: float = 0.,
+                refcalib=None, movingcalib=None, geometric_scale=None, refinement_homography=None,
+                bigger_size_factor = None,
+                vector_field=None
+    ):
+    h, mov_calib = rotation_homography(
+        yaw_main, pitch_main, roll_main, refcalib=refcalib, movingcalib=movingcalib, geometric_scale=geometric_scale
+    )
     if refinement_homography is not None:
         h = np.dot(refinement_homography, h)
     if vector_field is not None:
@@ -74,6 +101,89 @@ def manual_warp(ref: pr.Image, mov: pr.Image, yaw_main: float, pitch_main: float
     return mov_u
 
 
+def manual_warp_variants(ref: pr.Image, mov: pr.Image, yaw_main: float, pitch_main: float, roll_main: float = 0.,
+                         refcalib=None, movingcalib=None,
+                         global_homography=None, local_homography=None, vector_field=None,
+                         variants=[WARP_LOCAL, WARP_GLOBAL],
+                         bigger_size_factor=1.2):
+    """
+    Warp the moving image several times with the same 3D rotation & moving camera distortion,
+    the rotation + distortion map is computed only once on a padded grid and shared by all variants.
+    - WARP_LOCAL: refined by local_homography then by the vector field (same as manual_warp with vector_field)
+    - WARP_GLOBAL: refined by global_homography only (same as manual_warp without vector_field).
+    When the global homography footprint falls outside of the padded shared map,
+    the global variant is computed directly with manual_warp.
+
+    :param variants: list of the variants to compute, the others are not computed at all.
+    :param bigger_size_factor: padding of the shared map.
+    :return: dictionary {variant: warped image}
+    """
+    rot_main, _ = cv2.Rodrigues(np.array([-np.deg2rad(pitch_main), np.deg2rad(yaw_main), np.deg2rad(roll_main)]))
+    h = np.dot(np.dot(refcalib["mtx"], rot_main), np.linalg.inv(movingcalib["mtx"]))
+    outsize = [ref.data.shape[1], ref.data.shape[0]]
+    new_out_size = [int(outsize[0]*bigger_size_factor), int(outsize[1]*bigger_size_factor)]
+    translation_mat = np.eye(3)
+    translation_mat[0, 2] = (new_out_size[0] - outsize[0])/2
+    translation_mat[1, 2] = (new_out_size[1] - outsize[1])/2
+    padding = [int(translation_mat[0, 2]), int(translation_mat[1, 2])]
+    map_x, map_y = cv2.initUndistortRectifyMap(
+        movingcalib["mtx"], movingcalib["dist"], np.eye(3, 3),
+        np.dot(np.dot(translation_mat, h), movingcalib["mtx"]),
+        (new_out_size[0], new_out_size[1]), cv2.CV_32FC1
+    )
+    shared_map = cv2.merge([map_x, map_y])
+    del map_x, map_y
+    out = {}
+    for variant in variants:
+        if variant == WARP_GLOBAL:
+            refinement = np.eye(3) if global_homography is None else global_homography
+            homog = np.dot(translation_mat, np.linalg.inv(refinement))
+            corners = cv2.perspectiveTransform(
+                np.array([[[0., 0.], [outsize[0]-1, 0.], [0., outsize[1]-1], [outsize[0]-1, outsize[1]-1]]]), homog
+            )[0]
+            if not (np.all(corners >= 0) and np.all(corners <= np.array(new_out_size) - 1)):
+                logging.info("Global homography footprint exceeds the shared map padding, direct global warp")
+                out[variant] = manual_warp(
+                    ref, mov, yaw_main, pitch_main, roll_main, refcalib=refcalib, movingcalib=movingcalib,
+                    refinement_homography=global_homography
+                )
+                continue
+            grid = np.dstack(np.meshgrid(np.arange(outsize[0], dtype=np.float32), np.arange(outsize[1], dtype=np.float32)))
+        elif variant == WARP_LOCAL:
+            refinement = np.eye(3) if local_homography is None else local_homography
+            if vector_field is not None:
+                res_map_x, res_map_y = warp_from_sparse_vector_field(
+                    np.empty(new_out_size[::-1]), vector_field, get_remap=True, padding=padding
+                )
+                grid = cv2.merge([
+                    res_map_x[padding[1]:padding[1]+outsize[1], padding[0]:padding[0]+outsize[0]],
+                    res_map_y[padding[1]:padding[1]+outsize[1], padding[0]:padding[0]+outsize[0]]
+                ])
+                del res_map_x, res_map_y
+            else:
+                grid = np.dstack(np.meshgrid(
+                    np.arange(padding[0], padding[0]+outsize[0], dtype=np.float32),
+                    np.arange(padding[1], padding[1]+outsize[1], dtype=np.float32)
+                ))
+            homog = np.dot(np.dot(translation_mat, np.linalg.inv(refinement)), np.linalg.inv(translation_mat))
+        else:
+            raise NameError("Warp variant {} is not supported".format(variant))
+        coords = cv2.perspectiveTransform(grid, homog)
+        del grid
+        # outside of the shared map: far outside of the moving image -> black
+        warp_map = cv2.remap(
+            shared_map, coords, None,
+            interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(-1.E5, -1.E5, 0, 0)
+        )
+        del coords
+        out[variant] = cv2.remap(
+            mov if not isinstance(mov, pr.Image) else mov.data,
+            warp_map, None,
+            interpolation=cv2.INTER_CUBIC, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0)
+        )
+    return out
+
+
 # ---------------------------------------------- SEMI-AUTO ALIGNMENT----------------------------------------------------
 def estimate_translation(ref, mov_warped, refcalib, geometricscale=None):
     shifts, error, phase_diff = phase_cross_correlation(
@@ -204,9 +204,13 @@ def c2g(im):
 def g2c(im):
     return cv2.cvtColor(im, cv2.COLOR_GRAY2RGB)
 
-def get_polar_shading_map(img_shape=(3448, 4600, 3), calib=None):
+def get_polar_shading_map(img_shape=(3448, 4600, 3), calib=None, pixel_size=1.):
+    """
+    :param pixel_size: size of a pixel of img_shape in full resolution pixels (thumbnails), calib radii are in
+    full resolution pixels
+    """
     radius = int(np.sqrt((img_shape[0]/2)**2+(img_shape[1]/2) **2))
-    x_lin = np.array(range(radius))
+    x_lin = np.array(range(radius)) * pixel_size
     vignetting_map = np.zeros(img_shape)
     for ch in range(3):
         parametric_profile = get_shading_profile(calib["RGB"[ch]], x_lin)
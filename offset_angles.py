@@ -9,6 +9,7 @@ version 1.3  2022-11-23 19:12:00
 
 import logging
 import os
+import numpy as np
 import os.path as osp
 import sys
 
@@ -22,7 +23,13 @@ import automatic_registration
 import config
 
 
-def estimOffsetYawPitchRoll(shootingPts, listImgMatch, planVol, dirPlanVol, dirMission):
+def estimOffsetYawPitchRoll(shootingPts, listImgMatch, planVol, dirPlanVol, dirMission, fast=True, workers=None):
+    """
+    Offset angles of the NIR camera estimated from the coarse alignment of the best synchronized pairs.
+    :param fast: angles only alignment (coarse search on thumbnails, in parallel, no image written).
+    Otherwise the pairs are fully processed (aligned images are written in the ImgOffset folder).
+    :param workers: number of parallel processes of the fast mode, all CPUs by default
+    """
     offsetAngles_0 = planVol["offset_angles"]   # use offset angles  in FlightPlan (Excel ) or config.json (??)
     print(Style.GREEN + 'Current NIR camera offset angles : [Yaw, Pitch, Roll]= [ %.3f° | %.3f° | %.3f° ].   ' % (planVol["offset_angles"][0], planVol["offset_angles"][1], planVol["offset_angles"][2]) + Style.RESET)
     try:
@@ -43,11 +50,14 @@ def estimOffsetYawPitchRoll(shootingPts, listImgMatch, planVol, dirPlanVol, dirM
                 exc) + Style.RESET)
         traceback.print_exc()
 
+    dirNameOffset = os.path.join(dirMission, 'ImgOffset')
+    IRd.reformatDirectory(dirNameOffset, rootdir=dirPlanVol, makeOutdir=True)
+    if fast:
+        return estimOffsetAnglesOnly(shootingPts, listImgMatch, planVol, dirMission, ImgMatchOffset, ptsOffset,
+                                     dirNameOffset, workers=workers)
     traces = ["vir", "vis"] #, "nir", "vir", "ndvi"]
     nbImgProcess = len(ptsOffset)
     print(Style.YELLOW + 'WARNING : The processing of these %i images will take %.2f h.' % (nbImgProcess, 1.5 * nbImgProcess / 60.) + Style.RESET)
-    dirNameOffset = os.path.join(dirMission, 'ImgOffset')
-    IRd.reformatDirectory(dirNameOffset, rootdir=dirPlanVol, makeOutdir=True)
     print(Style.CYAN + 'INFO : ------ Automatic_registration.process_raw_pairs \n' + Style.RESET)
     automatic_registration.process_raw_pairs(ImgMatchOffset[::1],
                                              out_dir=dirNameOffset,
@@ -67,3 +77,33 @@ def estimOffsetYawPitchRoll(shootingPts, listImgMatch, planVol, dirPlanVol, dirM
 
 
     return offsetYaw, offsetPitch, offsetRoll
+
+
+def estimOffsetAnglesOnly(shootingPts, listImgMatch, planVol, dirMission, ImgMatchOffset, ptsOffset, dirNameOffset,
+                          workers=None):
+    """
+    Fast offset angles estimation: coarse angles only, computed on thumbnails of all pairs in parallel.
+    Only the motion models (coarse angles) are written in the ImgOffset folder.
+    """
+    print(Style.CYAN + 'INFO : ------ Automatic_registration.coarse_angles_pairs (%i pairs)\n' % len(ptsOffset) + Style.RESET)
+    motion_models = automatic_registration.coarse_angles_pairs(ImgMatchOffset, listPts=ptsOffset, workers=workers)
+    ptsValid = []
+    for (vis_pth, _nir_pth), ptOffset, motion_model in zip(ImgMatchOffset, ptsOffset, motion_models):
+        if motion_model is None:
+            continue
+        np.save(osp.join(dirNameOffset, osp.basename(str(vis_pth))[:-4] + "_motion_model"), motion_model, allow_pickle=True)
+        for pt in [ptOffset, shootingPts[ptOffset.num - 1]]:
+            pt.yawCoarseAlign = motion_model["yaw"]
+            pt.pitchCoarseAlign = motion_model["pitch"]
+            pt.rollCoarseAlign = motion_model["roll"]
+        ptsValid.append(ptOffset)
+    if len(ptsValid) == 0:
+        raise NameError("No pair could be coarsely aligned to estimate the offset angles")
+    try:
+        IRd.SaveSummaryInExcelFormat(dirMission, True, shootingPts, listImgMatch, mute=True)
+        IRd.SaveSummaryInNpyFormat(dirMission, False, planVol, shootingPts)
+    except Exception as exc:
+        logging.error(Style.YELLOW + "WARNING : Flight analytics cannot be saved.\nError = {}".format(exc) + Style.RESET)
+    offsetYaw, offsetPitch, offsetRoll = IRd.estimOffset(ptsValid)
+    print(Style.GREEN + 'New NIR camera offset angles : [Yaw, Pitch, Roll]= [ %.3f° | %.3f° | %.3f° ].   ' % (offsetYaw, offsetPitch, offsetRoll) + Style.RESET)
+    return offsetYaw, offsetPitch, offsetRoll
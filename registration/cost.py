@@ -4,7 +4,9 @@ import os.path as osp
 import sys
 sys.path.append(osp.join(osp.dirname(__file__), ".."))
 from irdrone.utils import c2g, g2c
-from numba import jit
+from numba import jit, prange
+import numba
+import cv2
 
 import logging
 import irdrone.process as pr
@@ -80,21 +82,27 @@ def representation_visualization_pairs(ref, mov, ref_orig=None, mov_orig=None, d
 
 # --------------------------------------------------- Representations --------------------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
+def laplacian_energies(img_filt):
+    """Directional energies (Scharr horizontal & vertical, Roberts diagonals) of a filtered grayscale image
+    """
+    ms_img = np.empty((img_filt.shape[0], img_filt.shape[1], 4))
+    ms_img[:, :, 0] = filters.scharr_h(img_filt)
+    ms_img[:, :, 1] = filters.scharr_v(img_filt)
+    ms_img[:, :, 2] = filters.edges.roberts_pos_diag(img_filt)
+    ms_img[:, :, 3] = filters.edges.roberts_neg_diag(img_filt)
+    return ms_img**2
+
+
 def multispectral_representation(_img, sigma_gaussian=None, mode=LAPLACIAN_ENERGIES):
     """Laplacian Energy , Gray scales, Colors
     """
     img = _img if isinstance(_img, np.ndarray) else _img.data
     shp = img.shape
     if mode == LAPLACIAN_ENERGIES:
-        ms_img = np.empty((shp[0], shp[1], 4))
         img_filt = c2g(img.astype(np.float32)) #float32 otherwise cv2 cannot convert RGB to GRAY
         if sigma_gaussian is not None:
             img_filt = filters.gaussian(img_filt, sigma_gaussian)
-        ms_img[:, :, 0] = filters.scharr_h(img_filt)
-        ms_img[:, :, 1] = filters.scharr_v(img_filt)
-        ms_img[:, :, 2] = filters.edges.roberts_pos_diag(img_filt)
-        ms_img[:, :, 3] = filters.edges.roberts_neg_diag(img_filt)
-        ms_img = ms_img**2
+        ms_img = laplacian_energies(img_filt)
     elif mode == GRAY_SCALE:
         ms_img = np.empty((shp[0], shp[1], 1))
         ms_img[:, :, 0] = 0.299*img[:, :, 0] + 0.587*img[:, :, 1] + 0.114*img[:, :, 2]
@@ -140,6 +148,99 @@ def cost_surface_NTG(patch_ref, patch_mov_search, search_y, search_x):
     return cost
 
 
+def cost_surface_SSD_template(patch_ref, patch_mov_search, search_y, search_x):
+    """Sum of squared difference expanded as sum(ref_shift^2) + sum(mov^2) - 2 * cross correlation.
+    cv2.matchTemplate (TM_SQDIFF) evaluates the cross correlation by FFT and the ref energies by integral images,
+    so the cost no longer grows with patch area x search area.
+    Same output as cost_surface_SSD: (2*search_y+1, 2*search_x+1, C)
+    """
+    c_s = patch_mov_search.shape[-1]
+    cost = np.empty((2*search_y+1, 2*search_x+1, c_s), dtype=np.float32)
+    for ch in range(c_s):
+        cost[:, :, ch] = cv2.matchTemplate(
+            np.ascontiguousarray(patch_ref[:, :, ch], dtype=np.float32),
+            np.ascontiguousarray(patch_mov_search[:, :, ch], dtype=np.float32),
+            cv2.TM_SQDIFF
+        )
+    return cost
+
+
+def sobel_gradients(img):
+    """Valid Sobel responses (H-2, W-2, C) with the cost_surface_NTG conventions.
+    Sobel is linear: Sobel(mov - ref_shift) = Sobel(mov) - Sobel(ref)_shift
+    so gradients are computed once per image instead of once per shift.
+    :return: vertical edges, horizontal edges as channel first contiguous float32 arrays (C, H-2, W-2)
+    """
+    img = np.moveaxis(img.astype(np.float32), -1, 0)
+    sobel_ = img[:, :, 2:] - img[:, :, :-2]
+    grad_v = sobel_[:, :-2] + sobel_[:, 2:] + 2*sobel_[:, 1:-1]
+    sobel_ = img[:, 2:, :] - img[:, :-2, :]
+    grad_h = sobel_[:, :, :-2] + sobel_[:, :, 2:] + 2*sobel_[:, :, 1:-1]
+    return np.ascontiguousarray(grad_v), np.ascontiguousarray(grad_h)
+
+
+@jit(nopython=True)
+def ntg_shift_cost(grad_ref_v, grad_ref_h, grad_mov_v, grad_mov_h, v, u, ch):
+    """L1 norm of the gradients difference for a single shift (v, u) and channel
+    """
+    _c_s, g_y, g_x = grad_mov_v.shape
+    acc = 0.
+    for y in range(g_y):
+        for x in range(g_x):
+            acc += abs(grad_mov_v[ch, y, x] - grad_ref_v[ch, v+y, u+x]) + \
+                   abs(grad_mov_h[ch, y, x] - grad_ref_h[ch, v+y, u+x])
+    return acc
+
+
+@jit(nopython=True, parallel=True)
+def cost_surface_NTG_gradients(grad_ref_v, grad_ref_h, grad_mov_v, grad_mov_h, search_y, search_x):
+    """NTG cost from precomputed Sobel gradients (sobel_gradients): only shifted L1 sums remain.
+    Parallelized over shifts.
+    :param grad_ref_v, grad_ref_h: gradients of the reference patch (C, h+2*search_y-2, w+2*search_x-2)
+    :param grad_mov_v, grad_mov_h: gradients of the moving search patch (C, h-2, w-2)
+    Same output as cost_surface_NTG: (2*search_y+1, 2*search_x+1, C)
+    """
+    c_s = grad_mov_v.shape[0]
+    n_u = 2*search_x+1
+    cost = np.zeros((2*search_y+1, n_u, c_s), dtype=np.float32)
+    for idx in prange((2*search_y+1)*n_u):
+        v = idx // n_u
+        u = idx % n_u
+        for ch in range(c_s):
+            cost[v, u, ch] = ntg_shift_cost(grad_ref_v, grad_ref_h, grad_mov_v, grad_mov_h, v, u, ch)
+    return cost
+
+
+@jit(nopython=True, parallel=True)
+def compute_cost_surfaces_NTG_gradients(
+        grad_ref_v, grad_ref_h, grad_mov_v, grad_mov_h,
+        y_s, x_s,
+        y_n=3, x_n=3, search_y=3, search_x=3
+    ):
+    """Patch parallel NTG cost surfaces from whole image gradients (sobel_gradients of images of size y_s, x_s).
+    Parallelized over the flattened patch index, writes into a float32 cost volume.
+    Kernels called inside the parallel loop are serial (no nested parallelism).
+    """
+    c_s = grad_ref_v.shape[0]
+    p_size_x = int(np.floor(x_s / x_n))
+    p_size_y = int(np.floor(y_s / y_n))
+    costs = np.empty((y_n, x_n, 2*search_y+1, 2*search_x+1, c_s), dtype=np.float32)
+    for idx in prange(y_n*x_n):
+        y_id = idx // x_n
+        x_id = idx % x_n
+        y_start, y_end = y_id*p_size_y, (y_id+1)*p_size_y
+        x_start, x_end = x_id*p_size_x, (x_id+1)*p_size_x
+        patch_ref_v = grad_ref_v[:, y_start:y_end-2, x_start:x_end-2]
+        patch_ref_h = grad_ref_h[:, y_start:y_end-2, x_start:x_end-2]
+        patch_mov_v = grad_mov_v[:, y_start+search_y:y_end-search_y-2, x_start+search_x:x_end-search_x-2]
+        patch_mov_h = grad_mov_h[:, y_start+search_y:y_end-search_y-2, x_start+search_x:x_end-search_x-2]
+        for v in range(2*search_y+1):
+            for u in range(2*search_x+1):
+                for ch in range(c_s):
+                    costs[y_id, x_id, v, u, ch] = ntg_shift_cost(patch_ref_v, patch_ref_h, patch_mov_v, patch_mov_h, v, u, ch)
+    return costs
+
+
 # ---------------------------------------------- Full image cost function ----------------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
 @jit(nopython=True)
@@ -179,6 +280,62 @@ def compute_cost_surfaces(
     return costs, centers, patch_coords
 
 
+def compute_cost_surfaces_fast(
+        ref, mov,
+        y_n=3, x_n=3, search_y=3, search_x=3,
+        dist_mode=SSD,
+        parallel_patches=None
+    ):
+    """Same contract as compute_cost_surfaces (costs, centers, patch_coords) with faster cost engines
+    and a float32 cost volume.
+    SSD: cost_surface_SSD_template in a serial loop over patches (cv2.matchTemplate is multithreaded itself).
+    NTG: Sobel gradients computed once on the whole images then shifted L1 sums.
+    Parallel over patches when there are enough patches to feed all threads, over shifts otherwise
+    (like the single huge patch of the coarse search).
+    :param parallel_patches: force the NTG patch parallel (True) or shift parallel (False) kernel. None: automatic
+    """
+    y_s, x_s, c_s = ref.shape
+    p_size_x = int(np.floor(x_s / x_n))
+    p_size_y = int(np.floor(y_s / y_n))
+    centers = np.empty((y_n, x_n, 2))
+    patch_coords = np.empty((y_n, x_n, 4))
+    for y_id in range(y_n):
+        for x_id in range(x_n):
+            y_start, y_end = y_id*p_size_y, (y_id+1)*p_size_y
+            x_start, x_end = x_id*p_size_x, (x_id+1)*p_size_x
+            patch_coords[y_id, x_id, :] = [y_start, y_end, x_start, x_end]
+            centers[y_id, x_id, :] = [(x_start+x_end)/2., (y_start+y_end)/2.]
+    if dist_mode == NTG:
+        grad_ref_v, grad_ref_h = sobel_gradients(ref)
+        grad_mov_v, grad_mov_h = sobel_gradients(mov)
+        if parallel_patches is None:
+            parallel_patches = y_n * x_n >= numba.get_num_threads()
+        if parallel_patches:
+            costs = compute_cost_surfaces_NTG_gradients(
+                grad_ref_v, grad_ref_h, grad_mov_v, grad_mov_h,
+                y_s, x_s, y_n=y_n, x_n=x_n, search_y=search_y, search_x=search_x
+            )
+            return costs, centers, patch_coords
+    elif dist_mode != SSD:
+        raise NameError("Distance {} is not supported".format(dist_mode))
+    costs = np.empty((y_n, x_n, 2*search_y+1, 2*search_x+1, c_s), dtype=np.float32)
+    for y_id in range(y_n):
+        for x_id in range(x_n):
+            y_start, y_end, x_start, x_end = patch_coords[y_id, x_id, :].astype(int)
+            if dist_mode == SSD:
+                patch_ref = ref[y_start:y_end, x_start:x_end, :]
+                patch_mov_search = mov[y_start+search_y:y_end-search_y, x_start+search_x:x_end-search_x, :]
+                costs[y_id, x_id] = cost_surface_SSD_template(patch_ref, patch_mov_search, search_y, search_x)
+            elif dist_mode == NTG:
+                costs[y_id, x_id] = cost_surface_NTG_gradients(
+                    grad_ref_v[:, y_start:y_end-2, x_start:x_end-2], grad_ref_h[:, y_start:y_end-2, x_start:x_end-2],
+                    grad_mov_v[:, y_start+search_y:y_end-search_y-2, x_start+search_x:x_end-search_x-2],
+                    grad_mov_h[:, y_start+search_y:y_end-search_y-2, x_start+search_x:x_end-search_x-2],
+                    search_y, search_x
+                )
+    return costs, centers, patch_coords
+
+
 def plot_costs_overview(cost_dict, debug_fig=None, title=None, pickle_path=None):
     _costs_dbg = []
     for y_id in range(cost_dict["costs"].shape[0]):
@@ -248,15 +405,19 @@ def plot_single_cost_function(cost_dict, ref, mov, patch_coords, prefix="", suff
 def compute_cost_surfaces_with_traces(
         ref, mov,
         debug=False, debug_dir=None, prefix=None, suffix="", align_config=AlignmentConfig(),
-        forced_debug_dir=None
+        forced_debug_dir=None, tracer=None
     ):
     """Wrapping for numba acclerated compute_cost_surfaces with extra debug traces
+    :param tracer: registration.tracing.Tracer, overrides debug, debug_dir & forced_debug_dir.
+    Single cost surfaces are traced at TRACE_ALL level, the cost overview (and its pickle) at TRACE_MANDATORY level.
     """
+    if tracer is not None:
+        debug, debug_dir, forced_debug_dir = tracer.debug, tracer.debug_dir, tracer.forced_debug_dir
     if prefix is None:
         prefix = ""
     debug_fig_main = None if debug_dir is None else osp.join(debug_dir, "{}_blocks_y{}x{}_search_y{}x{}_{}_".format(
         prefix, align_config.y_n, align_config.x_n, align_config.search_y, align_config.search_x, align_config.dist_mode))
-    costs, centers, patch_coords = compute_cost_surfaces(
+    costs, centers, patch_coords = compute_cost_surfaces_fast(
         ref, mov,
         y_n=align_config.y_n, x_n=align_config.x_n,
         search_x=align_config.search_x, search_y=align_config.search_y,
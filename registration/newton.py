@@ -51,6 +51,31 @@ So it could be easier to retrieve Hessian A and gradient Ax+B
 import numpy as np
 import logging
 from registration.constants import NEWTON, GRADIENT_DESCENT, QUADRATIC_FORM
+import cv2
+
+# Quadric approximation kernels (see quadric_approximation)
+GRAD_X_CONV = np.array([
+    [-1., 0., 1.],
+    [-2., 0., 2.],
+    [-1., 0., 1.],
+])/8. # b1
+GRAD_Y_CONV = GRAD_X_CONV.T  # b2
+HESS_XX_CONV = np.array([
+    [1., -2., 1.],
+    [2., -4., 2.],
+    [1., -2., 1.],
+])/4.
+HESS_YY_CONV = HESS_XX_CONV.T
+HESS_XY_CONV = np.array([
+    [ 1, 0, -1 ],
+    [ 0, 0,  0 ],
+    [-1, 0,  1 ]
+])/4.
+CONSTANT_CONV = np.array([
+    [-1,  2, -1 ],
+    [ 2, 12,  2 ],
+    [-1,  2, -1 ]
+])/16.
 
 
 def quadric_approximation(full_cost):
@@ -100,40 +125,18 @@ def quadric_approximation(full_cost):
             full_cost.shape[1]//2 - 1:full_cost.shape[1]//2 + 2,
             :
         ]
-    grad_x_conv = np.array([
-        [-1., 0., 1.],
-        [-2., 0., 2.],
-        [-1., 0., 1.],
-    ])/8. # b1
-    grad_y_conv = grad_x_conv.T  # b2
-    hess_xx_conv = np.array([
-        [1., -2., 1.],
-        [2., -4., 2.],
-        [1., -2., 1.],
-    ])/4.
-    hess_yy_conv = hess_xx_conv.T
-    hess_xy_conv = np.array([
-        [ 1, 0, -1 ],
-        [ 0, 0,  0 ],
-        [-1, 0,  1 ]
-    ])/4.
-    constant_conv = np.array([
-        [-1,  2, -1 ],
-        [ 2, 12,  2 ],
-        [-1,  2, -1 ]
-    ])/16.
     n_channels = full_cost.shape[-1]
     hessi = np.empty((n_channels, 2, 2))
     grads = np.empty((n_channels, 2))
     constants = np.empty((n_channels))
     for ch in range(n_channels):
         cost = full_cost[:, :, ch]
-        hess_xx = np.sum(cost * hess_xx_conv)
-        hess_yy = np.sum(cost * hess_yy_conv)
-        hess_xy = np.sum(cost * hess_xy_conv)
-        grad_x = np.sum(cost * grad_x_conv)
-        grad_y = np.sum(cost * grad_y_conv)
-        constants[ch] = np.sum(cost * constant_conv)
+        hess_xx = np.sum(cost * HESS_XX_CONV)
+        hess_yy = np.sum(cost * HESS_YY_CONV)
+        hess_xy = np.sum(cost * HESS_XY_CONV)
+        grad_x = np.sum(cost * GRAD_X_CONV)
+        grad_y = np.sum(cost * GRAD_Y_CONV)
+        constants[ch] = np.sum(cost * CONSTANT_CONV)
         hessi[ch, :, :] = np.array([
             [hess_xx, hess_xy],
             [hess_xy, hess_yy]
@@ -142,6 +145,23 @@ def quadric_approximation(full_cost):
     return hessi, grads, constants
 
 
+def hessian_determinant_maps(cost):
+    """
+    Determinant of the quadric approximation Hessian (see quadric_approximation) of each 3x3 neighborhood
+    of a cost surface, for all positions at once (3 correlations per channel).
+    :param cost: (N, M, C)
+    :return: (N, M, C) determinant maps, borders (1 pixel) are not valid
+    """
+    det = np.empty(cost.shape, dtype=np.float64)
+    for ch in range(cost.shape[-1]):
+        cost_ch = np.ascontiguousarray(cost[:, :, ch], dtype=np.float64)
+        hess_xx = cv2.filter2D(cost_ch, -1, HESS_XX_CONV, borderType=cv2.BORDER_REPLICATE)
+        hess_yy = cv2.filter2D(cost_ch, -1, HESS_YY_CONV, borderType=cv2.BORDER_REPLICATE)
+        hess_xy = cv2.filter2D(cost_ch, -1, HESS_XY_CONV, borderType=cv2.BORDER_REPLICATE)
+        det[:, :, ch] = hess_xx * hess_yy - hess_xy**2
+    return det
+
+
 def newton_iter(previous_val, grad_vec, hess_mat=None, alpha=1., max_step=1.):
     step = np.zeros_like(previous_val)
     n_ch = grad_vec.shape[0]
@@ -0,0 +1,149 @@
+"""
+Gaussian pyramids of multispectral representations in float32.
+Successive cv2.pyrDown halvings, only the levels requested by an iterative scheme are stored.
+A pyramid is a dictionary {downscale factor: image}, computed once per image and shared by all the scales
+of the pyramidal search (the coarse search builds its own levels from thumbnails).
+
+Laplacian energies are computed at pyramid level by default: the grayscale image is downsampled first
+(as far as the requested gaussian blur allows it without aliasing), the remaining part of the blur is applied there,
+then directional energies are computed and pyramid reduced to the requested levels
+(the same way full resolution energies used to be reduced).
+"""
+import numpy as np
+import cv2
+import logging
+from irdrone.utils import c2g
+from registration.cost import multispectral_representation, laplacian_energies
+from registration.constants import LAPLACIAN_ENERGIES
+
+
+def pyramid_down(img):
+    """Blur and halve an image (any number of channels), keeps the channel axis of single channel images
+    """
+    out = cv2.pyrDown(img)
+    if out.ndim < img.ndim:
+        out = out[..., np.newaxis]
+    return out
+
+
+def scales_from_scheme(iterative_scheme):
+    """Pyramid levels used by an iterative scheme [(downsample, iteration, ...)]
+    """
+    return sorted(set([el[0] for el in iterative_scheme]))
+
+
+def compute_pyramid(img, scales_list):
+    """Returns pyramid dictionary, only for the downscale factors (powers of 2) in scales_list.
+    uint8 images are normalized to [0, 1]
+    """
+    if img.dtype == np.uint8:
+        current = img.astype(np.float32) / 255.
+    else:
+        current = img.astype(np.float32, copy=False)
+    for scale in scales_list:
+        if scale < 1 or (scale & (scale - 1)) != 0:
+            raise NameError("Pyramid level {} is not a power of 2".format(scale))
+    img_pyr = {}
+    ds = 1
+    while True:
+        if ds in scales_list:
+            img_pyr[ds] = current
+            logging.info("Storing pyramid level {} {}".format(ds, current.shape))
+        if ds >= max(scales_list):
+            break
+        current = pyramid_down(current)
+        ds *= 2
+    return img_pyr
+
+
+def energy_level(sigma_gaussian, ds):
+    """Coarsest pyramid level (at most ds/2) at which the blurred grayscale image can be sampled:
+    the cumulated blur of cv2.pyrDown binomial filters (unit variance at the resolution they are applied to)
+    must not exceed the requested full resolution gaussian blur.
+    """
+    level = 1
+    while 2 * level <= ds // 2 and ((2 * level)**2 - 1) / 3. <= (0. if sigma_gaussian is None else sigma_gaussian**2):
+        level *= 2
+    return level
+
+
+def residual_sigma(sigma_gaussian, level):
+    """Gaussian blur (in pixels of a pyramid level) still to be applied at this level so that the pyramid blur
+    plus the residual blur match a full resolution gaussian blur of sigma_gaussian.
+    """
+    variance_pyramid = (level**2 - 1) / 3.
+    if sigma_gaussian is None or sigma_gaussian**2 <= variance_pyramid:
+        return 0.
+    return np.sqrt(sigma_gaussian**2 - variance_pyramid) / level
+
+
+def pyramid_shape(shape, ds):
+    """(height, width) of the pyramid level ds of an image of a given shape (successive cv2.pyrDown halvings)
+    """
+    height, width = shape[:2]
+    while ds > 1:
+        height, width, ds = (height + 1) // 2, (width + 1) // 2, ds // 2
+    return height, width
+
+
+def level_energies(gray_level, level, sigma_gaussian=None):
+    """Laplacian energies of a grayscale pyramid level, blurred to match a full resolution gaussian blur
+    and scaled to full resolution gradients.
+    """
+    sigma = residual_sigma(sigma_gaussian, level)
+    if sigma > 0:
+        gray_level = cv2.GaussianBlur(gray_level, (0, 0), sigma)
+    # gradients at a pyramid level are ~level times larger than full resolution gradients
+    return (laplacian_energies(gray_level) / level**2).astype(np.float32)
+
+
+def msr_input_level(mode, ds, sigma_gaussian=None):
+    """Pyramid level of the input image the representation of level ds is computed from
+    (see warped_msr)
+    """
+    return energy_level(sigma_gaussian, ds) if mode == LAPLACIAN_ENERGIES else ds
+
+
+def msr_input_pyramid(img, scales_list, mode, sigma_gaussian=None):
+    """Pyramid of the input images of the representations (grayscale for Laplacian energies)
+    so that they can be warped before the representation is computed (see warped_msr)
+    """
+    img = img if isinstance(img, np.ndarray) else img.data
+    img = img.astype(np.float32)
+    if mode == LAPLACIAN_ENERGIES:
+        img = c2g(img)
+    return compute_pyramid(img, sorted(set([msr_input_level(mode, ds, sigma_gaussian) for ds in scales_list])))
+
+
+def warped_msr(input_pyr, ds, mode, warp_level, sigma_gaussian=None):
+    """Multispectral representation of level ds of a warped image.
+    The input pyramid level is warped first (warp_level(image, level) -> image in the reference geometry),
+    then the representation is computed on the warped level,
+    like the representation of a full resolution warped image.
+    :param input_pyr: see msr_input_pyramid
+    """
+    level = msr_input_level(mode, ds, sigma_gaussian)
+    warped = warp_level(input_pyr[level], level)
+    if mode != LAPLACIAN_ENERGIES:
+        return multispectral_representation(warped, mode=mode).astype(np.float32)
+    return compute_pyramid(level_energies(warped, level, sigma_gaussian), [ds // level])[ds // level]
+
+
+def msr_pyramid(img, scales_list, mode, sigma_gaussian=None, at_level=True):
+    """Multispectral representation pyramid of the requested levels
+    :param at_level: compute Laplacian energies on the downsampled grayscale image.
+    Otherwise the representation is computed at full resolution then downsampled (slow on 12Mpix images)
+    """
+    img = img if isinstance(img, np.ndarray) else img.data
+    if mode != LAPLACIAN_ENERGIES or not at_level:
+        msr = multispectral_representation(img, sigma_gaussian=sigma_gaussian, mode=mode).astype(np.float32)
+        return compute_pyramid(msr, scales_list)
+    energy_levels = {ds: energy_level(sigma_gaussian, ds) for ds in scales_list}
+    gray_pyr = compute_pyramid(c2g(img.astype(np.float32)), sorted(set(energy_levels.values())))
+    msr_pyr = {}
+    for level in sorted(set(energy_levels.values())):
+        energies = level_energies(gray_pyr[level], level, sigma_gaussian)
+        energies_pyr = compute_pyramid(energies, [ds // level for ds, lvl in energy_levels.items() if lvl == level])
+        for ds_energies, energies_ds in energies_pyr.items():
+            msr_pyr[ds_energies * level] = energies_ds
+    return msr_pyr
@@ -2,17 +2,19 @@ import os.path as osp
 import sys
 sys.path.append(osp.join(osp.dirname(__file__), ".."))
 import numpy as np
-from registration.newton import newton_iter, quadric_approximation
+from registration.newton import newton_iter, quadric_approximation, hessian_determinant_maps
+from registration.newton import GRAD_X_CONV, GRAD_Y_CONV, HESS_XX_CONV, HESS_YY_CONV, HESS_XY_CONV
 from irdrone.register import geometric_rigid_transform_estimation
 from registration.warp_flow import warp_from_sparse_vector_field
 # from irdrone.utils import c2g, g2c
 import matplotlib.pyplot as plt
 import logging
-from registration.cost import compute_cost_surfaces_with_traces, AlignmentConfig, run_multispectral_cost, multispectral_representation, viz_laplacian_energy
+from registration.cost import compute_cost_surfaces_with_traces, AlignmentConfig, run_multispectral_cost, viz_laplacian_energy
 from registration.constants import LAPLACIAN_ENERGIES, GRAY_SCALE, COLORED, SSD, NTG
+from registration.pyramid import compute_pyramid, msr_pyramid, scales_from_scheme, pyramid_shape, msr_input_pyramid, msr_input_level, warped_msr
+from registration.tracing import Tracer, TRACE_ALL, TRACE_MANDATORY
 import irdrone.process as pr
 import cv2
-from skimage import transform
 from os import mkdir
 import time
 
@@ -45,14 +47,52 @@ def minimum_cost(cost, amin_index=None):
     return new_val+init_position, hessi, gradi
 
 
+def minimum_cost_batch(costs):
+    """Batched version of minimum_cost for many cost areas at once (same results).
+    argmin of each area, quadric approximation of the 3x3 neighborhoods and a single Newton step
+    (closed form 2x2 inversion, gradient descent fallback on singular Hessians) averaged over channels.
+    :param costs: (N, H, W, C)
+    :return: (N, 2) displacements (x, y)
+    """
+    n_areas, size_y, size_x, n_channels = costs.shape
+    amin = np.argmin(costs.sum(axis=-1).reshape(n_areas, -1), axis=1)
+    amin_y, amin_x = amin // size_x, amin % size_x
+    init_position = np.stack([amin_x - size_x//2, amin_y - size_y//2], axis=-1).astype(np.float64)
+    neighborhood_size = 1
+    valid = (amin_y >= neighborhood_size) & (amin_y <= size_y-1-neighborhood_size) & \
+            (amin_x >= neighborhood_size) & (amin_x <= size_x-1-neighborhood_size)
+    # gather 3x3 neighborhoods (N, 3, 3, C) - invalid areas are clamped and discarded afterwards
+    offsets = np.arange(-neighborhood_size, neighborhood_size+1)
+    idx_y = np.clip(amin_y[:, np.newaxis] + offsets, 0, size_y-1)
+    idx_x = np.clip(amin_x[:, np.newaxis] + offsets, 0, size_x-1)
+    patches = costs[
+        np.arange(n_areas)[:, np.newaxis, np.newaxis], idx_y[:, :, np.newaxis], idx_x[:, np.newaxis, :], :
+    ].astype(np.float64)
+    hess_xx = np.einsum("nijc,ij->nc", patches, HESS_XX_CONV)
+    hess_yy = np.einsum("nijc,ij->nc", patches, HESS_YY_CONV)
+    hess_xy = np.einsum("nijc,ij->nc", patches, HESS_XY_CONV)
+    grad = np.stack([np.einsum("nijc,ij->nc", patches, GRAD_X_CONV), np.einsum("nijc,ij->nc", patches, GRAD_Y_CONV)], axis=-1)
+    det = hess_xx*hess_yy - hess_xy**2
+    singular = det == 0.
+    det[singular] = 1.
+    newton_step = - np.stack([
+        hess_yy*grad[..., 0] - hess_xy*grad[..., 1],
+        -hess_xy*grad[..., 0] + hess_xx*grad[..., 1]
+    ], axis=-1) / det[..., np.newaxis]
+    if singular.any():
+        logging.warning("CANNOT INVERT HESSIAN MATRIX! FALLBACK TO GRADIENT DESCENT!")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            gradient_step = - grad / np.sqrt(np.sum(grad**2, axis=-1, keepdims=True))
+        newton_step[singular] = gradient_step[singular]
+    new_val = newton_step.sum(axis=1) / n_channels
+    new_val = new_val * (np.fabs(new_val) < 1.)
+    return np.where(valid[:, np.newaxis], new_val + init_position, init_position)
+
+
 def minimum_cost_max_hessian(cost, debug=False):
     concavity = np.zeros_like(cost)
-    for id_y in range(2, cost.shape[0]-2):
-        for id_x in range(2, cost.shape[1]-2):
-            cost_patch = cost[id_y-1:id_y+2, id_x-1:id_x+2]
-            hessi, grads, constants = quadric_approximation(cost_patch)
-            for ch in range(cost.shape[-1]):
-                concavity[id_y, id_x, :] = np.linalg.det(hessi[ch, :, :])
+    # Concavity is the Hessian determinant of the last channel, copied to all channels (2 pixels borders excluded)
+    concavity[2:-2, 2:-2, :] = hessian_determinant_maps(cost[:, :, -1:])[2:-2, 2:-2, :]
     amax_index = np.unravel_index(np.argmax(concavity.sum(axis=-1)), (cost.shape[0], cost.shape[1]))
     init_position = np.array([amax_index[1]-cost.shape[1]//2, amax_index[0]-cost.shape[0]//2])
     refinement_neighborhood = 3
@@ -96,19 +136,16 @@ def brute_force_vector_field_search(costs=None, centers=None, downscale=None):
     """
     center_y, center_x = costs.shape[2]//2, costs.shape[3]//2
     extraction_area = 5
-    vector_field = np.empty((costs.shape[0], costs.shape[1], 2))
-    vpos = np.empty((costs.shape[0], costs.shape[1], 2))
-    for i in range(costs.shape[0]):
-        for j in range(costs.shape[1]):
-            logging.info("patch {} {}".format(i, j))
-            single_cost = costs[
-                          i, j,
-                          center_y-extraction_area:center_y+extraction_area+1,
-                          center_x-extraction_area:center_x+extraction_area+1,
-                          :
-                          ]
-            vector_field[i, j, :] = minimum_cost(single_cost)[0] * (1. if downscale is None else downscale)
-            vpos[i, j, :] = centers[i, j] * (1. if downscale is None else downscale)
+    extracted_costs = costs[
+                      :, :,
+                      center_y-extraction_area:center_y+extraction_area+1,
+                      center_x-extraction_area:center_x+extraction_area+1,
+                      :
+                      ]
+    vector_field = minimum_cost_batch(
+        extracted_costs.reshape(-1, *extracted_costs.shape[2:])
+    ).reshape(costs.shape[0], costs.shape[1], 2) * (1. if downscale is None else downscale)
+    vpos = np.array(centers, dtype=np.float64).reshape(costs.shape[0], costs.shape[1], 2) * (1. if downscale is None else downscale)
     return vpos, vector_field
 
 
@@ -186,17 +223,12 @@ class MotionModel:
         return str(self.model)
 
 
-def compute_pyramid(img, scales_list):
-    """Returns pyramid dictionary"""
-    img_pyr = {}
-
-    for (ids, resized) in enumerate(transform.pyramid_gaussian(img, downscale=2, multichannel=True)):
-        if 2**ids in scales_list:
-            img_pyr[2**ids] = resized.astype(np.float32)
-            logging.info("Storing pyramid level {}".format(2**ids, resized.shape))
-        if 2**ids >= max(scales_list):
-            break
-    return img_pyr
+def corners_displacement(homography, shape):
+    """Maximum displacement (in pixels) of the image corners moved by a homography"""
+    corners = np.array([[0., 0., 1.], [shape[1], 0., 1.], [0., shape[0], 1.], [shape[1], shape[0], 1.]]).T
+    moved = np.dot(homography, corners)
+    moved = moved[:2] / moved[2]
+    return np.max(np.sqrt(np.sum((moved - corners[:2])**2, axis=0)))
 
 
 def viz_msr(img, msr_mode):
@@ -215,53 +247,87 @@ def pyramidal_search(
     sigma_ref=5,
     sigma_mov=3,
     affinity=True,
-    default_patch_number=5
+    default_patch_number=5,
+    msr_ref_pyr=None,
+    msr_mov_pyr=None,
+    tracer=None,
+    init_model=None,
+    early_stop=None,
+    mov_warp=None
 ):
     """
         iterative_scheme = [ (downsample, iteration, num_patches)]
         - debug_dir=None, debug=True,  # -> SHOW TRACES, NOT SAVING ANYTHING TO DISK
         - debug_dir=None, debug=False,  # -> NO TRACES AT ALL, NOT SAVING ANYTHING TO DISK
-        - debug_dir=debug_dir, debug=False, # -> FORCE ONLY MANDATORY TRACES (see debug_flag in debug_trace function)
+        - debug_dir=debug_dir, debug=False, # -> FORCE ONLY MANDATORY TRACES (see registration.tracing trace levels)
         - debug_dir=debug_dir, debug=True, # -> FORCE ALL TRACES TO DISK
+        msr_ref_pyr: pyramid of the reference multispectral representation (see registration.pyramid).
+        Computed here if not provided or if some levels are missing.
+        msr_mov_pyr: pyramid of the moving image representation (msr_pyramid), or of its input levels
+        (msr_input_pyramid) when mov_warp is provided. Computed here if not provided or if some levels are missing.
+        tracer: registration.tracing.Tracer, overrides debug & debug_dir.
+        With TRACE_OFF, no full resolution image is warped at all (only the downsampled MSR).
+        init_model: initial full resolution homography (warm start), identity by default.
+        early_stop: when provided (in full resolution pixels), stop iterating at a given scale as soon as
+        the residual homography moves the image corners by less than early_stop.
+        mov_warp: initial transform of img_mov (see irdrone.semi_auto_registration.rotation_warp), a function
+        (image, homography, downscale, outsize) -> image warped to the reference geometry at this scale.
+        img_mov is then the unwarped moving image: only downsampled levels of its grayscale image are warped,
+        by the initial transform composed with the current homography (no full resolution resampling),
+        and the MSR is computed on the warped levels (the representation of a fisheye image is not the
+        representation of the undistorted image).
+        None: img_mov is already in the reference geometry (homography only), its MSR levels are warped.
     """
     ts_start = time.perf_counter()
-    forced_debug_dir = debug_dir
-    if not debug:
-        debug_dir = None # disable most traces if debug is set to False
-
-    def debug_trace(img, ds=1, iter="", suffix="", prefix="", debug_flag=None, msr_mode=None):
-        """debug_flag allows to force debugging trace if set to True"""
-        if debug_flag is None:
-            debug_flag = debug
-        if debug_flag and forced_debug_dir is not None:
-            name = "{}it{:02d}_ds{:02d}_{}.jpg".format(prefix, iter, ds, suffix)
-            if isinstance(img, np.ndarray) or isinstance(img, pr.Image):
-                img_save = viz_msr(img, msr_mode=msr_mode)
-                pr.Image(img_save).save(osp.join(forced_debug_dir, name))
-            elif isinstance(img, plt.Axes):
-                plt.savefig(osp.join(forced_debug_dir, name))
+    if tracer is None:
+        tracer = Tracer.from_debug_flags(debug=debug, debug_dir=debug_dir)
+    debug = tracer.debug
+    img_ref_shape = (img_ref if isinstance(img_ref, np.ndarray) else img_ref.data).shape
+
+    def debug_trace(img, ds=1, iter="", suffix="", prefix="", level=TRACE_ALL, msr_mode=None):
+        """img can be a callable, evaluated only if the trace level is enabled"""
+        name = "{}it{:02d}_ds{:02d}_{}.jpg".format(prefix, iter, ds, suffix)
+        if isinstance(img, plt.Axes):
+            tracer.figure(level, name)
+        else:
+            tracer.image(level, name, lambda: viz_msr(img() if callable(img) else img, msr_mode=msr_mode))
     # ------------------------------------------------------------------------------------------------------------------
-    motion_model = MotionModelHomography()
+    motion_model = MotionModelHomography(model=np.eye(3) if init_model is None else np.array(init_model))
     compute_cost = compute_cost_surfaces_with_traces
+
+    def warp_mov(img, ds, ref_shape):
+        """Warp a moving image of a pyramid level (downscale ds) to the reference of shape ref_shape"""
+        if mov_warp is None:
+            return motion_model.warp(img, downscale=ds)
+        return mov_warp(img, motion_model.rescale(downscale=ds), ds, (ref_shape[1], ref_shape[0]))
+
+    def warp_msr_mov(ds):
+        """MSR of the moving image registered by the current model at pyramid level ds"""
+        if mov_warp is None:
+            return motion_model.warp(msr_mov_pyr[ds], downscale=ds)
+        return warped_msr(
+            msr_mov_pyr, ds, mode,
+            lambda img, level: warp_mov(img, level, pyramid_shape(img_ref_shape, level)),
+            sigma_gaussian=sigma_mov
+        )
     # ------------------------------------------------------------------------------------------------------------------
     # ------------------------------------------------------------------------------------  Multispectral representation
     ts_msr_start = time.perf_counter()
-    msr_ref = multispectral_representation(
-        img_ref if isinstance(img_ref, np.ndarray) else img_ref.data,
-        sigma_gaussian=sigma_ref, mode=mode
-    ).astype(np.float32)
-    msr_mov = multispectral_representation(
-        img_mov if isinstance(img_mov, np.ndarray) else img_mov.data,
-        sigma_gaussian=sigma_mov, mode=mode
-    ).astype(np.float32)
+    scales_list = scales_from_scheme(iterative_scheme)
+    if msr_ref_pyr is None or not all([ds in msr_ref_pyr.keys() for ds in scales_list]):
+        msr_ref_pyr = msr_pyramid(img_ref, scales_list, mode, sigma_gaussian=sigma_ref)
+    if mov_warp is None:
+        if msr_mov_pyr is None or not all([ds in msr_mov_pyr.keys() for ds in scales_list]):
+            msr_mov_pyr = msr_pyramid(img_mov, scales_list, mode, sigma_gaussian=sigma_mov)
+    elif msr_mov_pyr is None or not all(
+            [msr_input_level(mode, ds, sigma_mov) in msr_mov_pyr.keys() for ds in scales_list]):
+        # input levels, the representation is computed after warping (warp_msr_mov)
+        msr_mov_pyr = msr_input_pyramid(img_mov, scales_list, mode, sigma_gaussian=sigma_mov)
     ts_msr_end = time.perf_counter()
-    logging.warning("{:.2f}s elapsed in MSR {} computation".format(ts_msr_end - ts_msr_start, mode))
+    logging.warning("{:.2f}s elapsed in MSR {} pyramids".format(ts_msr_end - ts_msr_start, mode))
     # ------------------------------------------------------------------------------------------------------------------
     iter = 0
     ts_ds_start = time.perf_counter()
-    scales_list = [el[0] for el in iterative_scheme]
-    msr_ref_pyr = compute_pyramid(msr_ref, scales_list)
-    msr_mov_pyr = compute_pyramid(msr_mov, scales_list)
     if debug:
         img_ref_pyr = compute_pyramid(img_ref, scales_list)
         img_mov_pyr = compute_pyramid(img_mov, scales_list)
@@ -282,9 +348,7 @@ def pyramidal_search(
             search_size = iter_conf[3]
         ts_scale_start = time.perf_counter()
         alignment_params = dict(
-            debug=debug,
-            debug_dir=debug_dir,
-            forced_debug_dir=forced_debug_dir, # for cost overview
+            tracer=tracer,
             align_config = AlignmentConfig(
                 downscale=ds,
                 mode=mode,
@@ -299,7 +363,7 @@ def pyramidal_search(
         # ------------------------------------------------------------------------------------------------- Debug images
         if debug:
             ds_img_mov_init = img_mov_pyr[ds]
-            ds_img_mov = motion_model.warp(ds_img_mov_init, downscale=ds)  # register thumbnail based on previous model
+            ds_img_mov = warp_mov(ds_img_mov_init, ds, img_ref_pyr[ds].shape)  # register thumbnail based on previous model
             # debug_trace(ds_img_mov_init, ds, 999, prefix="_image_", suffix= "_mov_original")
             debug_trace(ds_img_mov, ds, iter, prefix="_image_" , suffix="mov_start")
 
@@ -307,11 +371,10 @@ def pyramidal_search(
         # --------------------------------------------------------------------- Downsample multispectral representation
         ts_ds_start = time.perf_counter()
         ds_msr_ref = msr_ref_pyr[ds]
-        ds_msr_mov_init = msr_mov_pyr[ds]
         ts_ds_end = time.perf_counter()
         logging.warning("{:.2f}s elapsed in dowscale {}".format(ts_ds_end - ts_ds_start, ds))
         ts_warp_start = time.perf_counter()
-        ds_msr_mov = motion_model.warp(ds_msr_mov_init, downscale=ds)  # register thumbnail based on previous model
+        ds_msr_mov = warp_msr_mov(ds)  # register thumbnail based on previous model
         ts_warp_end = time.perf_counter()
         logging.warning("{:.2f}s elapsed in warping at scale {}".format(ts_warp_end - ts_warp_start, ds))
         debug_trace(ds_msr_mov, ds, iter, prefix="_msr_", suffix="__start", msr_mode=mode)
@@ -339,14 +402,18 @@ def pyramidal_search(
             # --------------------------------------------------------------------------------------- Debug Vector field
             ax_vector_field = None
             img_mov_reg = None
-            if debug or (id_iter == len(iter_list)-1 and id_scheme==len(iterative_scheme)-1):
-                img_mov_reg = motion_model.warp(img_mov, downscale=1)
-                # debug_trace(img_mov_reg, ds, iter, prefix="FLOW_", suffix="ALIGNED_GLOBALLY", debug_flag=True)
-                displaced_image = warp_from_sparse_vector_field(img_mov_reg, vector_field)
-                # np.save(osp.join(forced_debug_dir, "local_displacement"), {"img":img_mov_reg, "vector_field":vector_field})
-                debug_trace(displaced_image, ds, iter, prefix="FLOW_", suffix="WARP_LOCAL", debug_flag=True)
+            last_iteration = id_iter == len(iter_list)-1 and id_scheme == len(iterative_scheme)-1
+            if tracer.saving(TRACE_ALL) or (last_iteration and tracer.saving(TRACE_MANDATORY)):
+                img_mov_reg = warp_mov(img_mov, 1, img_ref.shape)
+                # debug_trace(img_mov_reg, ds, iter, prefix="FLOW_", suffix="ALIGNED_GLOBALLY", level=TRACE_MANDATORY)
+                debug_trace(
+                    lambda: warp_from_sparse_vector_field(img_mov_reg, vector_field), ds, iter,
+                    prefix="FLOW_", suffix="WARP_LOCAL", level=TRACE_MANDATORY
+                )
+            elif debug:
+                img_mov_reg = warp_mov(img_mov, 1, img_ref.shape)  # displayed with the vector field
             if debug:
-                fig = plt.figure(figsize=(img_mov.shape[:2][::-1]), dpi=1)
+                fig = plt.figure(figsize=(img_ref.shape[:2][::-1]), dpi=1)
                 ax_vector_field = fig.add_subplot(111)
 
             motion_model_residual = MotionModelHomography(
@@ -362,37 +429,36 @@ def pyramidal_search(
             if debug:
                 debug_trace(
                     ax_vector_field, ds, iter,
-                    prefix="FLOW_", suffix="VECTOR_FIELD_GLOBAL_ALIGNED", debug_flag=True
+                    prefix="FLOW_", suffix="VECTOR_FIELD_GLOBAL_ALIGNED", level=TRACE_MANDATORY
                 )
             logging.info("iteration {} - {}".format(iter, motion_model_residual))
             motion_model.compose(motion_model_residual)
 
             # ----------------------------------------------    WARP   -------------------------------------------------
             # ----------------------------------------------------------------------------------------------- MSR images
-            ds_msr_mov = motion_model.warp(ds_msr_mov_init, downscale=ds)
-            debug_trace(ds_msr_mov, ds, iter, prefix="_msr_", suffix="_alignment", msr_mode=mode, debug_flag=True)
+            ds_msr_mov = warp_msr_mov(ds)
+            debug_trace(ds_msr_mov, ds, iter, prefix="_msr_", suffix="_alignment", msr_mode=mode, level=TRACE_MANDATORY)
             # @TODO: every once in a while, we could warp the full res image...
 
             # --------------------------------------------------------------------------------------------- Debug images
             if debug:
-                ds_img_mov = motion_model.warp(ds_img_mov_init, downscale=ds)
-                debug_trace(ds_img_mov, ds, iter, prefix="_image_", suffix="alignment")
-                out_img = motion_model.warp(img_mov, downscale=1)
-                debug_trace(out_img, ds, iter, prefix="FULL_RES_ALIGN_", debug_flag=True)
+                debug_trace(lambda: warp_mov(ds_img_mov_init, ds, img_ref_pyr[ds].shape), ds, iter, prefix="_image_", suffix="alignment")
+                debug_trace(lambda: warp_mov(img_mov, 1, img_ref.shape), ds, iter, prefix="FULL_RES_ALIGN_")
             ts_iter_end = time.perf_counter()
             logging.warning("{:.2f}s elapsed at scale {} - iter {}".format(ts_iter_end - ts_iter_start, ds, iter))
-        debug_trace(ds_msr_ref, ds, iter, prefix="_msr_", suffix="_ref", msr_mode=mode, debug_flag=True)
+            # the residual model is fitted on the full resolution vector field: full resolution corners
+            if early_stop is not None and corners_displacement(motion_model_residual.model, img_ref_shape) < early_stop:
+                logging.warning("converged at scale {} - iter {}".format(ds, iter))
+                break
+        debug_trace(ds_msr_ref, ds, iter, prefix="_msr_", suffix="_ref", msr_mode=mode, level=TRACE_MANDATORY)
         if debug:
-            ds_img_ref = img_ref_pyr[ds]
-            debug_trace(ds_img_ref, ds, iter, prefix="_image_", suffix= "ref")
+            debug_trace(img_ref_pyr[ds], ds, iter, prefix="_image_", suffix="ref")
         ts_scale_end = time.perf_counter()
         logging.warning("{:.2f}s elapsed at scale {}".format(ts_scale_end - ts_scale_start, ds))
         iter +=1
     ts_end = time.perf_counter()
     logging.warning("\tTOTAL {:.2f}s elapsed for iterative scheme {}".format(ts_end - ts_start, iterative_scheme))
-    if debug:
-        out_img = motion_model.warp(img_mov, downscale=1)
-        pr.Image(out_img).save(osp.join(forced_debug_dir, "FULLRES_REGISTERED_REFINED.jpg"))
+    tracer.image(TRACE_ALL, "FULLRES_REGISTERED_REFINED.jpg", lambda: warp_mov(img_mov, 1, img_ref.shape))
     return motion_model
 
 
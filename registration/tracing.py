@@ -0,0 +1,76 @@
+"""
+Debug traces of the alignment (coarse search, cost surfaces, pyramidal search).
+Trace levels:
+- TRACE_OFF: production mode, no trace at all and no extra computation
+- TRACE_MANDATORY: a few overview traces written to the traces folder (cost overviews, MSR alignments, local warp)
+- TRACE_ALL: all traces (debug images at every scale & iteration, single cost surfaces, vector fields)
+Traces are produced lazily: images are passed as callables which are evaluated only if their level is enabled.
+"""
+import os.path as osp
+import matplotlib.pyplot as plt
+import irdrone.process as pr
+
+TRACE_OFF, TRACE_MANDATORY, TRACE_ALL = 0, 1, 2
+
+
+class Tracer:
+    def __init__(self, level=TRACE_OFF, folder=None):
+        """
+        :param level: maximum level of the traces to produce
+        :param folder: traces folder. When None with TRACE_ALL, traces are shown but not saved.
+        """
+        self.level = level
+        self.folder = folder
+
+    @staticmethod
+    def from_debug_flags(debug=False, debug_dir=None):
+        """Legacy debug flags
+        - debug_dir=None, debug=True,  # -> SHOW TRACES, NOT SAVING ANYTHING TO DISK
+        - debug_dir=None, debug=False,  # -> NO TRACES AT ALL, NOT SAVING ANYTHING TO DISK
+        - debug_dir=debug_dir, debug=False, # -> FORCE ONLY MANDATORY TRACES
+        - debug_dir=debug_dir, debug=True, # -> FORCE ALL TRACES TO DISK
+        """
+        if debug:
+            return Tracer(level=TRACE_ALL, folder=debug_dir)
+        if debug_dir is not None:
+            return Tracer(level=TRACE_MANDATORY, folder=debug_dir)
+        return Tracer(level=TRACE_OFF)
+
+    def enabled(self, level=TRACE_ALL):
+        return level != TRACE_OFF and self.level >= level
+
+    def saving(self, level=TRACE_ALL):
+        """Traces of this level are written to disk"""
+        return self.enabled(level) and self.folder is not None
+
+    def path(self, name):
+        return None if self.folder is None else osp.join(self.folder, name)
+
+    def image(self, level, name, img):
+        """Save a debug image
+        :param img: image or callable returning the image (evaluated only when the trace is saved)
+        """
+        if not self.saving(level):
+            return
+        pr.Image(img() if callable(img) else img).save(self.path(name))
+
+    def figure(self, level, name):
+        """Save the current matplotlib figure"""
+        if not self.saving(level):
+            return
+        plt.savefig(self.path(name))
+
+    @property
+    def debug(self):
+        """Legacy debug flag"""
+        return self.enabled(TRACE_ALL)
+
+    @property
+    def debug_dir(self):
+        """Legacy debug_dir for all traces"""
+        return self.folder if self.enabled(TRACE_ALL) else None
+
+    @property
+    def forced_debug_dir(self):
+        """Legacy forced_debug_dir for mandatory traces"""
+        return self.folder if self.enabled(TRACE_MANDATORY) else None
@@ -5,10 +5,54 @@ root = osp.join(osp.dirname(__file__), "..")
 sys.path.append(root)
 import numpy as np
 import logging
-from scipy.interpolate import interp2d
 import cv2
+import hashlib
+from scipy.interpolate import bisplrep
 import irdrone.process as pr
 
+_UNDISTORTION_MAPS = dict()  # in memory cache of fixed point undistortion maps, per process
+
+
+def linear_interpolation_weights(coords, nodes):
+    """
+    Linear interpolation matrix from regularly sorted nodes to coords (constant extrapolation outside of the nodes).
+    :param coords: (n,) positions to interpolate at
+    :param nodes: (m,) sorted node positions
+    :return: (n, m) float32 weights, interpolated = weights . values
+    """
+    weights = np.zeros((len(coords), len(nodes)), dtype=np.float32)
+    if len(nodes) == 1:
+        weights[:, 0] = 1.
+        return weights
+    coords_clamped = np.clip(coords, nodes[0], nodes[-1])
+    idx = np.clip(np.searchsorted(nodes, coords_clamped, side="right") - 1, 0, len(nodes) - 2)
+    alpha = (coords_clamped - nodes[idx]) / (nodes[idx + 1] - nodes[idx])
+    rows = np.arange(len(coords))
+    weights[rows, idx] = 1. - alpha
+    weights[rows, idx + 1] = alpha
+    return weights
+
+
+def upsample_vector_field_component(x_coords, y_coords, vf, coord_x, coord_y):
+    """
+    Dense displacement from a sparse vector field component sampled at (x_coords, y_coords) block centers.
+    Same degree 1 tensor product spline as the former scipy interp2d (bisplrep with s=0, constant extrapolation),
+    evaluated in a separable way in float32: W_y . C . W_x^T
+    Falls back to bilinear interpolation between block centers when there is a single row or column of blocks.
+    :return: (len(coord_y), len(coord_x)) float32 displacement
+    """
+    y_n, x_n = vf.shape
+    if x_n >= 2 and y_n >= 2:
+        knots_x, knots_y, coeffs, _, _ = bisplrep(x_coords, y_coords, vf.ravel(), kx=1, ky=1, s=0.0)
+        nodes_x, nodes_y = knots_x[1:-1], knots_y[1:-1]
+        coeffs = coeffs[:len(nodes_x)*len(nodes_y)].reshape(len(nodes_x), len(nodes_y)).T
+    else:
+        nodes_x, nodes_y = np.array(x_coords[:x_n]), np.array(y_coords[::x_n])
+        coeffs = vf
+    weights_x = linear_interpolation_weights(coord_x, nodes_x)
+    weights_y = linear_interpolation_weights(coord_y, nodes_y)
+    return np.dot(np.dot(weights_y, coeffs.astype(np.float32)), weights_x.T)
+
 
 def warp_from_sparse_vector_field(img, vector_field, debug=False, get_remap=False, padding=None):
     """
@@ -39,20 +83,20 @@ def warp_from_sparse_vector_field(img, vector_field, debug=False, get_remap=Fals
             y_coords.append(y_center)
     vf_x = -vector_field[:, :, 0]
     vf_y = -vector_field[:, :, 1]
-    vf_x_interpolator = interp2d(x_coords, y_coords, vf_x)
-    vf_y_interpolator = interp2d(x_coords, y_coords, vf_y)
-    coord_continuous_x, coord_continuous_y = np.linspace(0, x_s, x_s, endpoint=True), np.linspace(0, y_s, y_s, endpoint=True)
-    displacement_x = vf_x_interpolator(coord_continuous_x, coord_continuous_y)
-    displacement_y = vf_y_interpolator(coord_continuous_x, coord_continuous_y)
-    xx, yy = np.meshgrid(coord_continuous_x, coord_continuous_y)
+    coord_continuous_x = np.linspace(0, x_s, x_s, endpoint=True).astype(np.float32)
+    coord_continuous_y = np.linspace(0, y_s, y_s, endpoint=True).astype(np.float32)
+    displacement_x = upsample_vector_field_component(x_coords, y_coords, vf_x, coord_continuous_x, coord_continuous_y)
+    displacement_y = upsample_vector_field_component(x_coords, y_coords, vf_y, coord_continuous_x, coord_continuous_y)
+    # identity grid added by broadcasting (no full size meshgrid)
+    xx, yy = coord_continuous_x[np.newaxis, :], coord_continuous_y[:, np.newaxis]
     if get_remap:
         # import matplotlib.pyplot as plt
         # plt.plot([pad_x, x_s-pad_x, x_s-pad_x,  pad_x, pad_x], [pad_y, pad_y, y_s - pad_y, y_s-pad_y, pad_y], "b-")
         # plt.imshow(displacement_x)
         # plt.plot(x_coords, y_coords, ".r")
         # plt.show()
-        return (xx+displacement_x).astype(np.float32), (yy+displacement_y).astype(np.float32)
-    img_w = cv2.remap(img, (xx+displacement_x).astype(np.float32), (yy+displacement_y).astype(np.float32), interpolation=cv2.INTER_LINEAR)
+        return xx+displacement_x, yy+displacement_y
+    img_w = cv2.remap(img, xx+displacement_x, yy+displacement_y, interpolation=cv2.INTER_LINEAR)
     if debug:
         pr.show(
             [
@@ -137,6 +181,69 @@ def warp(im, cal, homog, outsize=None, vector_field=None, padding=None):
     )
     return out
 
+
+def undistortion_maps(cal, outsize, cache_folder=None):
+    """
+    Fixed point (CV_16SC2) undistortion maps of a camera, cached in memory.
+    The calibration and the output size never change during a mission so maps are computed only once.
+    :param cal: calibration dictionary (mtx, dist)
+    :param outsize: (width, height)
+    :param cache_folder: if provided, maps are also persisted as .npy (memory mapped when re-loaded) in this folder
+    :return: map_xy, map_interpolation to be used with cv2.remap
+    """
+    key = hashlib.sha1(
+        np.ascontiguousarray(cal["mtx"], dtype=np.float64).tobytes() +
+        np.ascontiguousarray(cal["dist"], dtype=np.float64).tobytes() +
+        np.array(outsize, dtype=np.int64).tobytes()
+    ).hexdigest()[:16]
+    if key in _UNDISTORTION_MAPS:
+        return _UNDISTORTION_MAPS[key]
+    maps_paths = None
+    if cache_folder is not None:
+        maps_paths = [osp.join(cache_folder, "undistortion_maps_{}_{}.npy".format(key, name)) for name in ["xy", "interp"]]
+    maps = None
+    if maps_paths is not None and all([osp.isfile(pth) for pth in maps_paths]):
+        try:
+            maps = tuple([np.load(pth, mmap_mode="r") for pth in maps_paths])
+        except (ValueError, OSError) as exc:
+            logging.warning("cannot load undistortion maps {}, computing them again: {}".format(cache_folder, exc))
+    if maps is None:
+        map_x, map_y = cv2.initUndistortRectifyMap(
+            cal["mtx"], cal["dist"], np.eye(3, 3), cal["mtx"], outsize, cv2.CV_32FC1
+        )
+        maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        if maps_paths is not None:
+            try:
+                for pth, mp in zip(maps_paths, maps):
+                    # write aside then rename so that a concurrent reader never memory maps a partial file
+                    tmp_pth = "{}.{}.tmp".format(pth, os.getpid())
+                    with open(tmp_pth, "wb") as tmp_file:
+                        np.save(tmp_file, mp)
+                    os.replace(tmp_pth, pth)
+            except OSError as exc:
+                logging.warning("cannot save undistortion maps {}: {}".format(cache_folder, exc))
+    _UNDISTORTION_MAPS[key] = maps
+    return maps
+
+
+def undistort(im_list, cal, cache_folder=None):
+    """
+    Undistort several images of the same camera (same size) with shared cached maps.
+    Equivalent to warp(im, cal, np.eye(3)) for each image.
+    """
+    im_list = [im if not isinstance(im, pr.Image) else im.data for im in im_list]
+    outsize = (im_list[0].shape[1], im_list[0].shape[0])
+    map_xy, map_interp = undistortion_maps(cal, outsize, cache_folder=cache_folder)
+    return [
+        cv2.remap(
+            im, map_xy, map_interp,
+            interpolation=cv2.INTER_CUBIC,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=(0, 0, 0, 0)
+        ) for im in im_list
+    ]
+
+
 if __name__ == "__main__":
     import sys
     import os.path as osp
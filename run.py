@@ -20,6 +20,7 @@ from pathlib import Path
 from typing import List, Optional, Tuple, Union
 
 import automatic_registration
+import irdrone.process as pr
 import offset_angles
 import utils.angles_analyzis as analys
 import utils.utils_IRdrone as IRd
@@ -219,15 +220,21 @@ def image_processing_engine(ImgMatchProcess: List[Tuple[Path, Path]], ptsProcess
         if traces is None:
             traces = automatic_registration.TRACES
     nbImgProcess = len(ptsProcess)
+    workers = max(1, configuration.get("workers", 1))
     print(Style.YELLOW + 'WARNING : The processing of these %i images will take %.2f h.  Do you want to continue?'
-          % (nbImgProcess, 1.5 * nbImgProcess / 60.) + Style.RESET)
+          % (nbImgProcess, 1.5 * nbImgProcess / 60. / workers) + Style.RESET)
     autoRegistration = IRd.answerYesNo('Yes (y/1) |  No (n/0):')
     if autoRegistration:
+        if not configuration.get("clean_proxy", False):
+            # clean_proxy removes proxies pair by pair, pre-converting the whole mission would defeat its purpose
+            print(Style.CYAN + 'INFO : ------ Batch RAW conversion \n' + Style.RESET)
+            pr.batch_convert_raw([pth for pair in ImgMatchProcess for pth in pair], workers=max(2, workers))
         print(Style.CYAN + 'INFO : ------ Automatic_registration.process_raw_pairs \n' + Style.RESET)
         automatic_registration.process_raw_pairs(
                 ImgMatchProcess, out_dir=configuration["out_images_folder"], crop=CROP, listPts=ptsProcess,
-                option_alti=configuration['option_alti'], clean_proxy=configuration.get("clean_proxy", False), multispectral_folder=odm_image_directory,
-                traces=traces
+                option_alti=configuration['option_alti'], clean_proxy=configuration.get("clean_proxy", False), proxy_budget=configuration.get("proxy_budget", None), multispectral_folder=odm_image_directory,
+                traces=traces, workers=workers, queue_depth=configuration.get("queue_depth", None),
+                warm_start=configuration.get("warm_start", False)
             )
     else:
         print(
@@ -314,12 +321,16 @@ def configure(args: argparse.Namespace) -> dict:
     options = dict(
         config_file=args.config,                        # config file (json or excel)
         working_directory=os.path.dirname(args.config), # mission directory
-        clean_proxy = args.clean_proxy,                 # flag to clean temporary data
+        clean_proxy = args.clean_proxy or args.proxy_budget is not None, # flag to clean temporary data
+        proxy_budget=None if args.proxy_budget is None else int(args.proxy_budget * 1e9), # proxies disk budget in bytes per source folder (LRU eviction)
         odm_multispectral=args.odm_multispectral,       # flag to save 4 multispectral tifs per pair & enable ODM multispectral mode, True by default
         disable_altitude_api=args.disable_altitude_api, # disable calls to IGN API (not recommended), False by default
         traces=args.traces,                             # list of traces
-        offset=args.offset,                             # ["manual", "auto"] default manual
-        selection=args.selection                        # pairs sub-selection, by default all. best-mapping is recommended for the right c
+        offset=args.offset,                             # ["manual", "auto"] default auto
+        selection=args.selection,                       # pairs sub-selection, by default all. best-mapping is recommended for the right c
+        workers=args.workers,                           # number of parallel processes to align pairs, 1 by default
+        queue_depth=args.queue_depth,                   # pipeline decode / align / write with bounded queues (single worker), 2 by default
+        warm_start=args.warm_start                      # seed each pair alignment with the previous pair motion model, False by default
     )
     # --------------------------------------------------------------------------
     #                    options       (for rapid tests and analysis)
@@ -355,6 +366,7 @@ def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Process pre-synchronized multispectral aerial data')
     parser.add_argument('--config', type=str, help='path to the flight configuration')
     parser.add_argument('--clean-proxy', action="store_true", help='clean proxy tif files to save storage')
+    parser.add_argument('--proxy-budget', type=float, default=None, help='keep proxy files up to this disk budget (in GB) per source folder (visible and NIR folders each get this budget), least recently used proxies are cleaned first')
     parser.add_argument('--disable-altitude-api', action="store_true", help='force not using altitude from IGN API')
     parser.add_argument('--odm-multispectral', default=True, action="store_true", help='ODM multispectral export')
     parser.add_argument('--traces', default=None, choices=automatic_registration.TRACES, nargs="+", 
@@ -364,7 +376,10 @@ def parse_arguments() -> argparse.Namespace:
         help= 'best-synchro: only pick pairs of images with gap < 1/4th of the TimeLapseDJI interval ~ 0.5 seconds'
         + 'best-mapping: select best synchronized images + granting a decent overlap'
     )
-    parser.add_argument('--offset', type=str, default="manual", choices=["manual", "auto"],  help='offset angles choice - auto allows pre-computing offsets')
+    parser.add_argument('--offset', type=str, default="auto", choices=["manual", "auto"],  help='offset angles choice - auto pre-computes offsets (coarse angles only alignment on reduced resolution RAW decodings), manual uses the flight configuration offsets')
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel processes to align pairs (one pair per process)')
+    parser.add_argument('--queue-depth', type=int, default=2, help='overlap decoding, alignment and writing of consecutive pairs. 0 disables the pipeline. bounds memory usage')
+    parser.add_argument('--warm-start', action="store_true", help='seed each pair alignment with the previous pair (restricted search, full search fallback). single worker only')
     args = parser.parse_args()
 
     if args.config is None or not os.path.isfile(args.config):
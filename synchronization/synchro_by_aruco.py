@@ -60,6 +60,11 @@ def prepare_synchronization_data(
             candidates = ut.imagepath(imgname=extension, dirname=folder)
             assert candidates is not None and len(candidates)>5, \
                 "Cannot find enough images in {}/{}".format(folder, extension)
+            if not clean_proxy:
+                pr.batch_convert_raw([
+                    img_pth for index, img_pth in enumerate(candidates)
+                    if not osp.isfile(osp.join(out_dir, "_detection" + ("_%04d_" % (index)) + osp.basename(img_pth)[:-4] + ".npy"))
+                ])
             for index, img_pth in enumerate(candidates):
                 date = pr.Image(img_pth).date
                 img_name = ("_%04d_" % (index)) + osp.basename(img_pth)[:-4]
@@ -128,7 +128,8 @@ def test_applycm(block=False,  display=DISPLAY):
         plt.show()
 
 
-def test_imagepipe(display=DISPLAY):
+def test_imagepipe(tmp_path, monkeypatch, display=DISPLAY):
+    monkeypatch.chdir(tmp_path)  # save() writes _saved_image_*.jpg in the current directory
     ipBasicPipe = imagepipe.ImagePipe(
         [utils.testimage(xsize=400, ysize=400),],
         winname="Basic single image processing",
@@ -145,6 +146,23 @@ def test_imagepipe(display=DISPLAY):
     }
     ipBasicPipe.set(**forcedparams)
     ipBasicPipe.save()
+    assert len(list(tmp_path.glob("_saved_image_*.jpg"))) == 1
+
+
+def test_imagepipe_float_inputs_not_mutated():
+    """
+    A float pipe with in place process blocks neither modifies the caller's images
+    nor the pipe inputs read by the next blocks, float32 precision is preserved.
+    """
+    mix = imagepipe.ColorMix("MIX", slidersName=["blue", "green", "red"], vrange=(0., 3., 2.))
+    sub = imagepipe.Add("SUB", inputs=[0, 1], vrange=(-1., 1., -1.))  # 2 * input - input
+    img = np.random.rand(40, 60, 3).astype(np.float32)
+    img_orig = img.copy()
+    ip = imagepipe.ImagePipe([img], sliders=[mix, sub], floatpipe=True, jupyter=False)
+    out = ip.engine([img])
+    assert np.array_equal(img, img_orig)
+    assert out.dtype == np.float32
+    assert np.allclose(out, img_orig)
 
 
 
@@ -196,4 +214,762 @@ def test_signalplot():
         winname="Basic LINEAR DOMAIN single image processing",
         rescale=2.
     )
-    ipBasicLinPipe.gui()
\ No newline at end of file
+    ipBasicLinPipe.gui()
+
+def test_proxy_cache_lru(tmp_path):
+    """
+    Proxies are evicted least recently used first when releasing them over budget,
+    proxies of a modified source are stale.
+    """
+    from irdrone.proxy_cache import ProxyCache
+    cache = ProxyCache(str(tmp_path))
+    sources, proxies = [], []
+    for index in range(3):
+        src = tmp_path / f"IMG_{index}.DNG"
+        src.write_bytes(b"raw")
+        prx = tmp_path / f"IMG_{index}_RawTherapee.tif"
+        prx.write_bytes(b"0" * 100)
+        sources.append(str(src))
+        proxies.append([str(prx)])
+        cache.touch(sources[-1], proxies[-1])
+    cache.touch(sources[0], proxies[0])  # IMG_1 is now the least recently used
+    cache.release(sources[2], proxies[2], budget=250)
+    assert [os.path.isfile(prx[0]) for prx in proxies] == [True, False, True]
+    with open(sources[0], "ab") as fi:
+        fi.write(b"modified")
+    cache.validate(sources[0], proxies[0])
+    assert not os.path.isfile(proxies[0][0])
+    assert os.path.isfile(proxies[2][0])
+
+
+def test_proxy_cache_ownership(tmp_path):
+    """
+    The index is only created when the cache is used, proxies acquired by a live process are not evicted,
+    a lock is only removed by its owner (or when its owner is dead).
+    """
+    import subprocess
+    from irdrone.proxy_cache import ProxyCache
+    cache = ProxyCache(str(tmp_path))
+    sources, proxies = [], []
+    for index in range(3):
+        src = tmp_path / f"IMG_{index}.DNG"
+        src.write_bytes(b"raw")
+        prx = tmp_path / f"IMG_{index}_RawTherapee.tif"
+        prx.write_bytes(b"0" * 100)
+        sources.append(str(src))
+        proxies.append([str(prx)])
+    cache.validate(sources[0], proxies[0])
+    cache.release(sources[0], proxies[0], budget=0)
+    assert not cache.in_use() and not os.path.isfile(proxies[0][0])
+    (tmp_path / "IMG_0_RawTherapee.tif").write_bytes(b"0" * 100)  # converted again
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    cache.acquire(sources[0], proxies[0])  # in flight in this process
+    cache.acquire(sources[1], proxies[1])
+    with cache.locked_index() as index:
+        index[os.path.abspath(sources[1])]["readers"] = [dead.pid]  # worker killed while processing IMG_1
+    cache.release(sources[2], proxies[2], budget=200)
+    assert [os.path.isfile(prx[0]) for prx in proxies] == [True, False, True]
+    with open(cache.lock_path, "w") as fi:
+        fi.write(f"{dead.pid} token")  # stale lock of a dead process
+    with cache.locked_index():
+        with open(cache.lock_path, "w") as fi:
+            fi.write(f"{os.getpid()} other_token")  # lock taken over meanwhile
+    assert cache.lock_owner() == f"{os.getpid()} other_token"
+    os.remove(cache.lock_path)
+
+
+def test_npy_proxy(tmp_path):
+    """
+    Memory mapped proxies match the linear data they were saved from, regions are converted on access only.
+    """
+    linear_data = np.random.rand(30, 40, 3)
+    for proxy_format, tolerance in [("uint16", 1./(2**16-1)), ("float16", 1.E-3)]:
+        pth = str(tmp_path / f"IMG_RawTherapee_{proxy_format}.npy")
+        process.save_npy_proxy(pth, linear_data, proxy_format=proxy_format, black_point=0.25)
+        proxy = process.ProxyArray(pth)
+        assert proxy.shape == linear_data.shape
+        assert np.allclose(np.asarray(proxy), linear_data - 0.25, atol=tolerance)
+        region = proxy[::8, 10:20, :]
+        assert region.dtype == np.float32
+        assert np.allclose(region, linear_data[::8, 10:20, :] - 0.25, atol=tolerance)
+
+
+def test_metadata_index(tmp_path):
+    """
+    Image metadata are read from the index, modified images are parsed again.
+    """
+    import irdrone.metadata_index as metadata_index
+    img_pth = tmp_path / "sample.jpg"
+    process.Image(utils.testimage(xsize=64, ysize=48)).save(str(img_pth))
+    metadata_index.put([(str(img_pth), {"date": "indexed", "camera": {"maker": "irdrone"}})])
+    img = process.Image(str(img_pth))
+    assert img.date == "indexed" and img.camera["maker"] == "irdrone" and img.gps is None
+    img_pth.touch()
+    os.utime(img_pth, (0, 0))
+    assert metadata_index.get(str(img_pth)) is None
+    assert process.Image(str(img_pth)).date is None
+    assert metadata_index.get(str(img_pth)) is None  # no EXIF: failed parsing is not indexed
+    sample = utils.imagepath(imgname="*IR760*")[0]
+    db_path = metadata_index.index_path(sample)
+    assert metadata_index.get(sample) is None and not os.path.isfile(db_path)  # reads never create the index
+    date = process.Image(sample).date
+    assert date is not None and metadata_index.get(sample)["date"] == date
+    os.remove(db_path)
+
+
+def test_cost_surfaces_engines():
+    """
+    Fast cost engines return the same cost surfaces as the brute force numba implementation.
+    """
+    from registration.cost import compute_cost_surfaces, compute_cost_surfaces_fast, SSD, NTG
+    ref = np.random.rand(60, 80, 4)
+    mov = np.random.rand(60, 80, 4)
+    for dist_mode in [SSD, NTG]:
+        for y_n, x_n, search in [(2, 3, 3), (1, 1, 6)]:
+            costs, centers, patch_coords = compute_cost_surfaces(ref, mov, y_n=y_n, x_n=x_n, search_y=search, search_x=search, dist_mode=dist_mode)
+            for parallel_patches in [True, False]:  # both NTG kernels, whatever the number of threads
+                costs_fast, centers_fast, patch_coords_fast = compute_cost_surfaces_fast(
+                    ref, mov, y_n=y_n, x_n=x_n, search_y=search, search_x=search, dist_mode=dist_mode,
+                    parallel_patches=parallel_patches
+                )
+                assert costs_fast.shape == costs.shape
+                assert np.allclose(costs_fast, costs, rtol=1.E-4)
+                assert np.allclose(centers_fast, centers) and np.allclose(patch_coords_fast, patch_coords)
+
+
+def test_pyramid():
+    """
+    Only the requested pyramid levels are stored, in float32, at ceil(size / downscale).
+    """
+    from registration.pyramid import compute_pyramid
+    img = np.random.rand(100, 150, 4)
+    pyr = compute_pyramid(img, [4, 16])
+    assert sorted(pyr.keys()) == [4, 16]
+    assert pyr[4].shape == (25, 38, 4) and pyr[16].shape == (7, 10, 4)
+    assert all([lvl.dtype == np.float32 for lvl in pyr.values()])
+    assert compute_pyramid(np.random.rand(100, 150, 1), [2])[2].shape == (50, 75, 1)
+
+
+def test_msr_pyramid_at_level():
+    """
+    Laplacian energies computed on the downsampled image match the downsampled full resolution energies.
+    """
+    from registration.pyramid import msr_pyramid
+    from registration.constants import LAPLACIAN_ENERGIES
+    img = process.Image(utils.imagepath(imgname="*FullSpectrum*")[0]).data
+    for sigma in [1., 5.]:
+        msr_full = msr_pyramid(img, [4, 16, 32], LAPLACIAN_ENERGIES, sigma_gaussian=sigma, at_level=False)
+        msr_level = msr_pyramid(img, [4, 16, 32], LAPLACIAN_ENERGIES, sigma_gaussian=sigma)
+        for ds in [4, 16, 32]:
+            assert msr_level[ds].shape == msr_full[ds].shape
+            assert np.corrcoef(msr_level[ds].ravel(), msr_full[ds].ravel())[0, 1] > 0.9
+
+
+def test_msr_pyramid_baseline_pair():
+    """
+    On a real visible / NIR pair, the at level Laplacian energies and the baseline implementation
+    (full resolution energies reduced by skimage pyramid_gaussian) find the same coarse translation.
+    """
+    from skimage import transform
+    from registration.pyramid import msr_pyramid
+    from registration.cost import multispectral_representation, compute_cost_surfaces_fast
+    from registration.constants import LAPLACIAN_ENERGIES, NTG
+
+    def baseline_msr_pyramid(img, ds, sigma):
+        msr = multispectral_representation(img, sigma_gaussian=sigma, mode=LAPLACIAN_ENERGIES).astype(np.float32)
+        for ids, resized in enumerate(transform.pyramid_gaussian(msr, downscale=2, channel_axis=-1)):
+            if 2**ids == ds:
+                return resized.astype(np.float32)
+
+    ref = process.Image(utils.imagepath(imgname="*FullSpectrum*")[0]).data
+    mov = process.Image(utils.imagepath(imgname="*IR760*")[0]).data
+    margin, (dy, dx), ds, search = 256, (64, -96), 16, 12
+    ref = ref[margin:-margin, margin:-margin]
+    mov = mov[margin+dy:margin+dy+ref.shape[0], margin+dx:margin+dx+ref.shape[1]]
+    shifts = []
+    for msr_ref, msr_mov in [
+        (baseline_msr_pyramid(ref, ds, 5.), baseline_msr_pyramid(mov, ds, 3.)),
+        (msr_pyramid(ref, [ds], LAPLACIAN_ENERGIES, sigma_gaussian=5.)[ds],
+         msr_pyramid(mov, [ds], LAPLACIAN_ENERGIES, sigma_gaussian=3.)[ds]),
+    ]:
+        costs, _, _ = compute_cost_surfaces_fast(
+            msr_ref, msr_mov, y_n=1, x_n=1, search_y=search, search_x=search, dist_mode=NTG
+        )
+        v, u = np.unravel_index(np.argmin(costs[0, 0].sum(axis=-1)), costs.shape[2:4])
+        shifts.append((v - search, u - search))
+    assert shifts[0] == shifts[1] == (dy // ds, dx // ds)
+
+
+def test_pyramidal_search_mov_warp():
+    """
+    pyramidal_search on the unwarped fisheye NIR image (mov_warp) warps grayscale levels before the MSR:
+    the representation matches the MSR of the full resolution warped image (baseline)
+    and both find the residual homography of a synthetic fisheye image.
+    """
+    import cv2
+    from registration import rigid
+    from registration.pyramid import msr_pyramid, msr_input_pyramid, warped_msr, pyramid_shape
+    from registration.constants import LAPLACIAN_ENERGIES, NTG
+    from irdrone.semi_auto_registration import rotation_warp, rotation_homography
+    img = process.Image(utils.imagepath(imgname="*FullSpectrum*")[0]).data
+    ref = (cv2.resize(img, (img.shape[1]//4, img.shape[0]//4), interpolation=cv2.INTER_AREA) / 255.).astype(np.float32)
+    refcalib = dict(mtx=np.array([[750., 0., 504.], [0., 750., 378.], [0., 0., 1.]]), dist=np.zeros(5))
+    movingcalib = dict(mtx=np.array([[600., 0., 500.], [0., 600., 380.], [0., 0., 1.]]),
+                       dist=np.array([-0.25, 0.06, 0., 0., 0.]))
+    # synthetic fisheye NIR image: each moving camera pixel sees the reference through the true rotation
+    angles_true, angles_coarse = (1., -0.5, 0.3), (1.4, -0.8, 0.3)
+    h_true, _ = rotation_homography(*angles_true, refcalib=refcalib, movingcalib=movingcalib)
+    h_coarse, _ = rotation_homography(*angles_coarse, refcalib=refcalib, movingcalib=movingcalib)
+    grid = np.dstack(np.meshgrid(np.arange(ref.shape[1], dtype=np.float32), np.arange(ref.shape[0], dtype=np.float32)))
+    undistorted = cv2.undistortPoints(grid.reshape(-1, 1, 2), movingcalib["mtx"], movingcalib["dist"], P=movingcalib["mtx"])
+    fisheye_map = cv2.perspectiveTransform(undistorted.astype(np.float64), h_true).reshape(grid.shape).astype(np.float32)
+    mov = cv2.remap(ref, fisheye_map, None, interpolation=cv2.INTER_CUBIC)
+    coarse_warp = rotation_warp(*angles_coarse, refcalib=refcalib, movingcalib=movingcalib)
+    mov_warped = coarse_warp(mov, np.eye(3), 1, (ref.shape[1], ref.shape[0]))
+    for ds in [4, 8]:
+        msr_baseline = msr_pyramid(mov_warped, [ds], LAPLACIAN_ENERGIES, sigma_gaussian=3.)[ds]
+        msr_warped = warped_msr(
+            msr_input_pyramid(mov, [ds], LAPLACIAN_ENERGIES, sigma_gaussian=3.), ds, LAPLACIAN_ENERGIES,
+            lambda img_level, level: coarse_warp(img_level, np.eye(3), level, pyramid_shape(ref.shape, level)[::-1]),
+            sigma_gaussian=3.
+        )
+        assert msr_warped.shape == msr_baseline.shape
+        valid = msr_baseline.sum(axis=-1) > 0
+        assert np.corrcoef(msr_warped[valid].ravel(), msr_baseline[valid].ravel())[0, 1] > 0.95
+    search_params = dict(
+        iterative_scheme=[(8, 2, 4, 6), (4, 2, 5)], mode=LAPLACIAN_ENERGIES, dist=NTG, affinity=False,
+        sigma_ref=5., sigma_mov=3., debug=False
+    )
+    homography_expected = np.dot(h_true, np.linalg.inv(h_coarse))
+    for homography in [
+        rigid.pyramidal_search(ref, mov_warped, **search_params).rescale(),
+        rigid.pyramidal_search(ref, mov, mov_warp=coarse_warp, **search_params).rescale()
+    ]:
+        assert rigid.corners_displacement(np.dot(np.linalg.inv(homography_expected), homography), ref.shape) < 1.5
+
+
+def test_undistortion_maps_cache(tmp_path):
+    """
+    undistort gives the same result as warp(im, cal, np.eye(3)) for each image,
+    also when maps are re-loaded from disk or when the files on disk are corrupted.
+    """
+    import registration.warp_flow as warp_flow
+    cal = dict(mtx=np.array([[120., 0., 80.], [0., 120., 60.], [0., 0., 1.]]), dist=np.array([-0.1, 0.05, 0., 0., 0.]))
+    img_list = [
+        np.random.rand(120, 160, 3).astype(np.float32),
+        np.random.rand(120, 160).astype(np.float32),
+        (255 * np.random.rand(120, 160, 4)).astype(np.uint8),
+    ]
+    ref_list = [warp_flow.warp(img, cal, np.eye(3)) for img in img_list]
+
+    def check_undistort():
+        out_list = warp_flow.undistort(img_list, cal, cache_folder=tmp_path)
+        for out, ref in zip(out_list, ref_list):
+            assert out.shape == ref.shape and out.dtype == ref.dtype
+            assert np.allclose(out, ref, atol=1.E-3 if ref.dtype == np.float32 else 1)
+
+    warp_flow._UNDISTORTION_MAPS.clear()
+    check_undistort()
+    maps_paths = sorted(tmp_path.glob("undistortion_maps_*.npy"))
+    assert len(maps_paths) == 2 and len(list(tmp_path.glob("*.tmp"))) == 0
+    warp_flow._UNDISTORTION_MAPS.clear()
+    check_undistort()
+    maps_paths[0].write_bytes(b"truncated")
+    warp_flow._UNDISTORTION_MAPS.clear()
+    check_undistort()
+    assert isinstance(np.load(maps_paths[0], mmap_mode="r"), np.memmap)
+
+
+def test_coarse_alignment_angles():
+    """
+    Coarse search on thumbnails only returns angles, the initial yaw / pitch error is corrected
+    within a coarse pixel (1/32 of the full resolution).
+    """
+    import cv2
+    from automatic_registration import coarse_alignment
+    img = process.Image(utils.imagepath(imgname="*FullSpectrum*")[0]).data
+    ds = 8
+    thumbnail = cv2.resize(img, (img.shape[1]//ds, img.shape[0]//ds), interpolation=cv2.INTER_AREA)
+    cal = dict(mtx=np.array([[3000., 0., 2016.], [0., 3000., 1512.], [0., 0., 1.]]), dist=np.zeros(5))
+    cals = dict(refcalib=cal, movingcalib=dict(mtx=cal["mtx"].copy(), dist=np.zeros(5)))
+    coarse_pixel = np.rad2deg(32. / cal["mtx"][0, 0])
+    for yaw, pitch in [(2., -1.), (-1.5, 0.5)]:
+        estimation = coarse_alignment(thumbnail, thumbnail, cals, yaw, pitch, 0., downscale=ds)
+        assert estimation["consistent"]
+        assert abs(estimation["yaw"]) < coarse_pixel and abs(estimation["pitch"]) < coarse_pixel
+
+
+def test_manual_warp_variants():
+    """
+    Local & global warps derived from a single shared rotation + distortion map match separate manual warps.
+    """
+    from irdrone.semi_auto_registration import manual_warp, manual_warp_variants, WARP_LOCAL, WARP_GLOBAL
+    refcalib = dict(mtx=np.array([[150., 0., 80.], [0., 150., 60.], [0., 0., 1.]]), dist=np.zeros(5))
+    movingcalib = dict(mtx=np.array([[110., 0., 82.], [0., 110., 61.], [0., 0., 1.]]), dist=np.array([-0.2, 0.05, 0., 0., 0.]))
+    ref = np.zeros((120, 160, 3), dtype=np.float32)
+    mov = np.random.rand(124, 164, 3).astype(np.float32)
+    global_homography = np.array([[1.01, 0.01, 2.], [-0.01, 0.99, -1.], [0., 0., 1.]])
+    local_homography = np.array([[1., 0., 1.], [0., 1., 0.5], [0., 0., 1.]])
+    vector_field = np.random.normal(size=(3, 3, 2))
+    out = manual_warp_variants(
+        ref, mov, 1., -2., 0.5, refcalib=refcalib, movingcalib=movingcalib,
+        global_homography=global_homography, local_homography=local_homography, vector_field=vector_field
+    )
+    local = manual_warp(ref, mov, 1., -2., 0.5, refcalib=refcalib, movingcalib=movingcalib,
+                        refinement_homography=local_homography, vector_field=vector_field)
+    glob = manual_warp(ref, mov, 1., -2., 0.5, refcalib=refcalib, movingcalib=movingcalib,
+                       refinement_homography=global_homography)
+    for variant, expected in [(WARP_LOCAL, local), (WARP_GLOBAL, glob)]:
+        valid = (expected.sum(axis=-1) > 0) * (out[variant].sum(axis=-1) > 0)
+        assert np.median(np.abs(out[variant] - expected)[valid]) < 1.E-2
+    assert list(manual_warp_variants(ref, mov, 1., -2., 0.5, refcalib=refcalib, movingcalib=movingcalib,
+                                     variants=[WARP_GLOBAL]).keys()) == [WARP_GLOBAL]
+    # global homography footprint beyond the shared map padding: same valid area as the separate global warp
+    global_homography = np.array([[1.01, 0.01, 40.], [-0.01, 0.99, -1.], [0., 0., 1.]])
+    out = manual_warp_variants(ref, mov, 1., -2., 0.5, refcalib=refcalib, movingcalib=movingcalib,
+                               global_homography=global_homography, variants=[WARP_GLOBAL])
+    glob = manual_warp(ref, mov, 1., -2., 0.5, refcalib=refcalib, movingcalib=movingcalib,
+                       refinement_homography=global_homography)
+    assert np.array_equal(out[WARP_GLOBAL].sum(axis=-1) > 0, glob.sum(axis=-1) > 0)
+    assert np.allclose(out[WARP_GLOBAL], glob, atol=1.E-2)
+
+
+def test_upsample_vector_field():
+    """
+    Dense displacement interpolates the sparse vector field at block centers and is constant outside.
+    """
+    from registration.warp_flow import upsample_vector_field_component
+    vf = np.random.normal(size=(4, 5))
+    x_nodes, y_nodes = 20. + 40. * np.arange(5), 15. + 30. * np.arange(4)
+    x_coords, y_coords = [el for el in x_nodes] * 4, [el for el in y_nodes for _ in range(5)]
+    dense = upsample_vector_field_component(x_coords, y_coords, vf, x_nodes.astype(np.float32), y_nodes.astype(np.float32))
+    assert dense.dtype == np.float32
+    assert np.allclose(dense, vf, atol=1.E-4)
+    outside = upsample_vector_field_component(x_coords, y_coords, vf, np.array([0., 500.], dtype=np.float32), np.array([0.], dtype=np.float32))
+    assert np.allclose(outside, vf[[0], :][:, [0, -1]], atol=1.E-4)
+
+
+def test_tracer_levels(tmp_path):
+    """
+    Legacy debug flags map to trace levels, lazy traces are evaluated only when their level is enabled.
+    """
+    from registration.tracing import Tracer, TRACE_OFF, TRACE_MANDATORY, TRACE_ALL
+
+    def fail():
+        raise AssertionError("trace should not be computed")
+    assert Tracer.from_debug_flags(debug=False, debug_dir=None).level == TRACE_OFF
+    assert Tracer.from_debug_flags(debug=False, debug_dir=tmp_path).level == TRACE_MANDATORY
+    assert Tracer.from_debug_flags(debug=True, debug_dir=tmp_path).level == TRACE_ALL
+    Tracer(TRACE_OFF, tmp_path).image(TRACE_MANDATORY, "off.jpg", fail)
+    tracer = Tracer(TRACE_MANDATORY, tmp_path)
+    tracer.image(TRACE_ALL, "all.jpg", fail)
+    tracer.image(TRACE_MANDATORY, "mandatory.jpg", lambda: np.zeros((8, 8, 3), dtype=np.uint8))
+    assert [pth.name for pth in tmp_path.iterdir()] == ["mandatory.jpg"]
+
+
+def test_hessian_determinant_maps():
+    """
+    Vectorized Hessian determinants match the quadric approximation of each 3x3 neighborhood.
+    """
+    from registration.newton import quadric_approximation, hessian_determinant_maps
+    cost = np.random.rand(12, 15, 2)
+    det = hessian_determinant_maps(cost)
+    for id_y in range(1, cost.shape[0]-1):
+        for id_x in range(1, cost.shape[1]-1):
+            hessi, _, _ = quadric_approximation(cost[id_y-1:id_y+2, id_x-1:id_x+2])
+            assert np.allclose(det[id_y, id_x, :], np.linalg.det(hessi))
+
+
+def test_minimum_cost_batch():
+    """
+    Batched sub-pixel refinement gives the same displacements as minimum_cost on each cost area.
+    """
+    from registration.rigid import minimum_cost, minimum_cost_batch
+    yy, xx = np.mgrid[-5:6, -5:6]
+    costs = []
+    for _ in range(20):
+        center = np.random.uniform(-6, 6, 2)
+        costs.append(((xx-center[0])**2 + 0.5*(yy-center[1])**2)[..., np.newaxis] * np.random.uniform(0.5, 2., 3)
+                     + np.random.rand(11, 11, 3))
+    costs = np.array(costs)
+    expected = np.array([minimum_cost(cost)[0] for cost in costs])
+    assert np.allclose(minimum_cost_batch(costs), expected)
+
+
+def test_warm_start_consistency():
+    """
+    Restricted coarse search is inconsistent when its minimum reaches the window border
+    or when the cost at the predicted position is much higher than the previous pair cost.
+    """
+    from automatic_registration import coarse_search_consistency, warm_start_seed
+    yy, xx = np.mgrid[-6:7, -6:7]
+    assert coarse_search_consistency(1. + (xx-1)**2 + yy**2, expected_cost=1.)
+    assert not coarse_search_consistency(1. + (xx-5)**2 + yy**2)
+    assert not coarse_search_consistency(1. + (xx-2)**2 + yy**2, expected_cost=1.)
+    seed = warm_start_seed(dict(
+        yaw=1.5, pitch=-0.5, roll=0., homography=np.eye(3), coarse_cost=0.1,
+        initialization={"yaw": 1., "pitch": 0., "roll": 0.}
+    ))
+    assert np.allclose([seed["yaw"], seed["pitch"], seed["roll"]], [0.5, -0.5, 0.])
+    assert warm_start_seed(None) is None
+
+
+def test_frame_cache(tmp_path):
+    """
+    Decoded frames and their derived representations are re-used until evicted or modified,
+    pairs sharing a NIR image are scheduled together.
+    """
+    from irdrone.frame_cache import FrameCache, cached_image, schedule_pairs, group_pairs
+    cache = FrameCache(max_frames=1)
+    paths = []
+    for index in range(2):
+        paths.append(str(tmp_path / f"nir_{index}.jpg"))
+        process.Image(utils.testimage(xsize=64, ysize=48)).save(paths[-1])
+    data = cached_image(paths[0], cache=cache).data
+    assert cached_image(paths[0], cache=cache).data is data
+    cached_image(paths[1], cache=cache)
+    assert cached_image(paths[0], cache=cache).data is not data  # evicted
+    os.utime(paths[0], (0, 0))
+    assert cached_image(paths[0], cache=cache).data is not data  # modified
+    assert (cache.hits, cache.misses) == (1, 4)
+    img = cached_image(paths[0], cache=cache)
+    thumbnail = cache.derived(paths[0], ("thumbnail", 2), lambda: img.data[::2, ::2], data=img.data)
+    assert cache.derived(paths[0], ("thumbnail", 2), lambda: None, data=img.data) is thumbnail
+    assert cache.derived(paths[0], ("thumbnail", 4), lambda: None, data=img.data) is None  # other parameters
+    assert cache.derived(paths[0], ("thumbnail", 2), lambda: None, data=img.data.copy()) is None  # other decoding
+    assert cache.derived(paths[1], ("thumbnail", 2), lambda: None) is None  # frame not cached
+    assert cache.derived_hits == 1
+    pairs = [("v0", "n0"), ("v1", "n1"), ("v2", "n0"), ("v3", "n2"), ("v4", "n1")]
+    assert schedule_pairs(pairs) == [0, 2, 1, 4, 3]
+    assert group_pairs(pairs) == [[0, 2], [1, 4], [3]]
+
+
+def test_thumbnail_from_proxy(tmp_path):
+    """
+    Thumbnails of RAW images are read from the memory mapped npy proxy without decoding the full image.
+    """
+    raw_pth = str(tmp_path / "DJI_0001.DNG")
+    with open(raw_pth, "wb") as fi:
+        fi.write(b"raw")
+    linear_data = np.random.rand(64, 960, 3)
+    process.save_npy_proxy(process.cached_npy(raw_pth), linear_data, proxy_format="float16")
+    img = process.Image(raw_pth, shading_correction=False)
+    thumbnail = img.thumbnail(8)
+    assert thumbnail.shape == (8, 120, 3) and thumbnail.dtype == np.uint8
+    expected = (utils.contrast_stretching(
+        np.asarray(img.rawproxy)[::8, ::8].clip(0., 1.), crop_black_circle=450//8)[0]*255).astype(np.uint8)
+    assert np.allclose(thumbnail, expected, atol=1)
+    assert img.isempty()
+
+
+FAKE_RAWTHERAPEE_PROFILES = """#!{python}
+import os, sys
+import numpy as np
+import cv2
+args = sys.argv[1:]
+profiles = [args[index + 1] for index, arg in enumerate(args) if arg == "-p"]
+with open({log!r}, "a") as fi:
+    fi.write("\\n".join(open(profile).read() for profile in profiles[1:]))
+cv2.imwrite(args[args.index("-o") + 1], np.random.RandomState(0).randint(0, 2**16, (16, 128, 3)).astype(np.uint16))
+"""
+
+
+def test_thumbnail_reduced_decoding(tmp_path, monkeypatch):
+    """
+    Without any proxy, thumbnails of RAW images are decoded at reduced resolution by RawTherapee (resize profile)
+    and no proxy is left on disk.
+    """
+    import sys
+    log = str(tmp_path / "profiles.log")
+    fake_rawtherapee = tmp_path / "fake_rawtherapee"
+    fake_rawtherapee.write_text(FAKE_RAWTHERAPEE_PROFILES.format(python=sys.executable, log=log))
+    fake_rawtherapee.chmod(0o755)
+    monkeypatch.setattr(process, "RAWTHERAPEEPATH", str(fake_rawtherapee))
+    raw_pth = str(tmp_path / "DJI_0001.DNG")
+    with open(raw_pth, "wb") as fi:
+        fi.write(b"raw")
+    img = process.Image(raw_pth, shading_correction=False)
+    thumbnail = img.thumbnail(8)
+    assert thumbnail.shape == (16, 128, 3) and thumbnail.dtype == np.uint8  # RawTherapee output size
+    with open(log) as fi:
+        profile = fi.read()
+    assert "Scale=0.125" in profile and "Enabled=true" in profile
+    assert img.isempty() and not process.cached_proxy_exists(raw_pth)
+
+
+def test_pyramidal_search_initial_warp():
+    """
+    With an initial transform, the pyramidal search only estimates the residual homography
+    (the moving image is not resampled at full resolution beforehand).
+    """
+    import cv2
+    from registration.rigid import pyramidal_search, LAPLACIAN_ENERGIES, NTG
+    ref = cv2.GaussianBlur(np.random.RandomState(0).rand(512, 512, 3).astype(np.float32), (0, 0), 2.)
+    shift = np.array([[1., 0., 12.], [0., 1., -8.], [0., 0., 1.]])
+    mov = cv2.warpPerspective(ref, shift, (512, 512))
+
+    def initial_warp(img, homography, downscale, outsize):
+        zoom = np.diag([1./downscale, 1./downscale, 1.])
+        return cv2.warpPerspective(img, np.dot(homography, zoom.dot(np.linalg.inv(shift)).dot(np.linalg.inv(zoom))), outsize)
+    for mov_warp, expected in [(initial_warp, np.eye(3)), (None, np.linalg.inv(shift))]:
+        motion_model = pyramidal_search(
+            ref, mov, iterative_scheme=[(4, 2, 3)], mode=LAPLACIAN_ENERGIES, dist=NTG, affinity=False,
+            debug=False, mov_warp=mov_warp
+        )
+        assert np.allclose(motion_model.model[:2, 2], expected[:2, 2], atol=1.)
+
+
+def test_working_dtype(tmp_path):
+    """
+    Linear data stays in the working dtype (float32) from decoding to the outputs.
+    """
+    import cv2
+    from automatic_registration import vir
+    tif_pth = str(tmp_path / "linear.tif")
+    raw = (np.random.RandomState(0).rand(16, 960, 3)*(2**16-1)).astype(np.uint16)
+    cv2.imwrite(tif_pth, raw)
+    img = process.Image(tif_pth)
+    assert img.lineardata.dtype == np.float32
+    assert np.allclose(img.lineardata, cv2.cvtColor(raw, cv2.COLOR_BGR2RGB)/(2.**16-1), atol=1.E-6)
+    npy_pth = str(tmp_path / "proxy_RawTherapee.npy")
+    process.save_npy_proxy(npy_pth, img.lineardata, proxy_format="float16")
+    assert process.ProxyArray(npy_pth)[::2, ::2].dtype == np.float32
+    vir_pth = str(tmp_path / "vir.tif")
+    vir(img.lineardata, img.lineardata, out_path=vir_pth)
+    assert os.path.isfile(vir_pth)
+
+
+def test_gather_records():
+    """
+    A process pool task which raised (e.g. a worker killed by the OOM killer) only fails its own pairs.
+    """
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    from automatic_registration import gather_records
+    pairs = [("v0", "n0"), ("v1", "n1"), ("v2", "n0")]
+    done, broken = Future(), Future()
+    done.set_result([dict(index=1, vis="v1", nir="n1", motion_model="mm1", error=None)])
+    broken.set_exception(BrokenProcessPool("worker killed"))
+    records = gather_records({done: [1], broken: [0, 2]}, pairs)
+    assert [record["index"] for record in records] == [0, 1, 2]
+    assert records[1]["motion_model"] == "mm1" and records[1]["error"] is None
+    assert all("BrokenProcessPool" in records[index]["error"] for index in [0, 2])
+
+
+def test_raw_pairs_pipeline(monkeypatch):
+    """
+    Pipelined pairs: results in input order, failures isolated, proxies of a NIR image shared by two pairs
+    released only once both pairs are written, clean shutdown when the alignment stage is interrupted.
+    """
+    import threading
+    import automatic_registration as ar
+    pairs = [("v0", "n0"), ("v1", "n1"), ("v2", "n0"), ("v3", "n2"), ("v4", "n3")]
+    written, cleaned = [], []
+
+    class Interrupted(BaseException):
+        pass
+
+    def decode(index_pair, sync_pairs, **kwargs):
+        if index_pair == 4:
+            raise ValueError("corrupted RAW")
+        return dict(index=index_pair)
+
+    def align(job, **kwargs):
+        if job["index"] == 3:
+            raise ValueError("alignment failed")
+        job["motion_model"] = "mm{}".format(job["index"])
+        return job
+
+    def write(job, **kwargs):
+        written.append(job["index"])
+        return job["motion_model"]
+
+    def clean(img_paths, proxy_budget=None):
+        if "n0" in img_paths:
+            assert {0, 2}.issubset(written)
+        cleaned.extend(img_paths)
+
+    monkeypatch.setattr(ar, "decode_raw_pair", decode)
+    monkeypatch.setattr(ar, "align_raw_pair", align)
+    monkeypatch.setattr(ar, "write_raw_pair", write)
+    monkeypatch.setattr(ar, "clean_proxies", clean)
+    threads = threading.active_count()
+    models = ar.process_raw_pairs_pipeline(pairs, queue_depth=1, clean_proxy=True)
+    assert models == ["mm0", "mm1", "mm2", None, None]
+    assert written == [0, 2, 1]
+    assert sorted(cleaned) == sorted([pth for pair in pairs for pth in pair if pth != "n0"] + ["n0"])
+
+    def align_interrupted(job, **kwargs):
+        if job["index"] == 2:
+            raise Interrupted()
+        return align(job)
+    monkeypatch.setattr(ar, "align_raw_pair", align_interrupted)
+    written.clear()
+    try:
+        ar.process_raw_pairs_pipeline(pairs, queue_depth=1)
+        assert False, "interruption not propagated"
+    except Interrupted:
+        pass
+    assert written == [0]
+    assert threading.active_count() == threads
+
+
+def test_raw_pairs_sequential_failures(tmp_path, monkeypatch):
+    """
+    Sequential processing (single worker, no pipeline): a failing pair gets a None motion model, the batch goes on.
+    """
+    import automatic_registration as ar
+    pairs = [("v0", "n0"), ("v1", "n1"), ("v2", "n2")]
+
+    def process(index_pair, sync_pairs, **kwargs):
+        if index_pair == 1:
+            raise ValueError("corrupted RAW")
+        return "mm{}".format(index_pair)
+
+    monkeypatch.setattr(ar, "process_raw_pair", process)
+    models = ar.process_raw_pairs(pairs, out_dir=str(tmp_path), workers=1, queue_depth=0)
+    assert models == ["mm0", None, "mm2"]
+
+
+FAKE_EXIFTOOL = """#!{python}
+import os, sys
+def run(args):
+    files = [arg for arg in args if os.path.isfile(arg)]
+    for pth in files:
+        print("File Name : " + os.path.basename(pth))
+    return ["Warning: fake warning " + os.path.basename(pth) for pth in files]
+args = sys.argv[1:]
+if "-stay_open" not in args or {one_shot}:
+    errors = run(args)
+    sys.stderr.write("\\n".join(errors) + "\\n")
+    sys.exit(0)
+command = []
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if line == "-execute":
+        echo = command[command.index("-echo4") + 1] if "-echo4" in command else None
+        errors = run(command)
+        print("{{ready}}", flush=True)
+        sys.stderr.write("\\n".join(errors + ([echo] if echo else [])) + "\\n")  # warnings after stdout is done
+        sys.stderr.flush()
+        command = []
+    elif command[-1:] == ["-stay_open"] and line == "False":
+        break
+    else:
+        command.append(line)
+"""
+
+
+def test_exiftool_session(tmp_path):
+    """
+    Output of each stay_open command contains its own stdout only (late warnings are not attributed to the next
+    command). Fallback to one process per call when the session dies.
+    """
+    import sys
+    from irdrone.exiftool import ExifToolSession
+    samples = utils.imagepath(imgname="*.JPG")
+    for one_shot in [False, True]:
+        fake_exiftool = tmp_path / f"exiftool_{one_shot}"
+        fake_exiftool.write_text(FAKE_EXIFTOOL.format(python=sys.executable, one_shot=one_shot))
+        fake_exiftool.chmod(0o755)
+        session = ExifToolSession(str(fake_exiftool))
+        for sample in samples:
+            assert session.execute("-n", sample) == "File Name : {}\n".format(os.path.basename(sample))
+        assert session.persistent == (not one_shot)
+        session.close()
+    import shutil
+    if shutil.which("exiftool") is not None:  # real exiftool when available
+        session = ExifToolSession("exiftool")
+        outputs = [session.execute(sample) for sample in samples]
+        assert all("File Name" in output and "{ready" not in output for output in outputs)
+        assert session.persistent
+        session.close()
+
+
+FAKE_RAW_CONVERTER = """#!{python}
+import os, sys, shutil, zlib
+import numpy as np
+import cv2
+args = sys.argv[1:]
+out = args[args.index("-o") + 1]
+in_files = args[args.index("-c") + 1:] if "-c" in args else [arg for arg in args[args.index("-o") + 2:]]
+for in_file in in_files:
+    name = os.path.basename(in_file)
+    if in_file.endswith(".RAW"):  # sjcam_raw2dng: out is an existing folder
+        shutil.copy(in_file, os.path.join(out, name.replace(".RAW", ".dng")))
+        continue
+    with open(in_file, "rb") as fi:  # rawtherapee-cli: out is a file (single input) or a folder
+        seed = zlib.crc32(fi.read())
+    data = np.random.RandomState(seed).randint(0, 2**16, (16, 24, 3)).astype(np.uint16)
+    cv2.imwrite(os.path.join(out, name[:-4] + ".tif") if os.path.isdir(out) else out, data)
+"""
+
+
+def test_batch_convert_raw(tmp_path, monkeypatch):
+    """
+    Batched conversion (several files per sjcam_raw2dng / rawtherapee-cli call) gives the same proxies as the
+    per file conversion of load_dng.
+    """
+    import sys
+    import subprocess
+    fake_converter = tmp_path / "fake_converter"
+    fake_converter.write_text(FAKE_RAW_CONVERTER.format(python=sys.executable))
+    fake_converter.chmod(0o755)
+    monkeypatch.setattr(process, "RAWTHERAPEEPATH", str(fake_converter))
+    monkeypatch.setattr(process, "sjcam_converter_path", lambda: str(fake_converter))
+    names = ["DJI_0001.DNG", "DJI_0002.DNG", "2021_0101_000001_001.RAW", "2021_0101_000003_002.RAW"]
+    for folder in ["batch", "single"]:
+        (tmp_path / folder).mkdir()
+        for index, name in enumerate(names):
+            (tmp_path / folder / name).write_bytes(bytes([index]) * 64)
+    batch = [str(tmp_path / "batch" / name) for name in names]
+    process.batch_convert_raw(batch + [utils.imagepath()], workers=1, batch_size=2)  # 2 files per call
+    for name in names:
+        single = str(tmp_path / "single" / name)
+        dng = [pth if pth.endswith(".DNG") else process.sjcam_dng_path(pth)
+               for pth in [str(tmp_path / "batch" / name), single]]
+        assert os.path.isfile(process.cached_tif(dng[0]))  # converted by the batch
+        if name.endswith(".RAW"):  # per file sjcam_raw2dng call of Image.get_data
+            os.makedirs(os.path.dirname(dng[1]), exist_ok=True)
+            subprocess.call([process.sjcam_converter_path(), "-o", os.path.dirname(dng[1]), single])
+        batch_data, single_data = [process.load_dng(pth)[0] for pth in dng]
+        assert batch_data.dtype == single_data.dtype and np.array_equal(batch_data, single_data)
+
+
+def test_list_visible_images(tmp_path):
+    """
+    The threaded EXIF scan of creatListImgVIS lists the same images as the former pr.Image based listing.
+    DNG headers which can't be parsed with a bounded read fall back to the full file parsing.
+    """
+    import shutil
+    import piexif
+    import PIL.Image
+    import utils.utils_IRdrone as IRd
+    shots = [("DJI_0001", "FC3170", "2021:05:01 10:00:01"), ("DJI_0002", "FC3170", "2021:05:01 10:00:03"),
+             ("DJI_0003", "FC3170", "2021:05:02 10:00:05"), ("DJI_0004", "M20", "2021:05:01 10:00:07")]
+    for name, model, date in shots:
+        exif = piexif.dump({
+            "0th": {piexif.ImageIFD.Make: b"DJI", piexif.ImageIFD.Model: model.encode()},
+            "Exif": {piexif.ExifIFD.DateTimeOriginal: date.encode(), piexif.ExifIFD.BodySerialNumber: b"0123"},
+        })
+        PIL.Image.fromarray(utils.testimage(xsize=32, ysize=24)).save(str(tmp_path / f"{name}.JPG"), exif=exif)
+    shutil.copy(utils.imagepath()[0], str(tmp_path / "SJCAM_0001.JPG"))  # no camera in EXIF
+    shutil.copy(str(tmp_path / "DJI_0001.JPG"), str(tmp_path / "DJI_0005.DNG"))
+    for date_mission, camera_model in [(None, None), (None, "FC3170")]:
+        imlist = sorted(utils.imagepath(imgname="*.JPG", dirname=str(tmp_path)))
+        expected = []  # former listing
+        date_ref = process.Image(imlist[0]).date if date_mission is None else date_mission
+        for pth in imlist:
+            img = process.Image(pth)
+            try:
+                if camera_model is None or img.camera["model"] == camera_model:
+                    if img.date.date() == date_ref.date():
+                        expected.append((os.path.basename(pth), pth, img.date))
+            except (TypeError, KeyError):
+                pass
+        listed = IRd.creatListImgVIS(str(tmp_path), date_mission, "*.JPG", 0, 0, cameraModel=camera_model, workers=2)
+        assert listed == expected and len(listed) == (3 if camera_model is None else 2)
+    dng = str(tmp_path / "DJI_0005.DNG")
+    expected_exif = ("DJI", "FC3170", "0123", IRd.dateExcelString2Py(shots[0][2]))
+    assert IRd.scanExifHeader(dng, headerBytes=16) == IRd.scanExifHeader(dng) == expected_exif
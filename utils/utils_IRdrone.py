@@ -23,6 +23,9 @@ import json
 from copy import copy, deepcopy
 from pathlib import Path
 import subprocess
+import io
+import exifread
+from concurrent.futures import ThreadPoolExecutor
 sep = '\\' if os.name == "nt" else "/"
 try:
     from tkinter import Tk
@@ -38,6 +41,7 @@ from datetime import timedelta
 
 sys.path.append(osp.join(osp.dirname(__file__), ".."))
 import irdrone.process as pr
+import irdrone.metadata_index as metadata_index
 import irdrone.utils as ut
 from irdrone.utils import Style
 import utils.utils_GPS as uGPS
@@ -432,12 +436,59 @@ def creatListImgNIR(dirName, rege):
     return imgList
 
 
-def creatListImgVIS(dirName, dateMission, rege, timelapse, deltatime, cameraModel=None, debug=False):
+EXIF_HEADER_BYTES = 2**18  # TIFF / EXIF IFDs of DJI DNG lie in the first few kB, image data follows
+
+
+def scanExifHeader(pathImg, headerBytes=EXIF_HEADER_BYTES):
+    """
+    Fast scanning of the few EXIF tags needed to list images: camera maker, model, serial number and date.
+    DNG: only the beginning of the file is read (bounded read, no maker notes, stop after the needed tags).
+    Falls back to a full file parsing when the bounded parsing fails or the tags lie further in the file.
+    Other images (JPG, TIF) use the pr.Image metadata (PIL EXIF parsing, as before).
+    :return: (maker, model, serial number, date) or None when the file has no readable EXIF
+    """
+    if not pathImg.lower().endswith("dng"):
+        try:
+            img = pr.Image(pathImg)
+            camera, date = img.camera, img.date
+        except Exception:
+            return None
+        if camera is None or date is None:
+            return None
+        return camera["maker"], camera["model"], camera["serial number"], date
+
+    def extract(exifTag):
+        try:
+            return (
+                str(exifTag['Image Make']),
+                str(exifTag['Image Model']),
+                str(exifTag['EXIF BodySerialNumber']),
+                dateExcelString2Py(str(exifTag['EXIF DateTimeOriginal']))
+            )
+        except (KeyError, ValueError):
+            return None
+    try:
+        with open(pathImg, 'rb') as f:
+            header = io.BytesIO(f.read(headerBytes))
+        info = extract(exifread.process_file(header, details=False, stop_tag='BodySerialNumber'))
+    except Exception:
+        info = None  # truncated header, the full parsing may succeed
+    if info is None:
+        try:
+            with open(pathImg, 'rb') as f:
+                info = extract(exifread.process_file(f, details=False))
+        except Exception:
+            return None
+    return info
+
+
+def creatListImgVIS(dirName, dateMission, rege, timelapse, deltatime, cameraModel=None, debug=False, workers=None):
     """
     :param dirName:
     :param dateMission:
     :param debug:
     :param cameraModel: optional to filter out wrong cameras
+    :param workers: number of threads scanning EXIF headers, None: ThreadPoolExecutor default (based on cpu count)
     :return:  imgList   [(), ...,(file name image , path name image, date image), ..., ()]
     """
 
@@ -448,42 +499,37 @@ def creatListImgVIS(dirName, dateMission, rege, timelapse, deltatime, cameraMode
 
     print(Style.CYAN + 'INFO : ------ Creating the list of visible spectrum images' + Style.RESET)
     imlist = sorted(ut.imagepath(imgname=rege, dirname=dirName))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        exifList = list(executor.map(scanExifHeader, imlist))
 
     imgList = []
     j = 0
     if dateMission is None:
-        dateMission = pr.Image(imlist[0]).date
+        dateMission = next((exif[3] for exif in exifList if exif is not None), None)
+    debug = True
     for i in range(len(imlist)):
-        img = pr.Image(imlist[i])
-        img.camera["timelapse"] = float(timelapse)
-        img.camera["deltatime"] = float(deltatime)
-
-        try:
-            # Extract Exif data from the image. If no Exif data, image is ignored.
-            debug = True
-            cameraMakerImg = img.camera['maker']
-            cameraModelImg = img.camera['model']
-            serial_number = img.camera['serial number']
-
-            if cameraModel is None or cameraModelImg == cameraModel or ( cameraMakerImg == 'irdrone' and cameraModelImg == 'multispectral'):
-                dateImg = img.date
-                if (dateImg.year, dateImg.month, dateImg.day) == (dateMission.year, dateMission.month, dateMission.day):
-                    j += 1
-                    nameImg = imlist[i].split(sep)[len(imlist[i].split(sep)) - 1]
-                    imgList.append((nameImg, imlist[i], dateImg))  # Add to image list.
-                else:
-                    # Image was taken by another camera. This image is ignored.
-                    if debug: print(Style.YELLOW,
-                                    '%s was taken on  %i %i %i. This date is different from the mission date %i %i %i'
-                                    % (imlist[i], dateImg.day, dateImg.month, dateImg.year, dateMission.day,
-                                       dateMission.month,
-                                       dateMission.year), Style.RESET)
+        # Extract Exif data from the image. If no Exif data, image is ignored.
+        if exifList[i] is None:
+            if debug: print("No Exif tags in %s" % imlist[i])
+            continue
+        cameraMakerImg, cameraModelImg, serial_number, dateImg = exifList[i]
+
+        if cameraModel is None or cameraModelImg == cameraModel or ( cameraMakerImg == 'irdrone' and cameraModelImg == 'multispectral'):
+            if (dateImg.year, dateImg.month, dateImg.day) == (dateMission.year, dateMission.month, dateMission.day):
+                j += 1
+                nameImg = imlist[i].split(sep)[len(imlist[i].split(sep)) - 1]
+                imgList.append((nameImg, imlist[i], dateImg))  # Add to image list.
             else:
+                # Image was taken by another camera. This image is ignored.
                 if debug: print(Style.YELLOW,
-                                '%s was taken by another camera (Model %s) ' % (imlist[i], cameraModelImg),
-                                Style.RESET)
-        except:
-            if debug: print("No Exif tags in %s" % imlist[i])
+                                '%s was taken on  %i %i %i. This date is different from the mission date %i %i %i'
+                                % (imlist[i], dateImg.day, dateImg.month, dateImg.year, dateMission.day,
+                                   dateMission.month,
+                                   dateMission.year), Style.RESET)
+        else:
+            if debug: print(Style.YELLOW,
+                            '%s was taken by another camera (Model %s) ' % (imlist[i], cameraModelImg),
+                            Style.RESET)
 
     if float(timelapse) > 0:
         # Dates are only corrected if the images have been taken in hyperlapse.
@@ -638,6 +684,7 @@ def matchImagesAorB(timeLapseDrone, imgListDrone, deltaTimeDrone, timeLapseIR, i
 # -------------------------     Synthèse de informations sur la mission      ------------------------------------------
 
 def spatialAttitude(listPts, listImg):
+    metadata_index.fill([listImg[i][0] for i in range(len(listImg))])  # parse all EXIF once, in parallel
     flightAngle, gimbalAngle = [], []
     for i in range(len(listImg)):
         img = pr.Image(listImg[i][0])
@@ -664,6 +711,7 @@ def spatialCoordinates(listPts, listImg, coordGPSTakeOff, seaLevel, altitude_api
 
 
 def gpsCoordinate(listPts, listImg, coordGPSTakeOff):
+    metadata_index.fill([listImg[i][0] for i in range(len(listImg))])  # parse all EXIF once, in parallel
     listPtGPS, listCoordGPS = [], []
 
     for i in range(len(listImg)):